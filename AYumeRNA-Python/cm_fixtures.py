@@ -0,0 +1,370 @@
+"""
+fixtures of the covariance model tools in src/infernal_tools.py, for test_infernal_tools.py and scripts/benchmark_cm.py:
+synthetic CM and traceback files, and the previous implementations that the tests and benchmarks compare against.
+"""
+import os
+import re
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+import numpy as np
+from collections import OrderedDict
+
+# states of each node type, in the order infernal writes them.
+NODE_STATES = {
+    "ROOT": ["S", "IL", "IR"],
+    "BEGL": ["S"],
+    "BEGR": ["S", "IL"],
+    "MATP": ["MP", "ML", "MR", "D", "IL", "IR"],
+    "MATL": ["ML", "D", "IL"],
+    "MATR": ["MR", "D", "IR"],
+    "BIF":  ["B"],
+    "END":  ["E"],
+}
+
+def _synthetic_guide_tree(rng, n_consensus, max_depth):
+    """
+    random guide tree in CM node order (pre-order, left subtree first).
+    returns node types and a map of BIF node -> BEGR node.
+    """
+    nodes     = ["ROOT"]
+    bif_right = dict()
+
+    def segment(budget, depth):
+        if depth >= max_depth or budget < 8:
+            n_here = budget
+        else:
+            n_here = max(1, int(budget*rng.uniform(0.2, 0.5)))
+        for _ in range(n_here):
+            nodes.append(rng.choice(["MATP", "MATP", "MATL", "MATR"]))
+        rest = budget - n_here
+        if rest >= 2:
+            bif = len(nodes)
+            nodes.append("BIF")
+            nodes.append("BEGL")
+            segment(rest//2, depth + 1)
+            bif_right[bif] = len(nodes)
+            nodes.append("BEGR")
+            segment(rest - rest//2, depth + 1)
+        else:
+            nodes.append("END")
+
+    segment(n_consensus, 0)
+    return nodes, bif_right
+
+def write_synthetic_cmfile(path, n_consensus = 70, max_depth = 3, seed = 0):
+    """
+    write a CM file in the infernal 1.1 ascii layout with random parameters.
+    n_consensus: number of MATP/MATL/MATR nodes. the number of states is about 4.5 times larger.
+    Only the parts read by CMReader are meaningful (no filter HMM, no calibration).
+    """
+    rng = np.random.default_rng(seed)
+    nodes, bif_right = _synthetic_guide_tree(rng, n_consensus, max_depth)
+
+    states, node_first = [], []
+    for ni, node_type in enumerate(nodes):
+        node_first.append(len(states))
+        for state_type in NODE_STATES[node_type]:
+            states.append((state_type, ni))
+
+    def split_set(ni):
+        return [node_first[ni] + k for k, t in enumerate(NODE_STATES[nodes[ni]]) if t not in {"IL", "IR"}]
+
+    def inserts(ni):
+        return [node_first[ni] + k for k, t in enumerate(NODE_STATES[nodes[ni]]) if t in {"IL", "IR"}]
+
+    children = []
+    for v, (state_type, ni) in enumerate(states):
+        if state_type == "E":
+            children.append([])
+        elif state_type == "B":
+            children.append([node_first[ni + 1], node_first[bif_right[ni]]])
+        elif state_type == "IL":
+            children.append([c for c in inserts(ni) if c >= v] + split_set(ni + 1))
+        elif state_type == "IR":
+            children.append([v] + split_set(ni + 1))
+        else:
+            children.append(inserts(ni) + split_set(ni + 1))
+
+    parents = [[] for _ in states]
+    for v, cs in enumerate(children):
+        for c in cs:
+            parents[c].append(v)
+
+    lines = [
+        "INFERNAL1/a [1.1.4 | Dec 2020]\n",
+        f"NAME     synthetic{seed}\n",
+        f"STATES   {len(states)}\n",
+        f"NODES    {len(nodes)}\n",
+        "ALPH     RNA\n",
+        "GA       40.00\n",
+        "TC       40.00\n",
+        "NC       39.90\n",
+        "CM\n",
+    ]
+    for v, (state_type, ni) in enumerate(states):
+        if v == node_first[ni]:
+            lines.append(" "*45 + f"[ {nodes[ni]:<4s} {ni:4d} ]" + "      -"*6 + "\n")
+
+        cs = children[v]
+        if state_type == "B":
+            cfirst, cnum = cs
+            trans = []
+        else:
+            cfirst, cnum = (cs[0] if cs else -1), len(cs)
+            # inserts are rarely entered and rarely extended, as in real CMs
+            alpha = [0.3 if states[c][0] in {"IL", "IR"} else 2. for c in cs]
+            probs = rng.dirichlet(alpha) if cnum else []
+            trans = [f"{np.log2(p):.3f}" if p > 1e-12 else "*" for p in probs]
+
+        if state_type in {"IL", "IR"}:
+            emit = ["0.000"]*4
+        elif state_type in {"ML", "MR"}:
+            emit = [f"{np.log2(p/0.25):.3f}" for p in rng.dirichlet(np.ones(4))]
+        elif state_type == "MP":
+            alpha = np.ones(16)*0.2
+            alpha[[3, 6, 9, 11, 12, 14]] = 4. # AU CG GC GU UA UG
+            emit = [f"{np.log2(max(p, 1e-9)/0.0625):.3f}" for p in rng.dirichlet(alpha)]
+        else:
+            emit = []
+
+        plast = parents[v][-1] if parents[v] else -1
+        head  = f"    {state_type:>2s} {v:5d} {plast:5d} {len(parents[v]):1d} {cfirst:5d} {cnum:5d} {0:5d} {0:5d} {0:5d} {0:5d} "
+        lines.append(head + " ".join(f"{x:>7s}" for x in trans + emit) + " \n")
+    lines.append("//\n")
+
+    with open(path, "w") as f:
+        f.writelines(lines)
+    return path
+
+def _legacy_num_to_state(content):
+    num_to_state = dict()
+    flag = False
+    for line in content:
+        if re.match("CM", line):
+            flag = True
+        elif re.match("//", line):
+            break
+        if flag and not re.match("CM", line):
+            if re.match(r"\s{45}", line) == None:
+                state_line = re.split(r"\s+", line)
+                num_to_state[int(state_line[2])] = "_".join(state_line[1:3])
+    return num_to_state
+
+def _legacy_read_state_line(content, line):
+    num_to_state     = _legacy_num_to_state(content)
+    state_line       = re.split(r"\s+", line)
+    state_name       = "_".join(state_line[1:3])
+    prob_trans       = OrderedDict()
+    lowest_child_idx = int(state_line[5])
+    num_child        = int(state_line[6]) if int(state_line[6]) <= 6 else 2
+    for i in range(num_child):
+        if re.match(r"B_\d+", state_name) == None:
+            log_odds = state_line[11+i]
+            prob_trans.update({num_to_state[lowest_child_idx + i]:2**float(log_odds) if log_odds != '*' else float(0)})
+        else:
+            prob_trans.update({num_to_state[lowest_child_idx]:float(1), num_to_state[int(state_line[6])]:float(1)})
+
+    if re.match(r"(IL|IR|ML|MR)_\d+", state_name) != None:
+        prob_emit = {k:(2**float(v)/4) for k, v in zip(['A', 'C', 'G', 'U'], state_line[-5:-1])}
+    elif 'MP' in state_name:
+        double_nuc = [n+m for n in ['A', 'C', 'G', 'U'] for m in ['A', 'C', 'G', 'U']]
+        prob_emit  = {k:(2**float(v)/16) for k, v in zip(double_nuc, state_line[-17:-1])}
+    else:
+        prob_emit = {}
+    return state_name, prob_trans, prob_emit
+
+def load_derivation_dict_legacy(cmreader):
+    """
+    derivation dict built the way CMReader did before the single-pass parser:
+    every state line rescans the file for the state-number map.
+    """
+    derivation_dict = OrderedDict()
+    flag            = False
+    for line in cmreader.content:
+        if re.match("CM", line):
+            flag = True
+        elif re.match("//", line):
+            flag = False
+        if flag and not re.match("CM", line):
+            if re.match(r"\s{45}", line):
+                state_dict = OrderedDict()
+                node_name  = cmreader._read_node_line(line)
+            else:
+                state_name, prob_trans, prob_emit = _legacy_read_state_line(cmreader.content, line)
+                state_dict.update({state_name:{"trans":prob_trans, "emit":prob_emit}})
+            derivation_dict.update({node_name:state_dict})
+    return derivation_dict
+
+def cmeval_legacy(deriv_dict, seq):
+    """
+    probability of seq by the inside algorithm as CovarianceModel.cmeval computed it
+    before the log-space version: probability space, one scalar at a time.
+    """
+    import torch
+    trans_prob_dict = dict()
+    for states in deriv_dict.values():
+        trans_prob_dict.update(states)
+    state2index = {state:i for i, state in enumerate(trans_prob_dict)}
+    statetype   = lambda state: state.split("_")[0][-1]
+    DeltaL = {"P":1, "L":1, "D":0, "S":0, "B":0, "E":0, "R":0,}
+    DeltaR = {"P":1, "R":1, "D":0, "S":0, "B":0, "E":0, "L":0,}
+    L = len(seq)
+    M = len(trans_prob_dict)
+    a = torch.zeros(M, L+2, L+2)
+
+    for j in range(0, L+1):
+        for state in list(trans_prob_dict.keys())[::-1]:
+            if statetype(state) == "E":
+                a[state2index[state]][j+1, j] = 1
+            elif statetype(state) in "SD":
+                for child_state, trans_prob in trans_prob_dict[state]["trans"].items():
+                    a[state2index[state]][j+1, j] += trans_prob * a[state2index[child_state]][j+1, j]
+            elif statetype(state) == "B":
+                child_bif1, child_bif2 = trans_prob_dict[state]["trans"].keys()
+                a[state2index[state]][j+1, j] = a[state2index[child_bif1]][j+1, j] * a[state2index[child_bif2]][j+1, j]
+
+    for j in range(1, L+1):
+        for i in range(j, 0, -1):
+            for state in list(trans_prob_dict.keys())[::-1]:
+                if statetype(state) == "E" or (statetype(state) == "P" and i == j):
+                    continue
+                elif statetype(state) == "B":
+                    child_bif1, child_bif2 = trans_prob_dict[state]["trans"].keys()
+                    for k in range(i-1, j+1):
+                        a[state2index[state]][i][j] += a[state2index[child_bif1]][i, k] * a[state2index[child_bif2]][k+1, j]
+                else:
+                    if   statetype(state) == "L": emit_prob = trans_prob_dict[state]["emit"][seq[i-1]]
+                    elif statetype(state) == "R": emit_prob = trans_prob_dict[state]["emit"][seq[j-1]]
+                    elif statetype(state) == "P": emit_prob = trans_prob_dict[state]["emit"][seq[i-1] + seq[j-1]]
+                    else:                         emit_prob = 1.
+                    for child_state, trans_prob in trans_prob_dict[state]["trans"].items():
+                        a[state2index[state]][i][j] += emit_prob * trans_prob *\
+                            a[state2index[child_state]][i + DeltaL[statetype(state)], j - DeltaR[statetype(state)]]
+    return float(a[0][1,L])
+
+def write_synthetic_tfile(path, cm, seqs, local_rng = None):
+    """
+    gzipped traceback file in the layout of cmalign --tfile, from CYK parses of seqs.
+    local_rng: np.random.Generator. If given, a random subtree of each parse is cut
+               and replaced by an EL row, as in local alignments.
+    """
+    import gzip
+    from infernal_tools import TRACEBACK_SEPARATOR
+
+    M = cm.compiled.n_states
+    with gzip.open(path, "wb") as f:
+        for n, seq in enumerate(seqs):
+            _, parse = cm.cyk(seq)
+            rows = cm.make_tbdf_from_parse(seq, parse).values.tolist()
+            if local_rng is not None:
+                candidates = [k for k, row in enumerate(rows) if k > 0 and row[2][-1] not in "BES"]
+                if candidates:
+                    k, pending = int(local_rng.choice(candidates)), 0
+                    for end in range(k, len(rows)):
+                        state_type = rows[end][2].lstrip("0123456789")
+                        pending   += {"B":1, "E":-1}.get(state_type, 0)
+                        if pending < 0:
+                            break
+                    rows = rows[:k+1] + [[rows[k+1][0], rows[end][1], f"{M}EL", "J", "-1", "-1", str(k), "-", "-"]] + rows[end+1:]
+            f.write(f">seq{n}\n\n".encode())
+            f.write(b"  idx  emitl  emitr   state  mode  nxtl  nxtr   prv    tsc    esc\n")
+            f.write(TRACEBACK_SEPARATOR)
+            for x, row in enumerate(rows):
+                emitl, emitr, state, mode, nxtl, nxtr, prv, tsc, esc = row
+                f.write(f"{x:5d} {emitl:>6s} {emitr:>6s} {state:>7s} {mode:>5s} {nxtl:>5s} {nxtr:>5s} {prv:>5s} {tsc:>6s} {esc:>6s}\n".encode())
+            f.write(TRACEBACK_SEPARATOR + b"\n")
+    return path
+
+def _legacy_traceback_texts(traceback_file):
+    """
+    raw row lines of each traceback of a gzipped traceback file, as the legacy reader read them (one readline at a time).
+    """
+    import gzip
+    from infernal_tools import TRACEBACK_SEPARATOR
+    with gzip.open(traceback_file, "rb") as f:
+        in_table = False
+        for line in iter(f.readline, b''):
+            if line.startswith(TRACEBACK_SEPARATOR):
+                in_table = not in_table
+                if in_table:
+                    tbtext = []
+                else:
+                    yield tbtext
+            elif in_table:
+                tbtext.append(line)
+
+def _legacy_make_tbdict_from_tbtext(tbtext):
+    import pandas as pd
+    backtrack_log = []
+    for line in tbtext:
+        _, _, *token, _ = re.split(r"\s+", line.decode())
+        backtrack_log.append(token)
+    header = "emitl  emitr   state  mode  nxtl  nxtr  prv   tsc   esc"
+    tbdf = pd.DataFrame(backtrack_log, columns = re.split(r"\s+", header))
+
+    traceback_dict = OrderedDict()
+    parent_state   = ""
+    last_emit      = ""
+    bif_stack      = []
+    for i, row in tbdf.iterrows():
+        trans_emit_from_parent = OrderedDict({"trans":OrderedDict(), "emit":OrderedDict()})
+        child_state = re.search(r"[A-Z]+", row["state"]).group() + "_" + re.search(r"\d+", row["state"]).group()
+        emitl       = row["emitl"][-1] if not row["emitl"].isnumeric() else ""
+        emitr       = row["emitr"][-1] if not row["emitr"].isnumeric() else ""
+        if "B" in child_state:
+            bif_stack.append(child_state)
+        if i != 0:
+            if "S" in child_state and "E" in parent_state:
+                traceback_dict[bif_stack.pop()]["trans"].update({child_state:1})
+            else:
+                trans_emit_from_parent["trans"].update({child_state:1})
+            if not last_emit == "":
+                trans_emit_from_parent["emit"].update({last_emit:1})
+            traceback_dict.update({parent_state:trans_emit_from_parent})
+        parent_state = child_state
+        last_emit    = emitl+emitr
+    return traceback_dict
+
+def load_aligned_tbdicts_legacy(cm_file, traceback_file):
+    """
+    aligned tbdicts (ELinitCM) of every traceback, the way TracebackFileReader made them
+    before the streaming parser: DataFrame per traceback, iterrows, deepcopy of the template.
+    """
+    import copy
+    from infernal_tools import TracebackFileReader
+
+    reader  = TracebackFileReader(cm_file)
+    results = []
+    for tbtext in _legacy_traceback_texts(traceback_file):
+        aligned_tbdict = copy.deepcopy(reader.cm_deriv_dict)
+        tbdict         = _legacy_make_tbdict_from_tbtext(tbtext)
+        modeEL = False
+        for node, states_in_nodes in aligned_tbdict.items():
+            for parent_state, trans_emit in states_in_nodes.items():
+                if modeEL and ("S" in parent_state):
+                    modeEL = False
+                if parent_state in tbdict.keys():
+                    for nuc, prob in trans_emit["emit"].items():
+                        sum_count_from_parent = sum(tbdict[parent_state]["emit"].values())
+                        if nuc in tbdict[parent_state]["emit"]:
+                            count = tbdict[parent_state]["emit"][nuc]/sum_count_from_parent
+                        elif not modeEL:
+                            count = 0
+                        else:
+                            count = aligned_tbdict[node][parent_state]["emit"][nuc]
+                        aligned_tbdict[node][parent_state]["emit"][nuc] = count
+                    for tbchild in tbdict[parent_state]["trans"]:
+                        if "EL_" in tbchild:
+                            modeEL = True
+                            break
+                    for child_state, prob in trans_emit["trans"].items():
+                        sum_count_from_parent = 1 if "B" in parent_state else sum(tbdict[parent_state]["trans"].values())
+                        if child_state in tbdict[parent_state]["trans"]:
+                            val = tbdict[parent_state]["trans"][child_state]/sum_count_from_parent
+                        elif not modeEL:
+                            val = 0
+                        else:
+                            val = aligned_tbdict[node][parent_state]["trans"][child_state]
+                        aligned_tbdict[node][parent_state]["trans"][child_state] = val
+        results.append(aligned_tbdict)
+    return results
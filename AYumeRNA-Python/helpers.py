@@ -1,6 +1,7 @@
 import os
 import subprocess
 import gzip
+import hashlib
 import requests
 import tempfile
 from flask import Flask, jsonify
@@ -42,6 +43,31 @@ def download_file_from_minio(url, destination):
         print(f"Error during download: {e}")
         raise
 
+# 通用函数：文件内容的 SHA-256
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+# 通用函数：文件内容的键, 用于缓存
+def artifact_key(url, destination):
+    """
+    content key of the file at url: its ETag (the MD5 of the content for MinIO), or the SHA-256 of the file
+    downloaded to destination if the server gives no strong ETag (e.g. HEAD on a presigned GET URL).
+    returns (key, downloaded); downloaded tells whether destination now holds the file.
+    """
+    try:
+        response = requests.head(url, verify=False, proxies={'http': None, 'https': None}, allow_redirects=True, timeout=30)
+        etag = response.headers.get('ETag', '') if response.status_code == 200 else ''
+    except requests.RequestException:
+        etag = ''
+    if etag and not etag.startswith('W/'):
+        return "etag:" + etag.strip('"'), False
+    download_file_from_minio(url, destination)
+    return f"sha256:{file_sha256(destination)}", True
+
 # 通用函数：运行 cmalign 工具并处理输出
 def run_cmalign(fasta_file, cmfile, cpu_cores=4, progress_messages=[]):
     try:
@@ -0,0 +1,456 @@
+"""
+persistent job queue of the long-running endpoints.
+
+Jobs are rows of a SQLite database (JOBS_DB, default data/jobs.sqlite), so that queued jobs survive a restart of the
+server. A job runs a module-level function `func(params, progress_messages, work_dir)` that returns a JSON-serializable
+dict. It runs in one of the worker processes of JobWorkerPool, in its own directory data/jobs/<job id>.
+progress_messages is a ProgressFeed: every message appended to it, and every line the job prints, is stored with the
+job and can be polled (/jobs/<job id>) or streamed (/jobs/<job id>/stream) while the job runs (see routes/jobs.py).
+
+Workers send heartbeats. A running job whose worker stopped sending them (killed, out of memory, server restart) is
+queued again, up to MAX_ATTEMPTS runs, and fails after that. It reruns in the same directory, so jobs that checkpoint
+there (training) continue where they stopped. When a job finishes, its directory is deleted except the file named by
+result["file"], which is kept for JOB_RETENTION_HOURS together with the progress of the job.
+"""
+import atexit
+import importlib
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+
+JOBS_DB  = os.environ.get('AYUMERNA_JOBS_DB', os.path.join(os.getcwd(), 'data', 'jobs.sqlite'))
+JOBS_DIR = os.environ.get('AYUMERNA_JOBS_DIR', os.path.join(os.getcwd(), 'data', 'jobs'))
+JOB_RETENTION_HOURS = float(os.environ.get('AYUMERNA_JOB_RETENTION_HOURS', 72))
+DONE     = ('succeeded', 'failed')
+MAX_ATTEMPTS      = 2   # runs of a job whose worker dies before it fails
+HEARTBEAT_SECONDS = 10
+STALE_SECONDS     = 60  # a worker without heartbeat for this long is gone
+PURGE_SECONDS     = 600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    func TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    pid INTEGER,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+CREATE TABLE IF NOT EXISTS progress (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    time REAL NOT NULL,
+    kind TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS progress_job ON progress (job_id, seq);
+CREATE TABLE IF NOT EXISTS workers (
+    id TEXT PRIMARY KEY,
+    pid INTEGER,
+    heartbeat REAL NOT NULL
+);
+"""
+# columns added to the jobs table after its first version
+JOB_COLUMNS = {"worker": "TEXT", "attempts": "INTEGER NOT NULL DEFAULT 0"}
+
+
+class JobStore:
+    """
+    jobs and their progress messages in a SQLite file. Each call opens its own connection, so one store may be used
+    from Flask threads and worker processes at once.
+    """
+    def __init__(self, path = JOBS_DB):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for name, definition in JOB_COLUMNS.items():
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+
+    def open(self):
+        """autocommit connection. Close it when done."""
+        conn = sqlite3.connect(self.path, timeout = 60, isolation_level = None, check_same_thread = False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def connect(self):
+        """autocommit connection, closed on exit."""
+        conn = self.open()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def submit(self, func, params):
+        """queue func(params, ...) and return the job id. func must be a module-level function."""
+        job_id = uuid.uuid4().hex
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, func, params, status, created) VALUES (?, ?, ?, 'queued', ?)",
+                (job_id, f"{func.__module__}:{func.__qualname__}", json.dumps(params), time.time())
+            )
+        return job_id
+
+    def claim(self, worker_id, pid = None):
+        """mark the oldest queued job as running in worker worker_id and return it (None if the queue is empty)."""
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1").fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, pid = ?, started = ?, attempts = attempts + 1 WHERE id = ?",
+                    (worker_id, pid, time.time(), row["id"])
+                )
+            conn.execute("COMMIT")
+        return None if row is None else dict(row)
+
+    def finish(self, job_id, result = None, error = None):
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ? WHERE id = ?",
+                ('failed' if error is not None else 'succeeded', json.dumps(result), error, time.time(), job_id)
+            )
+
+    def add_progress(self, job_id, message, kind = 'message', conn = None):
+        """kind: 'message' (progress_messages of the job) or 'output' (a line the job printed)."""
+        if conn is None:
+            with self.connect() as conn:
+                return self.add_progress(job_id, message, kind, conn)
+        conn.execute("INSERT INTO progress (job_id, time, kind, message) VALUES (?, ?, ?, ?)", (job_id, time.time(), kind, str(message)))
+
+    def progress(self, job_id, after = 0, kinds = ('message', 'output')):
+        """progress of a job as (seq, time, kind, message), after seq `after` only."""
+        with self.connect() as conn:
+            return [tuple(row) for row in conn.execute(
+                f"SELECT seq, time, kind, message FROM progress WHERE job_id = ? AND seq > ? AND kind IN ({','.join('?'*len(kinds))}) ORDER BY seq",
+                (job_id, after, *kinds)
+            )]
+
+    def get(self, job_id):
+        """the job as a dict with decoded params and result, or None."""
+        with self.connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        job["queue_position"] = self.queue_position(job) if job["status"] == 'queued' else None
+        return job
+
+    def queue_position(self, job):
+        with self.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created < ?", (job["created"],)).fetchone()[0]
+
+    def heartbeat(self, worker_id, pid = None):
+        with self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO workers (id, pid, heartbeat) VALUES (?, ?, ?)", (worker_id, pid, time.time()))
+
+    def remove_worker(self, worker_id):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM workers WHERE id = ?", (worker_id,))
+
+    def live_workers(self, stale = STALE_SECONDS):
+        """number of workers with a heartbeat in the last `stale` seconds."""
+        with self.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM workers WHERE heartbeat > ?", (time.time() - stale,)).fetchone()[0]
+
+    def requeue_orphans(self, dead_workers = (), stale = STALE_SECONDS):
+        """
+        running jobs of the workers in dead_workers, or of workers without heartbeat for `stale` seconds, are queued
+        again, or failed after MAX_ATTEMPTS runs. Returns {job id: new status}.
+        """
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            orphans = conn.execute(
+                f"""SELECT jobs.id, jobs.attempts FROM jobs LEFT JOIN workers ON jobs.worker = workers.id
+                    WHERE jobs.status = 'running' AND (workers.id IS NULL OR workers.heartbeat < ?
+                    OR jobs.worker IN ({','.join('?'*len(dead_workers))}))""",
+                (time.time() - stale, *dead_workers)
+            ).fetchall()
+            requeued = {}
+            for row in orphans:
+                if row["attempts"] < MAX_ATTEMPTS:
+                    requeued[row["id"]] = 'queued'
+                    conn.execute("UPDATE jobs SET status = 'queued', worker = NULL, pid = NULL WHERE id = ?", (row["id"],))
+                    message = "Requeued after the worker stopped."
+                else:
+                    requeued[row["id"]] = 'failed'
+                    message = f"The worker stopped during each of {row['attempts']} runs."
+                    conn.execute("UPDATE jobs SET status = 'failed', error = ?, finished = ? WHERE id = ?", (message, time.time(), row["id"]))
+                self.add_progress(row["id"], message, conn = conn)
+            conn.execute("DELETE FROM workers WHERE heartbeat < ?", (time.time() - stale,))
+            conn.execute("COMMIT")
+        return requeued
+
+    def purge_finished(self, before):
+        """forget the progress of the jobs finished before time `before`. Returns their ids."""
+        with self.connect() as conn:
+            job_ids = [row[0] for row in conn.execute("SELECT id FROM jobs WHERE status IN ('succeeded', 'failed') AND finished < ?", (before,))]
+            conn.executemany("DELETE FROM progress WHERE job_id = ?", [(job_id,) for job_id in job_ids])
+        return job_ids
+
+    def oldest_pending(self):
+        """creation time of the oldest queued or running job, or None."""
+        with self.connect() as conn:
+            return conn.execute("SELECT MIN(created) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+
+    def wait(self, job_id, poll = 1.0, timeout = None):
+        """block until the job is done and return it. TimeoutError after timeout seconds."""
+        start = time.time()
+        while True:
+            job = self.get(job_id)
+            if job is None or job["status"] in DONE:
+                return job
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError(f"Job {job_id} is still {job['status']} after {timeout:.0f} s.")
+            time.sleep(poll)
+
+
+class _ProgressSink:
+    """
+    one connection per process for the progress of a job. Processes forked by the job (pools, data loaders)
+    open their own instead of using the inherited one.
+    """
+    def __init__(self, store, job_id):
+        self.store  = store
+        self.job_id = job_id
+        self.lock   = threading.Lock()
+        self.pid    = None
+        self.conn   = None
+
+    def add(self, message, kind):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid, self.conn = os.getpid(), self.store.open()
+            self.store.add_progress(self.job_id, message, kind, conn = self.conn)
+
+    def close(self):
+        if self.conn is not None and self.pid == os.getpid():
+            self.conn.close()
+        self.conn = None
+
+
+class ProgressFeed(list):
+    """progress_messages list that also stores every message with the job."""
+    def __init__(self, sink):
+        super().__init__()
+        self.sink = sink
+
+    def append(self, message):
+        super().append(message)
+        self.sink.add(message, 'message')
+
+
+class _FeedWriter:
+    """stdout of a job: passes writes through and adds complete lines to the progress feed."""
+    def __init__(self, stream, sink):
+        self.stream = stream
+        self.sink   = sink
+        self.buffer = ""
+
+    def write(self, text):
+        self.stream.write(text)
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split("\n")
+        for line in lines:
+            if line.strip():
+                self.sink.add(line, 'output')
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def _clean_work_dir(work_dir, keep = None):
+    """delete work_dir, or everything in it but the file keep."""
+    keep = os.path.abspath(keep) if keep else None
+    if keep is None or not keep.startswith(os.path.abspath(work_dir) + os.sep):
+        shutil.rmtree(work_dir, ignore_errors = True)
+        return
+    for root, dirs, files in os.walk(work_dir, topdown = False):
+        for name in files:
+            if os.path.join(os.path.abspath(root), name) != keep:
+                os.remove(os.path.join(root, name))
+        for name in dirs:
+            if not os.listdir(os.path.join(root, name)):
+                os.rmdir(os.path.join(root, name))
+
+
+def _newest_mtime(path):
+    """last modification of path or of anything in it (writing a file does not touch its directory)."""
+    newest = os.path.getmtime(path)
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            newest = max(newest, os.path.getmtime(os.path.join(root, name)))
+    return newest
+
+
+def run_job(store, job):
+    """run a claimed job in this process, record its result or error and clean its directory."""
+    job_id   = job["id"]
+    sink     = _ProgressSink(store, job_id)
+    progress = ProgressFeed(sink)
+    work_dir = os.path.join(JOBS_DIR, job_id)
+    os.makedirs(work_dir, exist_ok = True)
+    stdout, sys.stdout = sys.stdout, _FeedWriter(sys.stdout, sink)
+    result = None
+    try:
+        module, name = job["func"].split(":")
+        func   = getattr(importlib.import_module(module), name)
+        result = func(json.loads(job["params"]), progress, work_dir)
+        store.finish(job_id, result = result)
+    except Exception as e:
+        traceback.print_exc()
+        store.finish(job_id, error = str(e))
+    finally:
+        sys.stdout = stdout
+        sink.close()
+        _clean_work_dir(work_dir, keep = (result or {}).get("file"))
+
+
+def _heartbeats(store, worker_id, stop, interval):
+    while not stop.wait(interval):
+        try:
+            store.heartbeat(worker_id, os.getpid())
+        except sqlite3.Error as e:
+            print(f"Job worker {worker_id}: heartbeat failed: {e}", file = sys.stderr)
+
+
+def _worker_loop(db_path, worker_id, stop, poll):
+    store = JobStore(db_path)
+    store.heartbeat(worker_id, os.getpid())
+    # heartbeats continue while a job runs in the main thread
+    beating = threading.Event()
+    threading.Thread(target = _heartbeats, args = (store, worker_id, beating, min(poll, HEARTBEAT_SECONDS)), daemon = True).start()
+    try:
+        while not stop.is_set():
+            try:
+                job = store.claim(worker_id, os.getpid())
+            except sqlite3.Error as e:
+                print(f"Job worker {worker_id}: claim failed: {e}", file = sys.stderr)
+                job = None
+            if job is None:
+                stop.wait(poll)
+            else:
+                run_job(store, job)
+    finally:
+        beating.set()
+        store.remove_worker(worker_id)
+
+
+class JobWorkerPool:
+    """
+    n_workers processes that run the queued jobs of a JobStore one at a time each.
+    A supervisor thread replaces workers that die, requeues (or fails) their jobs and those of workers of other pools
+    that stopped sending heartbeats, and deletes the results and progress of jobs finished over retention_hours ago.
+    The workers are not daemonic, so jobs may start processes of their own (training, multiprocessing pools).
+    stop() (also called at exit) lets idle workers leave and terminates the busy ones; their jobs are requeued by the
+    next pool.
+    """
+    def __init__(self, n_workers = 2, db_path = JOBS_DB, poll = 1.0, retention_hours = JOB_RETENTION_HOURS):
+        self.n_workers = n_workers
+        self.db_path   = db_path
+        self.poll      = poll
+        self.retention_hours = retention_hours
+        self.store      = JobStore(db_path)
+        self.stop_event = multiprocessing.Event()
+        self.processes  = {}  # worker id -> process
+        self.supervisor = None
+
+    def _spawn(self):
+        worker_id = uuid.uuid4().hex
+        process   = multiprocessing.Process(target = _worker_loop, args = (self.db_path, worker_id, self.stop_event, self.poll))
+        process.start()
+        self.processes[worker_id] = process
+
+    def start(self):
+        self.check()
+        self.purge(time.time() - 3600*self.retention_hours)
+        for _ in range(self.n_workers):
+            self._spawn()
+        self.supervisor = threading.Thread(target = self._supervise, daemon = True)
+        self.supervisor.start()
+        atexit.register(self.stop)
+        return self
+
+    def check(self):
+        """replace dead workers and requeue (or fail) orphaned jobs."""
+        dead = [worker_id for worker_id, process in self.processes.items() if not process.is_alive()]
+        for worker_id in dead:
+            print(f"Job worker {worker_id} exited with code {self.processes.pop(worker_id).exitcode}.", file = sys.stderr)
+        orphans = self.store.requeue_orphans(dead)
+        if orphans:
+            print(f"Jobs of stopped workers: {orphans}")
+        if not self.stop_event.is_set():
+            for _ in dead:
+                self._spawn()
+
+    def purge(self, before):
+        """delete the directories and progress of jobs finished before time `before`, and old uploads/resume files."""
+        for job_id in self.store.purge_finished(before):
+            shutil.rmtree(os.path.join(JOBS_DIR, job_id), ignore_errors = True)
+        # files of queued and running jobs are kept, however old (uploads are saved a moment before their job is queued)
+        pending = self.store.oldest_pending()
+        before  = before if pending is None else min(before, pending - 60)
+        for shared in ('uploads', 'weights'):
+            root = os.path.join(JOBS_DIR, shared)
+            for name in os.listdir(root) if os.path.isdir(root) else []:
+                path = os.path.join(root, name)
+                if _newest_mtime(path) < before:
+                    shutil.rmtree(path, ignore_errors = True)
+
+    def _supervise(self):
+        last_purge = time.time()
+        while not self.stop_event.wait(self.poll):
+            try:
+                self.check()
+                if time.time() - last_purge > PURGE_SECONDS:
+                    last_purge = time.time()
+                    self.purge(last_purge - 3600*self.retention_hours)
+            except (sqlite3.Error, OSError) as e:
+                print(f"Job supervisor: {e}", file = sys.stderr)
+
+    def stop(self, timeout = 5):
+        self.stop_event.set()
+        if self.supervisor is not None:
+            self.supervisor.join()
+        terminated = []
+        for worker_id, process in self.processes.items():
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+                terminated.append(worker_id)
+        self.processes = {}
+        if terminated:
+            self.store.requeue_orphans(terminated)
+
+
+if __name__ == '__main__':
+    # python jobs.py [n_workers]: job workers without the web server (run main.py with AYUMERNA_JOB_WORKERS=0)
+    pool = JobWorkerPool(n_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 2).start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
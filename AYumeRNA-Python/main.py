@@ -1,4 +1,8 @@
+import multiprocessing
+import os
 from flask import Flask
+from jobs import JobWorkerPool
+from routes.jobs import jobs_bp
 from routes.traceback import traceback_bp
 from routes.split_onehot import split_onehot_bp
 from routes.generate_weight import generate_weight_bp
@@ -22,7 +26,16 @@ app.register_blueprint(r2dt_bp)  # 注册新的 R2DT 蓝图
 app.register_blueprint(scape_bp)
 app.register_blueprint(charge_bp)
 app.register_blueprint(transcan_se_bp) 
+app.register_blueprint(jobs_bp)  # 任务状态与进度
+
+# 长任务 (/train, /generate_weight, /process_traceback, /sample, /scape/analyze) 在工作进程中运行.
+# 随应用创建启动, 因此 flask run 和 WSGI 服务器下也可用 (不在工作进程中重复启动).
+# AYUMERNA_JOB_WORKERS=0 时不启动, 由单独的 `python jobs.py <n_workers>` 运行任务 (例如 WSGI 服务器有多个进程时)
+n_job_workers = int(os.environ.get('AYUMERNA_JOB_WORKERS', 2))
+job_worker_pool = None
+if n_job_workers > 0 and multiprocessing.parent_process() is None:
+    job_worker_pool = JobWorkerPool(n_workers=n_job_workers).start()
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=2002)
+    app.run(host='0.0.0.0', port=2002, threaded=True)
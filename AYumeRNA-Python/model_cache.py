@@ -0,0 +1,82 @@
+"""
+in-process LRU cache of loaded artifacts (models in eval mode, compiled CMs) under a memory budget.
+
+Keys are built from artifact content hashes (see helpers.artifact_key), so a cached model is reused by any request
+for the same files, whatever their URLs. The cache lives in the process that loads the artifacts: with the job
+queue, every worker process of JobWorkerPool warms its own.
+"""
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+MODEL_CACHE_BYTES = int(os.environ.get('AYUMERNA_MODEL_CACHE_BYTES', 2 << 30))
+
+
+def estimate_nbytes(value):
+    """memory of a cached value: parameters and buffers of torch modules, the pickled size of anything else."""
+    if isinstance(value, (tuple, list)):
+        return sum(estimate_nbytes(v) for v in value)
+    if isinstance(value, torch.nn.Module):
+        return sum(t.numel()*t.element_size() for t in [*value.parameters(), *value.buffers()])
+    return len(pickle.dumps(value, protocol = pickle.HIGHEST_PROTOCOL))
+
+
+class ModelCache:
+    """
+    LRU cache of values built by `get(key, load)`. The least recently used values are evicted while the estimated
+    size of all values exceeds max_bytes; the newest value stays even if it alone exceeds the budget.
+    metrics() reports hits, misses, evictions and the time spent loading.
+    """
+    def __init__(self, max_bytes = MODEL_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries   = OrderedDict()  # key -> (value, nbytes)
+        self.nbytes    = 0
+        self.lock      = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+        self.load_seconds = 0.0
+
+    def get(self, key, load):
+        """the cached value of key, or load() (then cached) on a miss."""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+        start  = time.perf_counter()
+        value  = load()
+        nbytes = estimate_nbytes(value)
+        with self.lock:
+            self.load_seconds += time.perf_counter() - start
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted) = self.entries.popitem(last = False)
+                self.nbytes -= evicted
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "load_seconds": round(self.load_seconds, 3),
+            }
@@ -0,0 +1,98 @@
+import json
+import os
+import time
+from functools import lru_cache
+from flask import Blueprint, Response, request, jsonify, send_file
+from jobs import JobStore, DONE
+
+jobs_bp = Blueprint('jobs', __name__)
+
+# 同步请求最多等待的秒数, 之后返回 504 和任务 id
+JOB_WAIT_SECONDS = float(os.environ.get('AYUMERNA_JOB_WAIT_SECONDS', 6*3600))
+
+@lru_cache(maxsize=None)
+def job_store():
+    return JobStore()
+
+def wants_async(data=None):
+    """async: true in the JSON body, or async=1 in the query string or form."""
+    value = (data or {}).get('async', request.values.get('async', False))
+    return str(value).lower() in ('1', 'true', 'yes')
+
+def no_worker_response():
+    return jsonify({"error": "No job worker is running"}), 503
+
+def submit_and_respond(func, params, data=None, respond=None):
+    """
+    queue func(params, progress_messages, work_dir) and answer the request.
+    With async, return 202 and the job id at once. Otherwise wait for the job and return its result together with
+    progress_messages, as the endpoints did when they ran the work in the request, or respond(result) if given.
+    503 if no job worker is running, 504 (the job goes on) after JOB_WAIT_SECONDS.
+    """
+    if not job_store().live_workers():
+        return no_worker_response()
+    job_id = job_store().submit(func, params)
+    if wants_async(data):
+        return jsonify({"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}), 202
+    try:
+        job = job_store().wait(job_id, timeout=JOB_WAIT_SECONDS)
+    except TimeoutError as e:
+        return jsonify({"error": str(e), "job_id": job_id, "status_url": f"/jobs/{job_id}"}), 504
+    progress_messages = [message for _, _, _, message in job_store().progress(job_id, kinds=('message',))]
+    if job["status"] == 'failed':
+        return jsonify({"error": job["error"], "job_id": job_id, "progress_messages": progress_messages}), 500
+    if respond is not None:
+        return respond(job["result"])
+    return jsonify({**job["result"], "job_id": job_id, "progress_messages": progress_messages})
+
+def job_status(job):
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "queue_position": job["queue_position"],
+        "created": job["created"],
+        "started": job["started"],
+        "finished": job["finished"],
+        "result": job["result"],
+        "error": job["error"],
+    }
+
+@jobs_bp.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """status of a job and its progress messages after seq `after` (default: all)."""
+    job = job_store().get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job {job_id}"}), 404
+    progress = job_store().progress(job_id, int(request.args.get('after', 0)))
+    return jsonify({
+        **job_status(job),
+        "progress": [{"seq": seq, "time": t, "kind": kind, "message": message} for seq, t, kind, message in progress]
+    })
+
+@jobs_bp.route('/jobs/<job_id>/stream', methods=['GET'])
+def stream_job(job_id):
+    """server-sent events: one "progress" event per message, then a "status" event when the job is done."""
+    if job_store().get(job_id) is None:
+        return jsonify({"error": f"Unknown job {job_id}"}), 404
+    after = int(request.args.get('after', request.headers.get('Last-Event-ID', 0)))
+
+    def events(after):
+        while True:
+            job = job_store().get(job_id)
+            for seq, t, kind, message in job_store().progress(job_id, after):
+                after = seq
+                yield f"id: {seq}\nevent: progress\ndata: {json.dumps({'time': t, 'kind': kind, 'message': message})}\n\n"
+            if job["status"] in DONE:
+                yield f"event: status\ndata: {json.dumps(job_status(job))}\n\n"
+                return
+            time.sleep(1)
+
+    return Response(events(after), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@jobs_bp.route('/jobs/<job_id>/file', methods=['GET'])
+def get_job_file(job_id):
+    """the result file of a finished job that returns one (e.g. /scape/analyze)."""
+    job = job_store().get(job_id)
+    if job is None or job["status"] != 'succeeded' or not (job["result"] or {}).get('file'):
+        return jsonify({"error": f"No result file for job {job_id}"}), 404
+    return send_file(job["result"]["file"], as_attachment=True, download_name=os.path.basename(job["result"]["file"]))
@@ -1,83 +1,98 @@
 import os
 import tempfile
 from flask import Blueprint, request, jsonify
-from helpers import download_file_from_minio, upload_to_minio
-from scripts.sampling_from_gauss import sampling_CMVAE, helper_sampling_CMVAE  # 导入采样模块中的函数
+from helpers import artifact_key, download_file_from_minio, upload_to_minio
+from model_cache import ModelCache
+from routes.jobs import submit_and_respond
+from scripts.sampling_from_gauss import sampling_CMVAE, sampling_CMVAE_to_fasta  # 导入采样模块中的函数
 from util import load_config
 from models.CMVAE import CovarianceModelVAE
-from infernal_tools import CMReader
+from infernal_tools import CMReader, CompiledCM
 import torch
 
 sample_bp = Blueprint('sample', __name__)
 
+# 本进程中已加载的模型 (eval 模式) 与编译后的 CM, 以文件内容哈希为键
+sample_cache = ModelCache()
+
 @sample_bp.route('/sample', methods=['POST'])
 def handle_sample():
-    try:
-        # 获取请求的 JSON 数据
-        data = request.get_json()
-        print(f"Received data: {data}")
-
-        # 从 JSON 中获取参数
-        config_url = data.get('config_url')
-        ckpt_url = data.get('ckpt_url')
-        cmfile_url = data.get('cmfile_url')
-        n_samples = int(data.get('n_samples') or data.get('nSamples') or data.get('NSamples') or 100)
-        user_id = str(data.get('user_id', 'unknown_user'))
-        progress_messages = []
-
-        # 检查必要的参数
-        if not config_url or not ckpt_url or not cmfile_url:
-            return jsonify({"error": "Missing required URL parameter(s)"}), 400
-
-        # 使用固定目录，避免临时目录被删除导致文件丢失
-        data_dir_path = os.path.join(os.getcwd(), 'data')
-        os.makedirs(data_dir_path, exist_ok=True)
-
-        # 下载 config、ckpt、cmfile 文件
-        config_path = os.path.join(data_dir_path, 'config.yaml')
-        ckpt_path = os.path.join(data_dir_path, 'model.pt')
-        cmfile_path = os.path.join(data_dir_path, 'model.cm')
-
-        download_file_from_minio(config_url, config_path)
-        progress_messages.append(f"Downloaded config to {config_path}")
-        download_file_from_minio(ckpt_url, ckpt_path)
-        progress_messages.append(f"Downloaded checkpoint to {ckpt_path}")
-        download_file_from_minio(cmfile_url, cmfile_path)
-        progress_messages.append(f"Downloaded CM file to {cmfile_path}")
+    # 获取请求的 JSON 数据
+    data = request.get_json()
+    print(f"Received data: {data}")
+
+    # 检查必要的参数
+    if not data.get('config_url') or not data.get('ckpt_url') or not data.get('cmfile_url'):
+        return jsonify({"error": "Missing required URL parameter(s)"}), 400
+
+    # 在任务队列中采样
+    return submit_and_respond(run_sample, data, data)
+
+def run_sample(data, progress_messages, work_dir):
+    """job of /sample, in the job directory work_dir (see jobs.py)."""
+    # 从 JSON 中获取参数
+    config_url = data.get('config_url')
+    ckpt_url = data.get('ckpt_url')
+    cmfile_url = data.get('cmfile_url')
+    n_samples = int(data.get('n_samples') or data.get('nSamples') or data.get('NSamples') or 100)
+    user_id = str(data.get('user_id', 'unknown_user'))
+    cpu = int(data.get('cpu', 4))
+    n_unique = data.get('n_unique')
+    n_unique = int(n_unique) if n_unique else None
 
+    # 使用任务目录
+    data_dir_path = work_dir
+
+    # config、ckpt、cmfile 文件的内容键 (ETag 或 SHA-256)
+    config_path = os.path.join(data_dir_path, 'config.yaml')
+    ckpt_path = os.path.join(data_dir_path, 'model.pt')
+    cmfile_path = os.path.join(data_dir_path, 'model.cm')
+    artifacts = {name: (url, path, *artifact_key(url, path)) for name, url, path in [
+        ('config', config_url, config_path), ('checkpoint', ckpt_url, ckpt_path), ('CM file', cmfile_url, cmfile_path)
+    ]}
+
+    def fetch(name):
+        # 未命中缓存时才下载
+        url, path, _, downloaded = artifacts[name]
+        if not downloaded:
+            download_file_from_minio(url, path)
+        progress_messages.append(f"Downloaded {name} to {path}")
+
+    def load_model():
         # 加载配置和模型
+        fetch('config')
+        fetch('checkpoint')
         cfg = load_config(config_path)
         model = CovarianceModelVAE.build_from_config(config_path)
         model.load_model_from_ckpt(ckpt_path)
         model.to(model.device)
+        return cfg, model
 
-        # 加载 CM 文件并生成派生字典
+    def load_cm():
+        # 加载 CM 文件, 生成派生字典并编译
+        fetch('CM file')
         cmreader = CMReader(cmfile_path)
         progress_messages.append("Loading cm derivation dictionary.")
-        cm_deriv_dict = cmreader.load_derivation_dict_from_cmfile()
-
-        # 生成序列样本
-        seq_sampled = sampling_CMVAE(model, cm_deriv_dict, cfg["Z_DIM"], n_samples)
-        sampled_fasta_path = os.path.join(data_dir_path, 'sampled_sequences.fa')
+        return CompiledCM(cmreader.load_derivation_dict_from_cmfile())
 
-        # 将序列写入到 Fasta 文件
-        with open(sampled_fasta_path, "w") as f:
-            for i, seq in enumerate(set(seq_sampled)):
-                f.write(f">seq{str(i)}\n")
-                f.write(f"{str(seq)}\n")
-        progress_messages.append(f"Saved sampled sequences to {sampled_fasta_path}")
+    cfg, model = sample_cache.get(('model', artifacts['config'][2], artifacts['checkpoint'][2]), load_model)
+    compiled_cm = sample_cache.get(('cm', artifacts['CM file'][2]), load_cm)
+    cache_metrics = sample_cache.metrics()
+    progress_messages.append(f"Model cache: {cache_metrics}")
 
-        # 上传 Fasta 文件到 MinIO
-        output_url = upload_to_minio(sampled_fasta_path, user_id, file_type='fasta', progress_messages=progress_messages)
+    # 生成序列样本, 去重后逐条写入 Fasta 文件
+    sampled_fasta_path = os.path.join(data_dir_path, 'sampled_sequences.fa')
+    n_written = sampling_CMVAE_to_fasta(
+        model, None, cfg["Z_DIM"], sampled_fasta_path,
+        n_samples=n_samples, n_unique=n_unique, cpu=cpu, progress_messages=progress_messages, compiled_cm=compiled_cm
+    )
+    progress_messages.append(f"Saved {n_written} sampled sequences to {sampled_fasta_path}")
 
-        # 替换返回的 URL
-        adjusted_url = output_url.replace("http://127.0.0.1:9000", "https://minio.lumoxuan.cn")
+    # 上传 Fasta 文件到 MinIO
+    output_url = upload_to_minio(sampled_fasta_path, user_id, file_type='fasta', progress_messages=progress_messages)
 
-        # 返回结果
-        return jsonify({"output_file": adjusted_url, "progress_messages": progress_messages})
+    # 替换返回的 URL
+    adjusted_url = output_url.replace("http://127.0.0.1:9000", "https://minio.lumoxuan.cn")
 
-    except Exception as e:
-        print(f"Error in handle_sample: {str(e)}")
-        for message in progress_messages:
-            print(message)
-        return jsonify({"error": str(e), "progress_messages": progress_messages}), 500
\ No newline at end of file
+    # 返回结果
+    return {"output_file": adjusted_url, "cache": cache_metrics}
@@ -3,7 +3,11 @@ import tempfile
 from flask import Blueprint, request, jsonify
 from helpers import download_file_from_minio, upload_to_minio
 import h5py
+import numpy as np
 from sklearn.model_selection import train_test_split
+import sys
+sys.path.append('./src')
+from trsp_h5 import write_trsp_rows
 
 # 创建 Blueprint
 split_onehot_bp = Blueprint('split_onehot', __name__)
@@ -63,16 +67,9 @@ def split_onehot_cm(path_to_cmonehot, train_ratio=0.7, suffix="", random_state=4
     train/valid/test splitter for datasets of CM-VAE.
     """
     h5 = h5py.File(path_to_cmonehot, "r")
-    ids = h5["id"][:]
-    tr = h5["tr"][:]
-    s = h5["s"][:]
-    p = h5["p"][:]
-    h5.close()
-
-    id_train, id_vt, tr_train, tr_vt, s_train, s_vt, p_train, p_vt = train_test_split(
-        ids, tr, s, p, test_size=1-train_ratio, random_state=random_state)
-    id_valid, id_test, tr_valid, tr_test, s_valid, s_test, p_valid, p_test = train_test_split(
-        id_vt, tr_vt, s_vt, p_vt, test_size=0.5, random_state=random_state)
+    index = np.arange(len(h5["id"]))
+    index_train, index_vt = train_test_split(index, test_size=1-train_ratio, random_state=random_state)
+    index_valid, index_test = train_test_split(index_vt, test_size=0.5, random_state=random_state)
 
     # 临时文件路径
     temp_dir = tempfile.gettempdir()
@@ -80,22 +77,9 @@ def split_onehot_cm(path_to_cmonehot, train_ratio=0.7, suffix="", random_state=4
     valid_file = os.path.join(temp_dir, "valid.h5")
     test_file = os.path.join(temp_dir, "test.h5")
 
-    with h5py.File(train_file, "w") as h5f:
-        h5f.create_dataset("id", data=id_train)
-        h5f.create_dataset("tr", data=tr_train)
-        h5f.create_dataset("s", data=s_train)
-        h5f.create_dataset("p", data=p_train)
-
-    with h5py.File(valid_file, "w") as h5f:
-        h5f.create_dataset("id", data=id_valid)
-        h5f.create_dataset("tr", data=tr_valid)
-        h5f.create_dataset("s", data=s_valid)
-        h5f.create_dataset("p", data=p_valid)
-
-    with h5py.File(test_file, "w") as h5f:
-        h5f.create_dataset("id", data=id_test)
-        h5f.create_dataset("tr", data=tr_test)
-        h5f.create_dataset("s", data=s_test)
-        h5f.create_dataset("p", data=p_test)
+    # 保持输入文件的格式 (legacy / compact)
+    with h5py.File(train_file, "w") as h5_train, h5py.File(valid_file, "w") as h5_valid, h5py.File(test_file, "w") as h5_test:
+        write_trsp_rows(h5, [(h5_train, index_train), (h5_valid, index_valid), (h5_test, index_test)])
+    h5.close()
 
     return train_file, valid_file, test_file
@@ -0,0 +1,227 @@
+# benchmarks for the covariance model tools in src/infernal_tools.py.
+# CM files are synthesized (see cm_fixtures.py) so that the benchmark runs without Rfam data.
+
+import sys
+sys.path.append("./src")
+sys.path.append(".")
+import os
+import time
+import tempfile
+import numpy as np
+from cm_fixtures import write_synthetic_cmfile, write_synthetic_tfile, load_derivation_dict_legacy, load_aligned_tbdicts_legacy, cmeval_legacy
+
+def bench_parse(sizes, legacy_max_states, repeat):
+    from infernal_tools import CMReader
+
+    print(f"{'states':>8s} {'legacy[s]':>12s} {'single-pass[s]':>15s} {'speedup':>9s}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_consensus in sizes:
+            path = write_synthetic_cmfile(os.path.join(tmp, f"synthetic{n_consensus}.cm"), n_consensus = n_consensus)
+
+            t_new = []
+            for _ in range(repeat):
+                start = time.time()
+                deriv_dict = CMReader(path).load_derivation_dict_from_cmfile()
+                t_new.append(time.time() - start)
+            n_states = sum(len(v) for v in deriv_dict.values())
+
+            if n_states <= legacy_max_states:
+                cmreader = CMReader(path)
+                start    = time.time()
+                legacy   = load_derivation_dict_legacy(cmreader)
+                t_old    = time.time() - start
+                assert legacy == deriv_dict, "single-pass parser differs from the legacy parser."
+                print(f"{n_states:8d} {t_old:12.4f} {min(t_new):15.4f} {t_old/min(t_new):8.1f}x")
+            else:
+                print(f"{n_states:8d} {'skipped':>12s} {min(t_new):15.4f} {'-':>9s}")
+
+def bench_convert(sizes, repeat):
+    """
+    deriv_dict -> tr/s/p -> deriv_dict, through the dict path and the CompiledCM path.
+    """
+    import torch
+    from infernal_tools import CMReader, CompiledCM, make_trsp_from_deriv_dict, make_deriv_dict_from_trsp
+
+    print(f"{'states':>8s} {'dict[s]':>10s} {'compiled[s]':>12s} {'speedup':>9s}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_consensus in sizes:
+            path       = write_synthetic_cmfile(os.path.join(tmp, f"synthetic{n_consensus}.cm"), n_consensus = n_consensus)
+            deriv_dict = CMReader(path).load_derivation_dict_from_cmfile()
+            compiled   = CompiledCM(deriv_dict)
+            n_states   = compiled.n_states
+
+            def run(compiled_cm):
+                tr, s, p = make_trsp_from_deriv_dict(path, deriv_dict, compiled_cm)
+                trsp     = [torch.rand(1, x.shape[1], x.shape[0]) for x in (tr, s, p)]
+                return make_deriv_dict_from_trsp(deriv_dict, trsp, compiled_cm)
+
+            times = []
+            for compiled_cm in [None, compiled]:
+                t = []
+                for _ in range(repeat):
+                    start = time.time()
+                    run(compiled_cm)
+                    t.append(time.time() - start)
+                times.append(min(t))
+            print(f"{n_states:8d} {times[0]:10.4f} {times[1]:12.4f} {times[0]/times[1]:8.1f}x")
+
+def bench_batch_convert(sizes, n_seqs):
+    """
+    n_seqs decoder outputs -> CMs, one by one through make_deriv_dict_from_trsp vs in a single batch.
+    """
+    import torch
+    from infernal_tools import CMReader, CompiledCM, CovarianceModel, make_trsp_from_deriv_dict, make_deriv_dict_from_trsp, make_cms_from_trsp
+
+    print(f"{'states':>8s} {'n':>6s} {'one-by-one[s]':>14s} {'batch[s]':>10s} {'speedup':>9s}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_consensus in sizes:
+            path       = write_synthetic_cmfile(os.path.join(tmp, f"synthetic{n_consensus}.cm"), n_consensus = n_consensus)
+            deriv_dict = CMReader(path).load_derivation_dict_from_cmfile()
+            compiled   = CompiledCM(deriv_dict)
+            trsp       = [torch.rand(n_seqs, x.shape[1], x.shape[0]) for x in make_trsp_from_deriv_dict(path, deriv_dict, compiled)]
+
+            start = time.time()
+            for b in range(n_seqs):
+                CovarianceModel(make_deriv_dict_from_trsp(deriv_dict, [x[b:b+1] for x in trsp]))
+            t_old = time.time() - start
+
+            start = time.time()
+            make_cms_from_trsp(compiled, trsp)
+            t_new = time.time() - start
+            print(f"{compiled.n_states:8d} {n_seqs:6d} {t_old:14.4f} {t_new:10.4f} {t_old/t_new:8.1f}x")
+
+def bench_emit(sizes, n_seqs, repeat):
+    """
+    sampling n_seqs sequences one by one vs in a single batch.
+    """
+    from infernal_tools import CMReader, CovarianceModel
+
+    print(f"{'states':>8s} {'n':>6s} {'one-by-one[s]':>14s} {'batch[s]':>10s} {'speedup':>9s}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_consensus in sizes:
+            path = write_synthetic_cmfile(os.path.join(tmp, f"synthetic{n_consensus}.cm"), n_consensus = n_consensus)
+            cm   = CovarianceModel(CMReader(path).load_derivation_dict_from_cmfile())
+            times = []
+            for batch in [False, True]:
+                t = []
+                for r in range(repeat):
+                    start = time.time()
+                    if batch:
+                        cm.cmemit(n_seqs, sample = True, rng = r)
+                    else:
+                        rng = np.random.default_rng(r)
+                        [cm.cmemit(1, sample = True, rng = rng) for _ in range(n_seqs)]
+                    t.append(time.time() - start)
+                times.append(min(t))
+            print(f"{cm.compiled.n_states:8d} {n_seqs:6d} {times[0]:14.4f} {times[1]:10.4f} {times[0]/times[1]:8.1f}x")
+
+def bench_eval(sizes, lengths, legacy_max_length, tau, repeat):
+    """
+    inside scores of sampled sequences cut to the given lengths, without and with QDB bands.
+    The legacy probability-space version is run only for short sequences.
+    """
+    from infernal_tools import CMReader, CovarianceModel
+
+    print(f"{'states':>8s} {'L':>5s} {'legacy[s]':>10s} {'log-space[s]':>13s} {'banded[s]':>10s} {'loglik':>10s} {'banded':>10s} {'dropped':>9s}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_consensus in sizes:
+            path = write_synthetic_cmfile(os.path.join(tmp, f"synthetic{n_consensus}.cm"), n_consensus = n_consensus)
+            deriv_dict = CMReader(path).load_derivation_dict_from_cmfile()
+            cm   = CovarianceModel(deriv_dict)
+            seq  = "".join(seq for seq, _ in cm.cmemit(20, sample = True, rng = 0))
+            for L in lengths:
+                times, scores = [], []
+                for band_tau in [None, tau]:
+                    t = []
+                    for _ in range(repeat):
+                        start = time.time()
+                        loglik = cm.cmeval(seq[:L], tau = band_tau)
+                        t.append(time.time() - start)
+                    times.append(min(t))
+                    scores.append(loglik)
+                dropped = cm.compute_bands(L, tau)["dropped_mass"][0]
+                if L <= legacy_max_length:
+                    start = time.time()
+                    cmeval_legacy(deriv_dict, seq[:L])
+                    t_old = f"{time.time() - start:10.4f}"
+                else:
+                    t_old = f"{'skipped':>10s}"
+                print(f"{cm.compiled.n_states:8d} {L:5d} {t_old} {times[0]:13.4f} {times[1]:10.4f} {scores[0]:10.2f} {scores[1]:10.2f} {dropped:9.2e}")
+def bench_score(sizes, n_seqs, tau, cpu):
+    """
+    scoring sampled sequences one by one with cmeval vs score_many.
+    """
+    from infernal_tools import CMReader, CovarianceModel
+
+    print(f"{'states':>8s} {'n':>6s} {'cmeval[s]':>10s} {'score_many[s]':>14s} {'cpu':>4s} {'speedup':>9s}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_consensus in sizes:
+            path = write_synthetic_cmfile(os.path.join(tmp, f"synthetic{n_consensus}.cm"), n_consensus = n_consensus)
+            cm   = CovarianceModel(CMReader(path).load_derivation_dict_from_cmfile())
+            seqs = [seq for seq, _ in cm.cmemit(n_seqs, sample = True, rng = 0)]
+
+            start = time.time()
+            [cm.cmeval(seq, tau = tau) for seq in seqs]
+            t_one = time.time() - start
+
+            cm    = CovarianceModel(CMReader(path).load_derivation_dict_from_cmfile())
+            start = time.time()
+            cm.score_many(seqs, tau = tau, cpu = cpu)
+            t_many = time.time() - start
+            print(f"{cm.compiled.n_states:8d} {n_seqs:6d} {t_one:10.4f} {t_many:14.4f} {cpu:4d} {t_one/t_many:8.1f}x")
+
+def bench_traceback(sizes, n_seqs):
+    """
+    traceback file -> aligned tbdicts, with the DataFrame parser and with the streaming parser.
+    """
+    from infernal_tools import CMReader, CovarianceModel, TracebackFileReader
+
+    print(f"{'states':>8s} {'n':>6s} {'DataFrame[s]':>13s} {'streaming[s]':>13s} {'speedup':>9s}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_consensus in sizes:
+            path = write_synthetic_cmfile(os.path.join(tmp, f"synthetic{n_consensus}.cm"), n_consensus = n_consensus)
+            cm   = CovarianceModel(CMReader(path).load_derivation_dict_from_cmfile())
+            seqs = [seq for seq, _ in cm.cmemit(n_seqs, sample = True, rng = 0)]
+            tb_file = write_synthetic_tfile(os.path.join(tmp, "traceback.txt.gz"), cm, seqs, local_rng = np.random.default_rng(0))
+
+            start  = time.time()
+            legacy = load_aligned_tbdicts_legacy(path, tb_file)
+            t_old  = time.time() - start
+
+            start  = time.time()
+            reader = TracebackFileReader(path, tb_file)
+            new    = [reader.make_aligned_tbdict_from_tbdf_ELinitCM(tb) for tb in reader.iter_tracebacks()]
+            t_new  = time.time() - start
+            assert new == legacy, "streaming parser differs from the DataFrame parser."
+            print(f"{cm.compiled.n_states:8d} {n_seqs:6d} {t_old:13.4f} {t_new:13.4f} {t_old/t_new:8.1f}x")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--target', default = "parse", choices = ["parse", "convert", "batch_convert", "emit", "eval", "score", "traceback"])
+    parser.add_argument('--sizes', default = [70, 200, 700], type = int, nargs = "+", help = "number of consensus nodes of synthetic CMs.")
+    parser.add_argument('--legacy_max_states', default = 1000, type = int, help = "skip the quadratic legacy parser above this size.")
+    parser.add_argument('--n_seqs', default = 1000, type = int, help = "number of sequences for --target emit, score, traceback and batch_convert.")
+    parser.add_argument('--lengths', default = [10, 40, 76], type = int, nargs = "+", help = "sequence lengths for --target eval.")
+    parser.add_argument('--legacy_max_length', default = 10, type = int, help = "skip the probability-space inside above this length.")
+    parser.add_argument('--tau', default = 1e-7, type = float, help = "tail mass dropped by the QDB bands for --target eval.")
+    parser.add_argument('--cpu', default = 1, type = int, help = "processes for --target score.")
+    parser.add_argument('--repeat', default = 3, type = int)
+    args = parser.parse_args()
+
+    if args.target == "parse":
+        bench_parse(args.sizes, args.legacy_max_states, args.repeat)
+    elif args.target == "convert":
+        bench_convert(args.sizes, args.repeat)
+    elif args.target == "batch_convert":
+        bench_batch_convert(args.sizes, args.n_seqs)
+    elif args.target == "emit":
+        bench_emit(args.sizes, args.n_seqs, args.repeat)
+    elif args.target == "eval":
+        bench_eval(args.sizes, args.lengths, args.legacy_max_length, args.tau, args.repeat)
+    elif args.target == "score":
+        bench_score(args.sizes, args.n_seqs, args.tau, args.cpu)
+    elif args.target == "traceback":
+        bench_traceback(args.sizes, args.n_seqs)
@@ -1,9 +1,12 @@
+import sys
+sys.path.append("./src")
 import h5py
+import hashlib
 import numpy as np
 import time 
-import random
-random.seed(42)
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from trsp_h5 import read_trsp
 
 # compute abs distance among dataset
 def load_data_cm(path):
@@ -11,9 +14,9 @@ def load_data_cm(path):
     (N_SAMPLES, N_RULES, LENGTH)
     """
     data = h5py.File(path, "r")
-    tr = np.nan_to_num(data["tr"][:], copy = False).transpose(0, -1, -2)
-    s = data["s"][:].transpose(0, -1, -2)
-    p = data["p"][:].transpose(0, -1, -2)
+    tr = read_trsp(data, "tr", fill = 0).transpose(0, -1, -2)
+    s = read_trsp(data, "s", fill = 0).transpose(0, -1, -2)
+    p = read_trsp(data, "p", fill = 0).transpose(0, -1, -2)
     return tr, s, p
 
 # compute abs distance among dataset
@@ -34,83 +37,287 @@ def calc_distance_cg(xi, xj):
     distance = np.abs(xi - xj).sum()
     return distance
 
-def compute_and_write_weight(X_fname, threshold, outfile, mode = "cm", sampling_threshold = 10000, sample_ratio_over_threshold = 0.05, cpu = 4, print_every = 500):
-    assert args.mode in {"cm", "c", "g"}, "Select mode from c/g/cm"
+def flatten_onehot(arrays):
+    """
+    list of (N_SAMPLES, ...) arrays -> (N_SAMPLES, D) float32 matrix. The L1 distance between rows
+    is the sum of the distances of calc_distance_cm/calc_distance_cg.
+    """
+    return np.concatenate([np.asarray(x, dtype = np.float32).reshape(len(x), -1) for x in arrays], axis = 1)
+
+def _block_size(X, block_size, budget = 1 << 25):
+    """
+    rows per block so that a (block, block, D) difference tensor stays around budget bytes.
+    """
+    if block_size is not None:
+        return block_size
+    return max(1, min(len(X), int((budget/(4*max(X.shape[1], 1)))**0.5)))
+
+def _count_block(X, radius, rows, binary, block):
+    """
+    number of rows j of X with L1(X[i], X[j]) < radius for each i in rows (j = i included).
+    """
+    x_i    = X[rows]
+    counts = np.zeros(len(x_i), dtype = np.int64)
+    if binary:
+        # for 0/1 data, |x-y|_1 = |x| + |y| - 2 x.y. Integer valued, so exact in float32 below 2^24.
+        norm_i = x_i.sum(axis = 1)
+    else:
+        # blocks of about 4MB of X, reused for every row of x_i.
+        block = max(1, (1 << 22)//(4*max(X.shape[1], 1)))
+    for start in range(0, len(X), block):
+        x_j = X[start:start+block]
+        if binary:
+            distance = norm_i[:, None] + x_j.sum(axis = 1)[None, :] - 2*(x_i @ x_j.T)
+        else:
+            buf      = np.empty_like(x_j)
+            distance = np.empty((len(x_i), len(x_j)))
+            for k, x in enumerate(x_i):
+                np.subtract(x_j, x, out = buf)
+                np.abs(buf, out = buf)
+                np.add.reduce(buf, axis = 1, dtype = np.float64, out = distance[k])
+        counts += (distance < radius).sum(axis = 1)
+    return counts
+
+def count_neighbors(X, radius, rows = None, block_size = None, cpu = 1):
+    """
+    number of neighbors (L1 distance < radius, excluding itself) of each row of X, computed in blocks of rows.
+    X   : (N_SAMPLES, D) float32, see `flatten_onehot`.
+    rows: indices of the rows to compute. Default: all rows.
+    cpu : threads over row blocks. NumPy releases the GIL, so the blocks run in parallel.
+    """
+    rows   = np.arange(len(X)) if rows is None else np.asarray(rows)
+    binary = bool(np.isin(X, (0, 1)).all())
+    block  = _block_size(X, block_size)
+    blocks = [rows[start:start+block] for start in range(0, len(rows), block)]
+    if cpu > 1:
+        with ThreadPool(cpu) as p:
+            counts = p.starmap(_count_block, [(X, radius, r, binary, block) for r in blocks])
+    else:
+        counts = [_count_block(X, radius, r, binary, block) for r in blocks]
+    counts = np.concatenate(counts) if counts else np.zeros(0, dtype = np.int64)
+    return counts - (0 < radius) # the distance to itself is 0
+
+def count_neighbors_sampled(X, radius, n_samples, rows = None, seed = 42):
+    """
+    number of neighbors of each row of X among n_samples - 1 other rows drawn at random for that row.
+    The draw of row i depends only on (seed, i), so the counts do not depend on which rows are computed together.
+    """
+    Ntotal = len(X)
+    rows   = np.arange(Ntotal) if rows is None else np.asarray(rows)
+    counts = np.zeros(len(rows), dtype = np.int64)
+    for k, i in enumerate(rows):
+        sampled_index = np.random.default_rng([seed, i]).choice(Ntotal - 1, size = int(n_samples - 1), replace = False)
+        sampled_index += sampled_index >= i # skip i itself
+        distance  = np.abs(X[sampled_index] - X[i]).sum(axis = 1, dtype = np.float64)
+        counts[k] = (distance < radius).sum()
+    return counts
+
+def weight_fingerprint(X, chunk_size = 4096, **params):
+    """
+    fingerprint of the inputs of a weight job: sha256 of the shape, the parameters and all rows of X.
+    """
+    h = hashlib.sha256(repr((X.shape, str(X.dtype), sorted(params.items()))).encode())
+    for start in range(0, len(X), chunk_size):
+        h.update(np.ascontiguousarray(X[start:start+chunk_size]).tobytes())
+    return h.hexdigest()
+
+def write_weight_resumable(outfile, Ntotal, count_rows, fingerprint, rows_per_block = 4096, print_every = 1):
+    """
+    writes weight = 1/(1 + count_rows(rows)) to the "weight" dataset of outfile, rows_per_block rows at a time.
+    Each finished block is flushed and marked in the "done" bitmap, so a rerun with the same fingerprint
+    skips the finished blocks. A file with another fingerprint is overwritten.
+    returns the weights.
+    """
+    n_blocks = -(-Ntotal//rows_per_block)
+    with h5py.File(outfile, "a") as f:
+        if f.attrs.get("fingerprint") != fingerprint or f.attrs.get("rows_per_block") != rows_per_block:
+            for key in list(f.keys()):
+                del f[key]
+            f.attrs["fingerprint"], f.attrs["rows_per_block"] = fingerprint, rows_per_block
+            f.create_dataset('weight', (Ntotal, ), dtype = np.float32)
+            f.create_dataset('done', (n_blocks, ), dtype = bool)
+        todo = np.flatnonzero(~f["done"][:])
+        if len(todo) < n_blocks:
+            print(f"Resuming: {str(n_blocks - len(todo))}/{str(n_blocks)} blocks already done.")
+        start = time.time()
+        for n, b in enumerate(todo):
+            rows = np.arange(b*rows_per_block, min(Ntotal, (b+1)*rows_per_block))
+            f["weight"][rows[0]:rows[-1]+1] = 1/(1 + count_rows(rows))
+            f["done"][b] = True
+            f.flush()
+            if (n + 1)%print_every == 0:
+                finish = time.time()
+                print(f"{str(b+1)}/{str(n_blocks)} blocks\t, estimated remaining time:", (len(todo) - n - 1)*(finish - start)/(n + 1), "sec.")
+        weight = f["weight"][:]
+    return weight
+
+# number of set bits of each uint8. np.bitwise_count is only in numpy >= 2.0.
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype = np.uint8)
+
+def _popcount(x):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    return _POPCOUNT8[x]
+
+def _hamming_pairs(P, a, b, chunk = 1 << 16):
+    """
+    Hamming distances between rows a[k] and b[k] of the bit-packed matrix P.
+    """
+    distance = np.empty(len(a), dtype = np.int64)
+    for start in range(0, len(a), chunk):
+        x = np.bitwise_xor(P[a[start:start+chunk]], P[b[start:start+chunk]])
+        distance[start:start+chunk] = _popcount(x).sum(axis = 1, dtype = np.int64)
+    return distance
+
+def _bucket_pairs(keys, max_bucket = None, rng = None):
+    """
+    pairs (i, j) of rows with the same key.
+    max_bucket: buckets of more rows are split into parts of max_bucket rows, in a random order drawn from rng, so that
+                a bucket of m rows gives at most about m*max_bucket/2 pairs instead of m**2/2.
+    """
+    n = len(keys)
+    if n == 0:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+    order  = np.argsort(keys, kind = "stable") if rng is None else np.lexsort((rng.permutation(n), keys))
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]]))
+    if max_bucket is not None:
+        bucket_start = np.repeat(starts, np.diff(np.append(starts, n)))
+        starts = np.flatnonzero((np.arange(n) - bucket_start)%max_bucket == 0)
+    # number of following rows in the same bucket (part)
+    ends      = np.repeat(np.append(starts[1:], n), np.diff(np.append(starts, n)))
+    remaining = ends - np.arange(n) - 1
+    a, b = [], []
+    position  = np.flatnonzero(remaining > 0)
+    offset    = 1
+    while len(position) > 0:
+        a.append(order[position])
+        b.append(order[position + offset])
+        offset  += 1
+        position = position[remaining[position] >= offset]
+    if len(a) == 0:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+    return np.concatenate(a), np.concatenate(b)
+
+def count_neighbors_lsh(X, radius, n_tables = 20, bits_per_table = None, max_bucket = 512, seed = 0):
+    """
+    approximate `count_neighbors` for 0/1 data, where the L1 distance is the Hamming distance.
+    Identical rows are merged first. The rows are bit-packed and hashed into buckets by n_tables random subsets of
+    bits_per_table varying bits (bit-sampling LSH). Only pairs sharing a bucket are compared, with an exact popcount
+    distance, so neighbors can be missed but never added.
+    bits_per_table: default gives a pair at distance radius a 1/2 chance to collide in each table.
+    max_bucket: larger buckets are split at random into parts of max_bucket rows (see `_bucket_pairs`), which bounds
+                the candidates of dense families to about n_unique*max_bucket/2 per table. Rows of such a family
+                meet different parts of it in each table, but their counts are underestimated more.
+    """
+    if not np.isin(X, (0, 1)).all():
+        raise ValueError("LSH weighting needs 0/1 data")
+    rng    = np.random.default_rng(seed)
+    packed = np.packbits(X.astype(bool), axis = 1)
+    _, first, inverse, multiplicity = np.unique(
+        packed.view(f"V{packed.shape[1]}").reshape(-1), return_index = True, return_inverse = True, return_counts = True
+        )
+    packed  = packed[first]
+    unique  = np.unpackbits(packed, axis = 1, count = X.shape[1]).astype(bool)
+    varying = np.flatnonzero(unique.any(axis = 0) & ~unique.all(axis = 0))
+
+    # pairs of distinct rows colliding in any table
+    if bits_per_table is None:
+        if len(varying) == 0 or radius <= 1 or radius >= len(varying):
+            bits_per_table = 1
+        else:
+            bits_per_table = max(1, int(np.log(0.5)/np.log(1 - radius/len(varying))))
+    # candidate pairs as sorted unique keys i*n_unique + j (i < j), deduplicated after each table
+    keys = np.zeros(0, dtype = np.int64)
+    # Hamming distances are integers, so below radius 1 only identical rows are neighbors.
+    for _ in range(n_tables if len(varying) > 0 and radius > 1 else 0):
+        bits = rng.choice(varying, size = min(bits_per_table, len(varying)), replace = False)
+        # 64-bit hash of the sampled bits. Colliding hashes only add candidates.
+        hash_weight = rng.integers(0, np.iinfo(np.int64).max, size = len(bits), dtype = np.int64).astype(np.uint64)
+        a, b = _bucket_pairs(unique[:, bits].astype(np.uint64) @ hash_weight, max_bucket, rng)
+        keys = np.union1d(keys, np.minimum(a, b)*len(unique) + np.maximum(a, b))
+        del a, b
+    a, b = keys//len(unique), keys%len(unique)
+
+    near   = _hamming_pairs(packed, a, b) < radius
+    counts = np.zeros(len(unique), dtype = np.int64)
+    np.add.at(counts, a[near], multiplicity[b[near]])
+    np.add.at(counts, b[near], multiplicity[a[near]])
+    if 0 < radius:
+        counts += multiplicity - 1 # identical rows
+    return counts[inverse]
+
+def estimate_weight_error(X, radius, counts, n_check = 200, seed = 0, cpu = 1):
+    """
+    compares approximate neighbor counts with exact ones on n_check random rows.
+    returns (mean absolute error, max absolute error, relative error of the sum) of the weights 1/(1+counts).
+    """
+    rng      = np.random.default_rng(seed)
+    rows     = rng.choice(len(X), size = min(n_check, len(X)), replace = False)
+    exact    = 1/(1 + count_neighbors(X, radius, rows = rows, cpu = cpu))
+    approx   = 1/(1 + counts[rows])
+    error    = np.abs(approx - exact)
+    return float(error.mean()), float(error.max()), float(abs(approx.sum() - exact.sum())/exact.sum())
+
+def compute_and_write_weight(X_fname, threshold, outfile, mode = "cm", sampling_threshold = 10000, sample_ratio_over_threshold = 0.05, cpu = 4, print_every = 1, block_size = None,
+                             approx = False, n_check = 200, rows_per_block = 4096):
+    """
+    weight of each sequence = 1/(1 + number of neighbors), where neighbors are within L1 distance N_COLUMNS*threshold.
+    Over sampling_threshold sequences, the neighbors are counted among a random subset (sample_ratio_over_threshold) per sequence.
+    approx : count the neighbors of all sequences with `count_neighbors_lsh` instead (0/1 data only).
+             The error estimated on n_check sequences is printed and stored in the attributes of the weight dataset.
+    rows_per_block: rows per checkpoint. Rerunning with the same inputs resumes from the finished blocks (see `write_weight_resumable`).
+    print_every: blocks between progress messages.
+    """
+    assert mode in {"cm", "c", "g"}, "Select mode from c/g/cm"
     
     if mode == "cm":
         tr_train, s_train, p_train = load_data_cm(X_fname)
         N_COLLUMNS = tr_train.shape[-1] + s_train.shape[-1] + p_train.shape[-1]
-        Ntotal      = tr_train.shape[0]
-        if Ntotal < sampling_threshold: 
-            n_samples = Ntotal
-        else:
-            n_samples = int(Ntotal*sample_ratio_over_threshold)
-            
+        X = flatten_onehot([tr_train, s_train, p_train])
+        del tr_train, s_train, p_train
         print("CM mode.")
-        print(f"Sampled size: {str(n_samples)}")
-        print(f"N_COLUMNS: {str(N_COLLUMNS)}")
-        print(f"*"*50)
-        Neff = 0
-        with h5py.File(outfile, "w") as f:
-            f.create_dataset('weight', (Ntotal, ))
-            start = time.time()
-            for i in range(Ntotal):
-                tmp_index = set(range(Ntotal))
-                tmp_index.remove(i)
-                sampled_index = random.sample(tmp_index, k = int(n_samples -1))
-                tr_i, s_i, p_i = tr_train[i], s_train[i], p_train[i]
-                onehot_pairs = [((tr_i, s_i, p_i), (tr_train[j], s_train[j], p_train[j])) for j in sampled_index]
-
-                with Pool(cpu) as p:  
-                    distances = p.starmap(calc_distance_cm, onehot_pairs)
-
-                n_neighbor = 1 + sum([1 if d < N_COLLUMNS*threshold else 0 for d in distances])
-                weight = 1/n_neighbor
-                f["weight"][i] = weight
-                Neff += weight
-                
-                if i%print_every == 0:
-                    finish = time.time()
-                    print(f"{i}/{str(Ntotal)}\t, sampling {str(n_samples)}, estimated remaining time:", (Ntotal - i)*(finish - start)/print_every, "sec.")
-                    start = time.time()
-
-    elif mode in "cg":
+    else:
         onehot = load_data_cg(X_fname)
-        N_COLLUMNS  = onehot.shape[-1]
-        Ntotal      = onehot.shape[0]
-        if Ntotal < sampling_threshold: 
-            n_samples = Ntotal
-        else:
-            n_samples = int(Ntotal*sample_ratio_over_threshold)
+        N_COLLUMNS = onehot.shape[-1]
+        X = flatten_onehot([onehot])
+        del onehot
         print(f"Char/Gram mode.")
-        print(f"Sampled size: {str(n_samples)}")
-        print(f"N_COLUMNS: {str(N_COLLUMNS)}")
-        print(f"*"*50)
-        Neff = 0
-        with h5py.File(outfile, "w") as f:
-            f.create_dataset('weight', (Ntotal, ))
-            start = time.time()
-            for i in range(Ntotal):
-                tmp_index = set(range(Ntotal))
-                tmp_index.remove(i)
-                sampled_index = random.sample(tmp_index, k = int(n_samples -1))
-                x_i = onehot[i]
-                onehot_pairs = [(x_i, onehot[j]) for j in sampled_index]
-
-                with Pool(cpu) as p:
-                    distances = p.starmap(calc_distance_cg, onehot_pairs)
-
-                n_neighbor = 1 + sum([1 if d < N_COLLUMNS*threshold else 0 for d in distances])
-                weight = 1/n_neighbor
-                f["weight"][i] = weight
-                Neff += weight
-                if i%print_every == 0:
-                    finish = time.time()
-                    print(f"{i}/{str(Ntotal)}\t, sampling {str(n_samples)}, estimated remaining time:", (Ntotal - i)*(finish - start)/print_every, "sec.")
-                    start = time.time()
 
-    return Ntotal, Neff
+    Ntotal = X.shape[0]
+    if Ntotal < sampling_threshold or approx: 
+        n_samples = Ntotal
+    else:
+        n_samples = int(Ntotal*sample_ratio_over_threshold)
+    print(f"Sampled size: {str(n_samples)}")
+    print(f"N_COLUMNS: {str(N_COLLUMNS)}")
+    print(f"*"*50)
+
+    radius = N_COLLUMNS*threshold
+    if approx:
+        method = "approx"
+        counts = {}
+        def count_rows(rows):
+            if "all" not in counts:
+                counts["all"] = count_neighbors_lsh(X, radius)
+            return counts["all"][rows]
+    elif n_samples == Ntotal:
+        method = "exact"
+        count_rows = lambda rows: count_neighbors(X, radius, rows = rows, block_size = block_size, cpu = cpu)
+    else:
+        method = "sampled"
+        count_rows = lambda rows: count_neighbors_sampled(X, radius, n_samples, rows = rows)
+    fingerprint = weight_fingerprint(X, mode = mode, threshold = threshold, method = method, n_samples = n_samples)
+    weight = write_weight_resumable(outfile, Ntotal, count_rows, fingerprint, rows_per_block = rows_per_block, print_every = print_every)
+
+    if approx:
+        error = estimate_weight_error(X, radius, np.rint(1/weight).astype(np.int64) - 1, n_check = n_check, cpu = cpu)
+        print(f"Estimated weight error on {str(min(n_check, Ntotal))} seqs: mean {error[0]}, max {error[1]}, relative error of Neff {error[2]}")
+        with h5py.File(outfile, "a") as f:
+            f["weight"].attrs["mean_abs_error"], f["weight"].attrs["max_abs_error"], f["weight"].attrs["neff_rel_error"] = error
+    Neff = float(weight.sum(dtype = np.float64))
 
+    return Ntotal, Neff
 
 if __name__ == "__main__":
     import argparse
@@ -123,7 +330,11 @@ if __name__ == "__main__":
     parser.add_argument("--threshold", default = 0.2, type = float)
     parser.add_argument("--n_samples", default = float('inf'), type = float)
     parser.add_argument("--cpu", default = 8, type = int)
-    parser.add_argument("--print_every", default = 500, type = int)
+    parser.add_argument("--print_every", default = 1, type = int, help = "blocks between progress messages.")
+    parser.add_argument("--rows_per_block", default = 4096, type = int, help = "rows per checkpoint. A rerun with the same inputs resumes from the finished blocks.")
+    parser.add_argument("--block_size", default = None, type = int, help = "rows per distance block. Default: sized from the number of columns.")
+    parser.add_argument("--approx", action = "store_true", help = "approximate neighbor counts by LSH (0/1 data only).")
+    parser.add_argument("--n_check", default = 200, type = int, help = "sequences used to estimate the error of --approx.")
     args = parser.parse_args()
 
 
@@ -149,7 +360,11 @@ if __name__ == "__main__":
         mode = args.mode,
         sampling_threshold = args.n_samples,
         cpu = args.cpu, 
-        print_every = args.print_every
+        print_every = args.print_every,
+        block_size = args.block_size,
+        approx = args.approx,
+        n_check = args.n_check,
+        rows_per_block = args.rows_per_block
         )
     
     print(f"Total data size\t\t: {str(Ntotal)} seq")
@@ -3,6 +3,9 @@ import sys
 import importlib.util
 import gzip
 import h5py
+import numpy as np
+from collections import deque
+from multiprocessing import Pool
 
 # 手动设置 infernal_tools 模块的文件路径
 infernal_tools_path = "src/infernal_tools.py"
@@ -16,60 +19,112 @@ spec.loader.exec_module(infernal_tools)
 TracebackFileReader = infernal_tools.TracebackFileReader
 make_trsp_from_deriv_dict = infernal_tools.make_trsp_from_deriv_dict
 
-def wrapper_of_make_trsp_from_deriv_dict(doublet):
-    path_to_cmfile, deriv_dict_cminit = doublet
-    tr, ss, bp = make_trsp_from_deriv_dict(path_to_cmfile, deriv_dict_cminit)
-    return tr, ss, bp
-
-# memory saving code. slow...
-def make_onehot_of_cm_from_traceback(path_to_traceback, path_to_cmfile, progress_messages):
+sys.path.append("./src")
+import trsp_h5
+
+# reader of the worker processes. The CM file is read once per worker.
+_worker_tbreader = None
+
+def _init_onehot_worker(path_to_cmfile):
+    global _worker_tbreader
+    _worker_tbreader = TracebackFileReader(path_to_cmfile)
+
+def _tracebacks_to_trsp(tracebacks):
+    """
+    chunk of tracebacks (see TracebackFileReader.iter_tracebacks) -> stacked tr, s, p (float32)
+    """
+    tr_all, s_all, p_all = [], [], []
+    for traceback in tracebacks:
+        deriv_dict = _worker_tbreader.make_aligned_tbdict_from_tbdf_ELinitCM(traceback)
+        tr, ss, bp = make_trsp_from_deriv_dict(_worker_tbreader.cm_file, deriv_dict, _worker_tbreader.cm.compiled)
+        tr_all.append(tr.numpy())
+        s_all.append(ss.numpy())
+        p_all.append(bp.numpy())
+    return np.stack(tr_all).astype(np.float32), np.stack(s_all).astype(np.float32), np.stack(p_all).astype(np.float32)
+
+def _iter_chunks(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) != 0:
+        yield chunk
+
+def make_onehot_of_cm_from_traceback(path_to_traceback, path_to_cmfile, progress_messages, cpu = 1, chunk_size = 256, compact = False):
+    """
+    traceback file -> tr/s/p dataset (h5).
+    Tracebacks are streamed in chunks of chunk_size to cpu worker processes, and each converted chunk
+    is written as a contiguous slab. At most 2*cpu chunks are in flight, so memory does not grow with the dataset.
+    compact: write the compact layout of trsp_h5 (h5 chunks of chunk_size rows) instead of float32 with NaN.
+    """
     id_all = []
     with gzip.open(path_to_traceback, "rb") as tb:
         for line in tb:
             if line.startswith(b'>'):
-                id_all.append(line.replace(b">", b"").decode('utf-8'))
+                id_all.append(line.replace(b">", b"").decode('utf-8').strip())
 
-    n_size = len(id_all)
     progress_messages.append(f"Start reading {path_to_traceback}...")
 
-    tbreader = TracebackFileReader(path_to_cmfile, path_to_traceback)
-    tbtext_all = []
-    for i in range(n_size):
-        tbtext = list(tbreader.traceback_iter())[0]
-        tbtext_all.append(tbtext)
-    progress_messages.append(f"Start making tbtext")
-
-    tbdf_all = []
-    for tbtext in tbtext_all:
-        tbdf = tbreader._make_tbdf_from_tbtext(tbtext)
-        tbdf_all.append(tbdf)
-    progress_messages.append(f"Start making tbdict")
+    with TracebackFileReader(path_to_cmfile, path_to_traceback) as tbreader:
+        return _write_onehot(tbreader, id_all, path_to_traceback, path_to_cmfile, progress_messages, cpu, chunk_size, compact)
 
-    deriv_dict_all = []
-    for tbdf in tbdf_all:
-        deriv_dict = tbreader.make_aligned_tbdict_from_tbdf_ELinitCM(tbdf)
-        deriv_dict_all.append(deriv_dict)
-
-    # infer data shape
-    tr0, ss0, bp0 = wrapper_of_make_trsp_from_deriv_dict((path_to_cmfile, deriv_dict_all[0]))
+def _write_onehot(tbreader, id_all, path_to_traceback, path_to_cmfile, progress_messages, cpu, chunk_size, compact):
+    global _worker_tbreader
+    n_size   = len(id_all)
+    compiled = tbreader.cm.compiled
+    grammar  = infernal_tools.grammar
+    shapes   = {
+        "tr":(compiled.n_nodes, grammar.CM_N_TR),
+        "s" :(len(compiled.single_states), grammar.CM_N_S),
+        "p" :(len(compiled.pair_states), grammar.CM_N_P)
+        }
 
     # writing datafile
     output_h5 = path_to_traceback.replace(".txt.gz", "") + f"_onehot_cm.h5"
+    float_h5  = output_h5 + ".float.tmp" if compact else output_h5
     progress_messages.append(f"Start writing {output_h5}...")
-    with h5py.File(output_h5, 'w') as datafile:
-        datafile.create_dataset('id', (n_size, ), dtype=h5py.special_dtype(vlen=str))
-        datafile.create_dataset('tr', (n_size, *tr0.shape))
-        datafile.create_dataset('s', (n_size, *ss0.shape))  # 最後に転置
-        datafile.create_dataset('p', (n_size, *bp0.shape))  # 最後に転置
-
-        for i, deriv_dict_cminit in enumerate(deriv_dict_all):
-            tr, ss, bp = wrapper_of_make_trsp_from_deriv_dict((path_to_cmfile, deriv_dict_cminit))
-            datafile["tr"][i] = tr
-            datafile["s"][i] = ss
-            datafile["p"][i] = bp
-            if i % 100 == 0:
-                progress_messages.append(f"seq {str(i)}")
-
+    with h5py.File(float_h5, 'w') as datafile:
+        datafile.create_dataset('id', data = id_all, dtype=h5py.special_dtype(vlen=str))
+        for key, shape in shapes.items():
+            datafile.create_dataset(
+                key, (n_size, *shape), dtype = np.float32,
+                chunks = (max(min(chunk_size, n_size), 1), *shape), compression = "gzip"
+                )
+
+        def write_slab(start, trsp):
+            tr, ss, bp = trsp
+            datafile["tr"][start:start+len(tr)] = tr
+            datafile["s"][start:start+len(tr)]  = ss
+            datafile["p"][start:start+len(tr)]  = bp
+            progress_messages.append(f"seq {str(start+len(tr))}")
+            return start + len(tr)
+
+        chunks = _iter_chunks(tbreader.iter_tracebacks(), chunk_size)
+        start  = 0
+        if cpu <= 1:
+            # the reader of this process has the CM already
+            _worker_tbreader = tbreader
+            try:
+                for chunk in chunks:
+                    start = write_slab(start, _tracebacks_to_trsp(chunk))
+            finally:
+                _worker_tbreader = None
+        else:
+            with Pool(cpu, initializer = _init_onehot_worker, initargs = (path_to_cmfile,)) as p:
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(p.apply_async(_tracebacks_to_trsp, (chunk,)))
+                    if len(pending) >= 2*cpu:
+                        start = write_slab(start, pending.popleft().get())
+                while len(pending) != 0:
+                    start = write_slab(start, pending.popleft().get())
+
+    if compact:
+        progress_messages.append("Converting to the compact layout...")
+        trsp_h5.convert_to_compact(float_h5, output_h5, batch_size = chunk_size)
+        os.remove(float_h5)
     return output_h5
 
 if __name__ == '__main__':
@@ -84,7 +139,9 @@ if __name__ == '__main__':
     parser.add_argument('--fasta', default="", help='path to fasta file. Fasta file is automatically aligned to cmfile and its traceback will be converted to onehot.')
     parser.add_argument('--traceback', default="", help='path to gzipped tracebackfile')
     parser.add_argument('--cmfile', default="", required=True, help='path to cm file')
-    parser.add_argument('--cpu', default=4, type=int, help="CPU cores for cmalign program. (default: 4)")
+    parser.add_argument('--cpu', default=4, type=int, help="CPU cores for cmalign program and the conversion. (default: 4)")
+    parser.add_argument('--chunk_size', default=256, type=int, help="tracebacks per written slab and rows per h5 chunk. (default: 256)")
+    parser.add_argument('--compact', action='store_true', help="write uint8/float16 values with a validity mask instead of float32 with NaN.")
     args = parser.parse_args()
 
     if args.fasta != "":
@@ -103,5 +160,5 @@ if __name__ == '__main__':
 
     print(f"Loading {path_to_traceback}.")
     progress_messages = []
-    output_h5 = make_onehot_of_cm_from_traceback(path_to_traceback, args.cmfile, progress_messages)
+    output_h5 = make_onehot_of_cm_from_traceback(path_to_traceback, args.cmfile, progress_messages, cpu=args.cpu, chunk_size=args.chunk_size, compact=args.compact)
     print(f"wrote\t\t: {output_h5}")
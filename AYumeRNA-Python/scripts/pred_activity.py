@@ -10,34 +10,17 @@ import numpy as np
 import random 
 import h5py 
 from models.CMVAE import CovarianceModelVAE
+from models.loss import CMVAELoss, inverse_scale
+from trsp_h5 import read_trsp
 
 
 def load_data_cm(path):
-    data = h5py.File(path, "r")
-    tr = torch.from_numpy(data["tr"][:]).nan_to_num(0).transpose(-2, -1).float()
-    s = torch.from_numpy(data["s"][:]).transpose(-2, -1).float()
-    p = torch.from_numpy(data["p"][:]).transpose(-2, -1).float()
+    """tr, s, p of a file of either layout (see trsp_h5), as (N, N_RULE, LEN) float tensors with 0 for NaN."""
+    with h5py.File(path, "r") as data:
+        tr, s, p = [torch.from_numpy(read_trsp(data, key, fill=0)).transpose(-2, -1).float() for key in ("tr", "s", "p")]
     return tr, s, p
 
 
-def modifiedCELoss(pred, soft_targets, gamma = 0, summarize = True):
-    """
-    shape: (BATCH, N_COL, N_RULE)
-    gamma for focal loss
-    targetの列ごとの値scaleを求め, predとtarget/scaleのCELossをとる
-    """
-    scale = soft_targets.nansum(dim = -1).unsqueeze(dim = -1)
-    logsoftmax = nn.LogSoftmax(dim = -1)
-    sotfmax = nn.Softmax(dim = -1)
-    ce = - soft_targets/scale * ((1-sotfmax(pred)).pow(gamma)) * logsoftmax(pred)
-    ce_colwise = torch.sum(ce, dim = -1)
-
-    if summarize:
-        return torch.sum(ce)
-    else:
-        return ce.sum(dim=-1).sum(dim=-1)
-
-
 def eval_ELBO(model, tr_s_p, beta, n_samples = 25):
     SEED = 42
     random.seed(SEED)
@@ -45,17 +28,14 @@ def eval_ELBO(model, tr_s_p, beta, n_samples = 25):
     torch.manual_seed(SEED)
 
     tr,s,p = tr_s_p
+    criterion  = CMVAELoss()
+    inv_scales = [inverse_scale(x) for x in (tr, s, p)]  # same targets for all samples
     with torch.no_grad():
         mu, logvar = model.encoder((tr, s, p))
         eve = []
     for i in range(n_samples):
         z = model.sample(mu, logvar)
-        tr_, s_, p_ = model.decoder(z) 
-
-        tr_loss = modifiedCELoss(tr_.transpose(-1, -2), tr.transpose(-1, -2), summarize = False)
-        s_loss = modifiedCELoss(s_.transpose(-1, -2), s.transpose(-1, -2), summarize = False)
-        p_loss = modifiedCELoss(p_.transpose(-1, -2), p.transpose(-1, -2), summarize = False)
-        loss = (tr_loss + s_loss + p_loss) #/BATCH_SIZE
+        loss = criterion(model.decoder(z), (tr, s, p), inv_scales) #/BATCH_SIZE
         kl = model.kl(mu, logvar)
         elbo = loss + beta * kl
         eve.append(elbo)
@@ -1,4 +1,5 @@
 import sys
+import time
 sys.path.append("./src")
 import torch
 import torch.nn as nn
@@ -6,38 +7,146 @@ from torch.distributions import Normal
 import argparse
 import preprocess
 import grammar
-from infernal_tools import CovarianceModel, make_deriv_dict_from_trsp
+from infernal_tools import CovarianceModel, CompiledCM
 from multiprocessing import Pool
 
 print("torch.cuda.is_available: ", torch.cuda.is_available())
 
-def helper_sampling_CMVAE(params):
+# CM template of the emission workers. Set once per worker by `_init_emit_worker`.
+_worker_compiled_cm = None
+
+def _init_emit_worker(compiled_cm):
+    global _worker_compiled_cm
+    _worker_compiled_cm = compiled_cm
+
+def _emit_from_params(params):
     """
-    params: (cm_deriv_dict, tr, s, p)
+    params: (trans, emit_single, emit_pair) of a sample -> most probable sequence.
     """
-    softmax = nn.Softmax(dim = -2)
-    cm_deriv_dict, tr, s, p = params
-    out_dict = make_deriv_dict_from_trsp(cm_deriv_dict, (softmax(tr), softmax(s), softmax(p)))
-    cm = CovarianceModel(out_dict)
+    cm = CovarianceModel(None, _worker_compiled_cm.with_params(*params))
     seq, _ = cm.cmemit(sample = False)[0]
     return seq
 
-def sampling_CMVAE(model, cm_deriv_dict, Z_DIM, SAMPLE_SIZE_Z):
-
-    dist = Normal(torch.tensor([0.0]*Z_DIM), torch.tensor([1.0]*Z_DIM))
-    z_sampled = [dist.sample() for i in range(SAMPLE_SIZE_Z)]
-    seq_sampled = []
-    trsp_sampled = []
-    for i in range(SAMPLE_SIZE_Z):
-        # if i%10 == 0: 
-        print(i)
-        z = z_sampled[i].to(model.device)
-        tr, s, p = model.decoder(z.unsqueeze(dim = 0))
-        trsp_sampled.append([cm_deriv_dict, tr.detach().cpu(), s.detach().cpu(), p.detach().cpu()])
-    
-    seq_sampled = [helper_sampling_CMVAE(param) for param in trsp_sampled]
+def emit_sequences(compiled_cm, trsp, cpu = 1, chunksize = 16, pool = None):
+    """
+    softmaxed decoder outputs tr (B, 56, n_nodes), s (B, 4, n_single), p (B, 16, n_pair) -> generator of B sequences, in order.
+    The parameters are gathered in one batch, and only the per-sample arrays are sent to the cpu workers.
+    pool: Pool initialized by `_init_emit_worker` with compiled_cm. If given, it is used instead of a new one.
+    """
+    tr, s, p = [x.detach().cpu().numpy() if torch.is_tensor(x) else x for x in trsp]
+    trans, emit_single, emit_pair = compiled_cm.params_from_trsp(tr, s, p)
+    params = zip(trans, emit_single, emit_pair)
+    if pool is not None:
+        yield from pool.imap(_emit_from_params, params, chunksize = chunksize)
+        return
+    if cpu <= 1:
+        _init_emit_worker(compiled_cm)
+        yield from map(_emit_from_params, params)
+        return
+    with Pool(cpu, initializer = _init_emit_worker, initargs = (compiled_cm,)) as pool:
+        yield from pool.imap(_emit_from_params, params, chunksize = chunksize)
+
+def decode_latents(model, z, batch_size = 256):
+    """
+    z (n, Z_DIM) -> stacked decoder outputs tr, s, p on cpu, decoded in mini-batches of batch_size.
+    """
+    tr_all, s_all, p_all = [], [], []
+    with torch.inference_mode():
+        for start in range(0, len(z), batch_size):
+            tr, s, p = model.decoder(z[start:start+batch_size].to(model.device))
+            tr_all.append(tr.cpu())
+            s_all.append(s.cpu())
+            p_all.append(p.cpu())
+    return torch.cat(tr_all), torch.cat(s_all), torch.cat(p_all)
+
+def iter_sampling_CMVAE(model, compiled_cm, Z_DIM, n_draws = None, batch_size = 256, cpu = 1):
+    """
+    generator of sequences from z ~ N(0, I), drawn, decoded and emitted batch_size at a time.
+    n_draws: number of z to draw. None draws until the caller stops.
+    """
+    dist    = Normal(torch.tensor([0.0]*Z_DIM), torch.tensor([1.0]*Z_DIM))
+    softmax = nn.Softmax(dim = -2)
+    pool    = Pool(cpu, initializer = _init_emit_worker, initargs = (compiled_cm,)) if cpu > 1 else None
+    try:
+        drawn = 0
+        while n_draws is None or drawn < n_draws:
+            n = batch_size if n_draws is None else min(batch_size, n_draws - drawn)
+            trsp_batch = [softmax(x) for x in decode_latents(model, dist.sample((n,)), batch_size)]
+            yield from emit_sequences(compiled_cm, trsp_batch, cpu = cpu, pool = pool)
+            drawn += n
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+def sampling_CMVAE(model, cm_deriv_dict, Z_DIM, SAMPLE_SIZE_Z, batch_size = 256, cpu = 1):
+    compiled_cm = CompiledCM(cm_deriv_dict)
+    seq_sampled = list(iter_sampling_CMVAE(model, compiled_cm, Z_DIM, SAMPLE_SIZE_Z, batch_size = batch_size, cpu = cpu))
     return seq_sampled
 
+def write_unique_fasta(sequences, outfasta, n_unique = None, progress_messages = None, report_every = 1000):
+    """
+    write the distinct sequences of an iterable to outfasta as they arrive, as >seq0, >seq1, ...
+    n_unique: stop once this many distinct sequences are written. None consumes the whole iterable.
+    Only the set of written sequences is kept in memory.
+    returns the number of distinct sequences written.
+    """
+    seen = set()
+    with open(outfasta, "w") as f:
+        for seq in sequences:
+            if seq in seen:
+                continue
+            f.write(f">seq{str(len(seen))}\n")
+            f.write(f"{str(seq)}\n")
+            seen.add(seq)
+            if progress_messages is not None and len(seen) % report_every == 0:
+                f.flush()
+                progress_messages.append(f"{len(seen)} unique sequences written")
+            if n_unique is not None and len(seen) >= n_unique:
+                break
+    return len(seen)
+
+def sampling_CMVAE_to_fasta(model, cm_deriv_dict, Z_DIM, outfasta, n_samples = None, n_unique = None, max_draws = None,
+                            batch_size = 256, cpu = 1, progress_messages = None, compiled_cm = None):
+    """
+    streaming version of `sampling_CMVAE` that writes the distinct sequences to outfasta.
+    n_samples: number of z to draw. Used when n_unique is None.
+    n_unique : number of distinct sequences to write. Draws continue until it is reached, or until max_draws
+               (default 100*n_unique) draws in case the model cannot produce that many distinct sequences.
+    compiled_cm: CompiledCM of cm_deriv_dict. If given, cm_deriv_dict is not compiled again (and may be None).
+    returns the number of distinct sequences written.
+    """
+    if n_unique is not None:
+        n_draws = max_draws if max_draws is not None else 100*n_unique
+    else:
+        n_draws = n_samples
+    if compiled_cm is None:
+        compiled_cm = CompiledCM(cm_deriv_dict)
+    sequences   = iter_sampling_CMVAE(model, compiled_cm, Z_DIM, n_draws, batch_size = batch_size, cpu = cpu)
+    try:
+        return write_unique_fasta(sequences, outfasta, n_unique = n_unique, progress_messages = progress_messages)
+    finally:
+        sequences.close()
+
+def benchmark_decoding(model, Z_DIM, batch_sizes, threads, n_samples = 1024, repeat = 3):
+    """
+    throughput (samples/sec) of `decode_latents` for each batch size and number of torch threads.
+    """
+    z = torch.randn(n_samples, Z_DIM)
+    results = []
+    print(f"{'threads':>8s} {'batch':>6s} {'samples/sec':>12s}")
+    for n_threads in threads:
+        torch.set_num_threads(n_threads)
+        for batch_size in batch_sizes:
+            decode_latents(model, z[:batch_size], batch_size) # warm up
+            t = []
+            for _ in range(repeat):
+                start = time.time()
+                decode_latents(model, z, batch_size)
+                t.append(time.time() - start)
+            results.append((n_threads, batch_size, n_samples/min(t)))
+            print(f"{n_threads:8d} {batch_size:6d} {results[-1][2]:12.1f}")
+    return results
+
 
 if __name__ == "__main__":
     import argparse
@@ -52,6 +161,11 @@ if __name__ == "__main__":
     parser.add_argument('--cmfile', default = "", type = str)
     parser.add_argument('--outfasta', help='output fasta', type = str)
     parser.add_argument('--n_samples', help='sampling size', default = 1000, type = int)
+    parser.add_argument('--n_unique', help='number of distinct sequences to write. Overrides --n_samples.', default = None, type = int)
+    parser.add_argument('--batch_size', help='decoder mini-batch size', default = 256, type = int)
+    parser.add_argument('--cpu', help='processes of the emission stage', default = 1, type = int)
+    parser.add_argument('--bench_batch_sizes', help='batch sizes for --mode bench', default = [1, 16, 64, 256, 1024], type = int, nargs = "+")
+    parser.add_argument('--bench_threads', help='torch threads for --mode bench', default = [1, torch.get_num_threads()], type = int, nargs = "+")
     args = parser.parse_args()
 
     cfg = load_config(args.config)
@@ -60,19 +174,22 @@ if __name__ == "__main__":
     from models.CMVAE import CovarianceModelVAE
     from infernal_tools import CMReader
 
+    model = CovarianceModelVAE.build_from_config(args.config)
+    if args.mode == "bench":
+        if args.ckpt:
+            model.load_model_from_ckpt(args.ckpt)
+        model.to(model.device)
+        benchmark_decoding(model, cfg["Z_DIM"], args.bench_batch_sizes, args.bench_threads, n_samples = args.n_samples)
+        sys.exit()
+
     cmreader = CMReader(args.cmfile)
     print("Start loading cm dict. This process may take much time for long sequences.")
     cm_deriv_dict = cmreader.load_derivation_dict_from_cmfile()
-    model = CovarianceModelVAE.build_from_config(args.config)
     model.load_model_from_ckpt(args.ckpt)
     model.to(model.device)
-    # model.eval();
 
-    seq_sampled = sampling_CMVAE(model, cm_deriv_dict, cfg["Z_DIM"], args.n_samples)
-
-
-    with open(args.outfasta, "w") as f:
-        for i, seq in enumerate(set(seq_sampled)):
-            f.write(f">seq{str(i)}\n")
-            f.write(f"{str(seq)}\n")
-        
\ No newline at end of file
+    n_written = sampling_CMVAE_to_fasta(
+        model, cm_deriv_dict, cfg["Z_DIM"], args.outfasta,
+        n_samples = args.n_samples, n_unique = args.n_unique, batch_size = args.batch_size, cpu = args.cpu
+        )
+    print(f"wrote {n_written} sequences\t: {args.outfasta}")
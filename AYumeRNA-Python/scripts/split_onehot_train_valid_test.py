@@ -1,38 +1,28 @@
+import sys
+sys.path.append("./src")
 import h5py 
 import os 
+import numpy as np
 from sklearn.model_selection import train_test_split
+from trsp_h5 import write_trsp_rows
 
 def split_onehot_cm(path_to_cmonehot, train_ratio = 0.7, suffix = "", random_state = 42):
     """
     train/valid/test splitter for datasets of CM-VAE.
+    The outputs keep the layout (legacy or compact, see trsp_h5) of the input.
     """
 
     h5 = h5py.File(path_to_cmonehot, "r")
-    ids = h5["id"][:]
-    tr = h5["tr"][:]
-    s = h5["s"][:]
-    p = h5["p"][:]
-    id_train, id_vt,   tr_train,  tr_vt,   s_train,  s_vt,   p_train,  p_vt   = train_test_split(ids, tr, s,p, test_size=1-train_ratio, random_state = random_state)
-    id_valid, id_test, tr_valid,  tr_test, s_valid,  s_test, p_valid,  p_test = train_test_split(id_vt, tr_vt, s_vt, p_vt, test_size=0.5, random_state = random_state)
+    index = np.arange(len(h5["id"]))
+    index_train, index_vt   = train_test_split(index, test_size=1-train_ratio, random_state = random_state)
+    index_valid, index_test = train_test_split(index_vt, test_size=0.5, random_state = random_state)
 
     basename, _ = os.path.splitext(path_to_cmonehot)
-    with h5py.File(basename + f"_train{suffix}.h5", "w") as h5:
-        h5.create_dataset("id", data = id_train)
-        h5.create_dataset("tr", data = tr_train)
-        h5.create_dataset("s",  data = s_train)
-        h5.create_dataset("p",  data = p_train)
-
-    with h5py.File(basename + f"_valid{suffix}.h5", "w") as h5:
-        h5.create_dataset("id", data = id_valid)
-        h5.create_dataset("tr", data = tr_valid)
-        h5.create_dataset("s",  data = s_valid)
-        h5.create_dataset("p",  data = p_valid)
-
-    with h5py.File(basename + f"_test{suffix}.h5", "w") as h5:
-        h5.create_dataset("id", data = id_test)
-        h5.create_dataset("tr", data = tr_test)
-        h5.create_dataset("s",  data = s_test)
-        h5.create_dataset("p",  data = p_test)
+    with h5py.File(basename + f"_train{suffix}.h5", "w") as h5_train,\
+         h5py.File(basename + f"_valid{suffix}.h5", "w") as h5_valid,\
+         h5py.File(basename + f"_test{suffix}.h5", "w") as h5_test:
+        write_trsp_rows(h5, [(h5_train, index_train), (h5_valid, index_valid), (h5_test, index_test)])
+    h5.close()
 
     return basename + "_(train|valid|test).h5"
 
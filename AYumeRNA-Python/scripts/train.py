@@ -6,27 +6,16 @@ import sys
 sys.path.append("./src")
 import os
 import csv
+import hashlib
+import random
+import socket
+import time
 import torch
 import torch.nn as nn
+import torch.distributed as dist
+import torch.distributed.nn as dist_nn
 import numpy as np
-
-def modifiedCELoss(pred, soft_targets, gamma=0, summarize=True):
-    """
-    shape: (BATCH, N_COL, N_RULE)
-    gamma for focal loss
-    calc sum of a column and normalize a col by the sum, then calc CEloss.
-    Sum CELoss for each column and normalize it by the number of columns.
-    summarize: column-wise sum.
-    """
-    scale = soft_targets.nansum(dim=-1).unsqueeze(dim=-1)
-    logsoftmax = nn.LogSoftmax(dim=-1)
-    softmax = nn.Softmax(dim=-1)
-    ce = -soft_targets / scale * ((1 - softmax(pred)).pow(gamma)) * logsoftmax(pred)
-    ce_colwise = torch.sum(ce, dim=-1)
-    if summarize:
-        return torch.sum(ce)
-    else:
-        return ce.sum(dim=-1).sum(dim=-1)
+from models.loss import CMVAELoss, modifiedCELoss
 
 def save_model(model, dir_name, pt_file):
     if not os.path.isdir(dir_name):
@@ -43,43 +32,189 @@ def write_csv(d, dir_name, fname):
         writer.writerows(zip(*d.values()))
     print(f"Saved the log csv at {path}")
 
-def train_main(args):
-    import random
+# config keys that do not change the training trajectory: a run may resume with other values
+RESUME_FREE_KEYS = (
+    "EPOCH", "PRINT_EVERY", "LOG", "LOG_DIR", "CKPT_ITER", "CKPT_MINUTES", "SUFFIX", "DATA_BACKEND",
+    "EARLY_STOPPING", "EARLY_STOPPING_THRESHOLD"
+)
+
+def config_fingerprint(config_dict, paths):
+    """sha1 of the config (without RESUME_FREE_KEYS) and of the contents of the data files."""
+    sha1 = hashlib.sha1(repr(sorted((k, v) for k, v in config_dict.items() if k not in RESUME_FREE_KEYS)).encode())
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+    return sha1.hexdigest()
+
+def rng_states():
+    return {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "random": random.getstate()}
+
+def set_rng_states(states):
+    torch.set_rng_state(states["torch"])
+    np.random.set_state(states["numpy"])
+    random.setstate(states["random"])
+
+def save_train_state(state, path):
+    """write a training state atomically: an interrupted write leaves the previous state in place."""
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def load_train_state(path, fingerprint):
+    """the training state at path, or None if there is none or it was written by another config or data."""
+    if not os.path.exists(path):
+        return None
+    state = torch.load(path, weights_only=False)
+    return state if state.get("fingerprint") == fingerprint else None
+
+def allreduce_gradients(model):
+    """
+    sum the gradients of all ranks in one collective.
+    The loss is a sum over the batch, so the sum of the rank gradients (world_size times their average) is the gradient
+    of the whole global batch, as in single-process training with batch_size*world_size.
+    """
+    grads = [param.grad for param in model.parameters() if param.grad is not None]
+    flat  = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat)
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
+
+class GlooSyncBatchNorm(nn.BatchNorm1d):
+    """
+    BatchNorm1d whose training statistics are taken over the batches of all ranks, so that data-parallel training
+    normalizes like one process with the global batch. torch.nn.SyncBatchNorm runs only on GPUs.
+    The state dict is that of BatchNorm1d.
+    """
+    def forward(self, x):
+        if not self.training:
+            return super().forward(x)
+        n_channel = x.shape[1]
+        dims  = [0, 2] if x.dim() == 3 else [0]
+        shape = (1, n_channel, 1) if x.dim() == 3 else (1, n_channel)
+        count = torch.tensor([x.numel() / n_channel], dtype=x.dtype)
+        stats = dist_nn.functional.all_reduce(torch.cat([x.sum(dims), (x * x).sum(dims), count]))
+        count = stats[-1]
+        mean = stats[:n_channel] / count
+        var = stats[n_channel:2 * n_channel] / count - mean * mean
+        if self.track_running_stats:
+            with torch.no_grad():
+                self.running_mean.mul_(1 - self.momentum).add_(self.momentum * mean)
+                self.running_var.mul_(1 - self.momentum).add_(self.momentum * var * count / (count - 1))
+                self.num_batches_tracked += 1
+        x = (x - mean.view(shape)) * torch.rsqrt(var.view(shape) + self.eps)
+        if self.affine:
+            x = x * self.weight.view(shape) + self.bias.view(shape)
+        return x
+
+    @classmethod
+    def convert(cls, module):
+        """replace the BatchNorm1d layers of module, keeping their parameters and running statistics."""
+        if isinstance(module, nn.BatchNorm1d):
+            sync = cls(module.num_features, module.eps, module.momentum, module.affine, module.track_running_stats)
+            sync.load_state_dict(module.state_dict())
+            return sync
+        for name, child in module.named_children():
+            module.add_module(name, cls.convert(child))
+        return module
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _ddp_worker(rank, args, world_size, port):
+    dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{port}", rank=rank, world_size=world_size)
+    torch.set_num_threads(args.get('threads_per_worker') or max(1, (os.cpu_count() or 1) // world_size))
+    try:
+        train_main(args, rank=rank, world_size=world_size)
+    finally:
+        dist.destroy_process_group()
+
+def train_main(args, rank=0, world_size=None):
+    """
+    train CM-VAE. With args['world_size'] > 1, world_size processes train one model data-parallel on the gloo backend:
+    each rank reads batch_size items of every global batch, the gradients are summed over the ranks (see
+    allreduce_gradients), and only rank 0 prints, writes logs and saves models. The effective batch size is
+    batch_size*world_size. BatchNorm statistics are synchronized over the ranks (see GlooSyncBatchNorm).
+    With a log_dir, the training state (model, optimizer, epoch and step, batch order, logs and RNG states of every
+    rank) is saved to train_state<suffix>.ckpt every ckpt_iter epochs with save_ckpt and every ckpt_minutes minutes.
+    A rerun with the same config and data resumes from it (unless resume is False) and trains exactly as if it had not
+    stopped. epoch, print_every, logging, checkpointing and early stopping may change between the runs.
+    """
+    if world_size is None:
+        world_size = args.get('world_size', 1)
+        if world_size > 1:
+            import torch.multiprocessing as mp
+            mp.spawn(_ddp_worker, args=(args, world_size, args.get('ddp_port') or _free_port()), nprocs=world_size, join=True)
+            return
+
+    import builtins
     import yaml
     from pprint import pprint
-    from models.CMVAE import CovarianceModelVAE, MyDataset
+    from models.CMVAE import CovarianceModelVAE, MyDataset, BatchIndexSampler
     from util import Timer, AnnealKL
     from torch.utils.data import DataLoader
 
-    # Set random seeds
-    torch.manual_seed(args.get('random_seed', 42))
-    np.random.seed(args.get('random_seed', 42))
-    random.seed(args.get('random_seed', 42))
+    # Set random seeds. Ranks draw their own reparametrization noise; the batch order is shared (see BatchIndexSampler).
+    torch.manual_seed(args.get('random_seed', 42) + rank)
+    np.random.seed(args.get('random_seed', 42) + rank)
+    random.seed(args.get('random_seed', 42) + rank)
+    distributed = world_size > 1
+    is_main = rank == 0
+    batch_size = args.get('batch_size', 8)
+    global_batch_size = batch_size * world_size
+    # only rank 0 prints
+    print = builtins.print if is_main else (lambda *a, **k: None)
 
     timer = Timer()
 
     # Load training dataset
+    # data_backend: h5 reads items from the file, memory (in RAM) / mmap (on disk) hold preconverted arrays (see MyDataset)
+    data_backend = args.get('data_backend', 'h5')
+    num_workers = 4 if data_backend == 'h5' else 0
     train_dataset = MyDataset(
         path=os.path.join(args['data_dir'], args['X_train']),
-        weight_path=os.path.join(args['data_dir'], args.get('w_train', '')) if args.get('w_train') else None
+        weight_path=os.path.join(args['data_dir'], args.get('w_train', '')) if args.get('w_train') else None,
+        backend=data_backend,
+        return_scales=True
+    )
+    # whole batches are gathered by the dataset (batch_size=None disables collation)
+    train_sampler = BatchIndexSampler(
+        len(train_dataset), batch_size, shuffle=True, drop_last=True,
+        generator=torch.Generator().manual_seed(args.get('random_seed', 42)), rank=rank, world_size=world_size
+    )
+    # the loaders draw their worker seeds from their own generators, not from the global RNG saved in the train state
+    train_dataloader = DataLoader(
+        train_dataset, batch_size=None, num_workers=num_workers, sampler=train_sampler, generator=torch.Generator(),
+        persistent_workers=num_workers > 0
     )
-    train_dataloader = DataLoader(train_dataset, batch_size=args.get('batch_size', 8), shuffle=True, num_workers=4, drop_last=True)
 
     # Load validation dataset if provided
     if not args.get('only_training', False) and args.get('X_valid'):
         valid_dataset = MyDataset(
             path=os.path.join(args['data_dir'], args['X_valid']),
-            weight_path=os.path.join(args['data_dir'], args.get('w_valid', '')) if args.get('w_valid') else None
+            weight_path=os.path.join(args['data_dir'], args.get('w_valid', '')) if args.get('w_valid') else None,
+            backend=data_backend,
+            return_scales=True
+        )
+        valid_dataloader = DataLoader(
+            valid_dataset, batch_size=None, num_workers=num_workers, persistent_workers=num_workers > 0,
+            sampler=BatchIndexSampler(
+                len(valid_dataset), batch_size, shuffle=True, drop_last=True,
+                generator=torch.Generator().manual_seed(args.get('random_seed', 42)), rank=rank, world_size=world_size
+            ),
+            generator=torch.Generator()
         )
-        valid_dataloader = DataLoader(valid_dataset, batch_size=args.get('batch_size', 8), shuffle=True, num_workers=4, drop_last=True)
     else:
         valid_dataset = None
         valid_dataloader = None
 
-    TR_LEN = train_dataset.data["tr"].shape[-2]
-    S_LEN = train_dataset.data["s"].shape[-2]
-    P_LEN = train_dataset.data["p"].shape[-2]
-    DATA_SIZE = train_dataset.data["tr"].shape[0]
+    TR_LEN = train_dataset.tr_len
+    S_LEN = train_dataset.s_len
+    P_LEN = train_dataset.p_len
+    DATA_SIZE = len(train_dataset)
 
     conv_params = {
         "ker1": args.get('ker1', 5), "ch1": args.get('ch1', 5),
@@ -98,35 +233,76 @@ def train_main(args):
         # dropout_rate=args.get('dropout_rate', 0.0),
         conv_params=conv_params,
     )
-    anneal = AnnealKL(step=(DATA_SIZE / args.get('batch_size', 8) * args.get('anneal_saturate_rate', 0.4)) ** -1, rate=args.get('anneal_rate', 1))
-    beta_sum_batch = args.get('beta', 0.001) * args.get('batch_size', 8)
+    if distributed:
+        model = GlooSyncBatchNorm.convert(model)
+        for param in model.parameters():
+            dist.broadcast(param.data, 0)
+    anneal = AnnealKL(step=(DATA_SIZE / global_batch_size * args.get('anneal_saturate_rate', 0.4)) ** -1, rate=args.get('anneal_rate', 1))
+    beta_sum_batch = args.get('beta', 0.001) * global_batch_size
     optimizer = torch.optim.Adam(model.parameters(), lr=args.get('learning_rate', 1e-3))
-
-    def train_model(log):
-        for step, tr_s_p_w in enumerate(train_dataloader, 0):
-            tr, s, p, w = tr_s_p_w
+    criterion = CMVAELoss()
+
+    state_path = os.path.join(args.get('log_dir') or '', f"train_state{args.get('suffix', '')}.ckpt")
+    ckpt_seconds = 60 * args.get('ckpt_minutes', 0)
+    last_ckpt_time = time.time()
+
+    def checkpoint(epoch, step, train_generator_state, stopped=False):
+        """
+        save the state to continue at batch `step` of `epoch`. train_generator_state is the state of the sampler
+        generator before the permutation of that epoch. Collective in distributed training.
+        """
+        nonlocal last_ckpt_time
+        rng = [rng_states()]
+        if distributed:
+            rng = [None] * world_size
+            dist.all_gather_object(rng, rng_states())
+        if is_main:
+            save_train_state({
+                "fingerprint": fingerprint,
+                "epoch": epoch,
+                "step": step,
+                "stopped": stopped,
+                "model": model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "train_generator": train_generator_state,
+                "valid_generator": valid_dataloader.sampler.generator.get_state() if valid_dataloader else None,
+                "rng": rng,
+                "log": log,
+                "log_valid": log_valid,
+            }, state_path)
+            print(f"Saved the training state at {state_path} (epoch {epoch}, step {step})")
+        last_ckpt_time = time.time()
+
+    def train_model(log, start_step=0):
+        for step, tr_s_p_w in enumerate(train_dataloader, start_step):
+            tr, s, p, w, inv_scales = tr_s_p_w
             tr = tr.to(model.device)
             s = s.to(model.device)
             p = p.to(model.device)
             w = w.to(model.device)
+            inv_scales = [x.to(model.device) for x in inv_scales]
 
             mu, logvar = model.encoder((tr, s, p))
             z = model.sample(mu, logvar)
-            tr_, s_, p_ = model.decoder(z)
-            tr_loss = modifiedCELoss(tr_.transpose(-1, -2), tr.transpose(-1, -2), summarize=False)
-            s_loss = modifiedCELoss(s_.transpose(-1, -2), s.transpose(-1, -2), summarize=False)
-            p_loss = modifiedCELoss(p_.transpose(-1, -2), p.transpose(-1, -2), summarize=False)
-            loss = (tr_loss + s_loss + p_loss)
-            w = w.reshape(args.get('batch_size', 8))
-            loss = (w * (tr_loss + s_loss + p_loss)).sum()
+            w = w.reshape(-1)
+            loss = (w * criterion(model.decoder(z), (tr, s, p), inv_scales)).sum()
             kl = model.kl(mu, logvar)
 
             alpha = beta_sum_batch * anneal.alpha(step) if args.get('use_anneal', False) else beta_sum_batch
             elbo = loss + alpha * kl
+            # rank 0 decides when a time-based checkpoint is due, so that all ranks join it
+            ckpt_due = ckpt_seconds > 0 and is_main and time.time() - last_ckpt_time > ckpt_seconds
 
             # update parameters
             optimizer.zero_grad()
             elbo.backward()
+            if distributed:
+                allreduce_gradients(model)
+                # log the sums over the global batch
+                loss_kl = torch.stack([loss.detach(), kl.detach(), torch.tensor(float(ckpt_due))])
+                dist.all_reduce(loss_kl)
+                loss, kl, ckpt_due = loss_kl[0], loss_kl[1], bool(loss_kl[2] > 0)
+                elbo = loss + alpha * kl
             torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=args.get('clip', 20))
             optimizer.step()
 
@@ -139,14 +315,16 @@ def train_main(args):
                 print(
                     '| step {}/{} \t| loss {:.4f}\t| kl {:.4f}\t|'
                     ' elbo {:.4f}\t| alpha {:.6f}\t| {:.0f} sents/sec\t|'.format(
-                        step, DATA_SIZE // args.get('batch_size', 8),
+                        step, DATA_SIZE // global_batch_size,
                         np.mean(log['loss'][-args.get('print_every', 20):]),
                         np.mean(log['kl'][-args.get('print_every', 20):]),
                         np.mean(log['elbo'][-args.get('print_every', 20):]),
                         np.mean(log['alpha'][-1]),
-                        args.get('batch_size', 8) * args.get('print_every', 20) / timer.elapsed()
+                        global_batch_size * args.get('print_every', 20) / timer.elapsed()
                     )
                 )
+            if ckpt_due and step + 1 < len(train_dataloader):
+                checkpoint(epoch, step + 1, train_sampler.epoch_generator_state)
         return log
 
     def valid_model(log_valid):
@@ -155,20 +333,17 @@ def train_main(args):
         tmp_elbo = []
 
         for step, tr_s_p_w in enumerate(valid_dataloader, 0):
-            tr, s, p, w = tr_s_p_w
+            tr, s, p, w, inv_scales = tr_s_p_w
             tr = tr.to(model.device)
             s = s.to(model.device)
             p = p.to(model.device)
             w = w.to(model.device)
+            inv_scales = [x.to(model.device) for x in inv_scales]
 
             mu, logvar = model.encoder((tr, s, p))
             z = model.sample(mu, logvar)
-            tr_, s_, p_ = model.decoder(z)
-            tr_loss = modifiedCELoss(tr_.transpose(-1, -2), tr.transpose(-1, -2), summarize=False)
-            s_loss = modifiedCELoss(s_.transpose(-1, -2), s.transpose(-1, -2), summarize=False)
-            p_loss = modifiedCELoss(p_.transpose(-1, -2), p.transpose(-1, -2), summarize=False)
-            w = w.reshape(args.get('batch_size', 8))
-            loss = (w * (tr_loss + s_loss + p_loss)).sum()
+            w = w.reshape(-1)
+            loss = (w * criterion(model.decoder(z), (tr, s, p), inv_scales)).sum()
             kl = model.kl(mu, logvar)
             elbo = loss + beta_sum_batch * kl
 
@@ -176,6 +351,11 @@ def train_main(args):
             tmp_kl.append(kl.item())
             tmp_elbo.append(elbo.item())
 
+        if distributed:
+            # means over the global batches
+            sums = torch.tensor([np.sum(tmp_loss), np.sum(tmp_kl), np.sum(tmp_elbo)], dtype=torch.float64)
+            dist.all_reduce(sums)
+            tmp_loss, tmp_kl, tmp_elbo = [[x / len(tmp_loss)] for x in sums.tolist()]
         log_valid["loss_valid"].append(np.mean(tmp_loss))
         log_valid["kl_valid"].append(np.mean(tmp_kl))
         log_valid["elbo_valid"].append(np.mean(tmp_elbo))
@@ -220,6 +400,9 @@ def train_main(args):
             "ANNEAL_RATE": args.get('anneal_rate', 1),
             # "USE_SHUFFLE": args.get('use_shuffle', False),
             "CLIP": args.get('clip', 20),
+            "RANDOM_SEED": args.get('random_seed', 42),
+            "DATA_BACKEND": data_backend,
+            "WORLD_SIZE": world_size,
             "Z_DIM": args.get('z_dim', 16),
 
             "STRIDE": args.get('stride', 1),
@@ -233,22 +416,46 @@ def train_main(args):
             "BETA": args.get('beta', 0.001),
             "BETA_SUM": beta_sum_batch,
             "CKPT_ITER": args.get('ckpt_iter', 3),
+            "CKPT_MINUTES": args.get('ckpt_minutes', 0),
             "SUFFIX": args.get('suffix', ''),
             "LOG": args.get('log', False),
             "LOG_DIR": args.get('log_dir', ''),
             "PRINT_EVERY": args.get('print_every', 20)
         }
-        pprint(config_dict)
-        if args.get('log'):
+        if is_main:
+            pprint(config_dict)
+        if args.get('log') and is_main:
             with open(os.path.join(args['log_dir'], f"config{args.get('suffix', '')}.yaml"), "w") as f:
                 yaml.dump(config_dict, f)
 
-        for epoch in range(1, args.get('epoch', 200) + 1):
+        # resume from the training state of a previous run with the same config and data
+        use_state = bool(args.get('log_dir')) and (args.get('save_ckpt', False) or ckpt_seconds > 0)
+        data_paths = [os.path.join(args['data_dir'], args[key]) for key in ['X_train', 'w_train', 'X_valid', 'w_valid'] if args.get(key)]
+        fingerprint = config_fingerprint(config_dict, data_paths) if use_state else None
+        state = load_train_state(state_path, fingerprint) if use_state and args.get('resume', True) else None
+        start_epoch, start_step, end_epoch = 1, 0, args.get('epoch', 200)
+        if state is not None:
+            model.load_state_dict(state["model"])
+            optimizer.load_state_dict(state["optimizer"])
+            log, log_valid = state["log"], state["log_valid"]
+            train_sampler.generator.set_state(state["train_generator"])
+            if valid_dataloader:
+                valid_dataloader.sampler.generator.set_state(state["valid_generator"])
+            set_rng_states(state["rng"][rank])
+            start_epoch, start_step = state["epoch"], state["step"]
+            train_sampler.start_batch = start_step
+            if state["stopped"]:
+                end_epoch = start_epoch - 1
+            print(f"Resumed from {state_path} at epoch {start_epoch}, step {start_step}")
+
+        epoch = start_epoch - 1
+        for epoch in range(start_epoch, end_epoch + 1):
             print('-' * 90)
             print('Epoch {}/{}'.format(epoch, args.get('epoch', 200)))
             print('-' * 90)
             model.train()
-            log = train_model(log)
+            log = train_model(log, start_step)
+            start_step = 0
 
             if not args.get('only_training', False) and valid_dataset:
                 model.eval()
@@ -256,19 +463,32 @@ def train_main(args):
                     log_valid = valid_model(log_valid)
 
             # save model
-            if args.get('save_ckpt', False):
-                if epoch % args.get('ckpt_iter', 3) == 0:
-                    save_model(model, args['log_dir'], f'model_epoch{epoch}{args.get("suffix", "")}.pt')
+            epoch_ckpt = args.get('save_ckpt', False) and epoch % args.get('ckpt_iter', 3) == 0
+            if epoch_ckpt and is_main:
+                save_model(model, args['log_dir'], f'model_epoch{epoch}{args.get("suffix", "")}.pt')
 
             # early stopping
+            stopped = False
             if args.get('use_early_stopping', False) and (epoch > args.get('tolerance', 3)) and valid_dataset:
                 elbo_diff = np.diff(np.array(log_valid['elbo_valid'][-args.get('tolerance', 3) - 1:]))
-                if all(elbo_diff > 0):
-                    print(f'Early stopping at epoch {epoch}')
-                    break
+                stopped = all(elbo_diff > 0)
+
+            # the train state of the next epoch; a stopped run does not train further when rerun
+            last_epoch = stopped or epoch == args.get('epoch', 200)
+            time_ckpt = ckpt_seconds > 0 and (last_epoch or time.time() - last_ckpt_time > ckpt_seconds)
+            if distributed:
+                # the clock of rank 0 decides for all ranks
+                time_ckpt = torch.tensor(float(time_ckpt))
+                dist.broadcast(time_ckpt, 0)
+                time_ckpt = bool(time_ckpt > 0)
+            if use_state and (epoch_ckpt or time_ckpt or (last_epoch and args.get('save_ckpt', False))):
+                checkpoint(epoch + 1, 0, train_sampler.generator.get_state(), stopped)
+            if stopped:
+                print(f'Early stopping at epoch {epoch}')
+                break
 
         # save final version
-        if args.get('log'):
+        if args.get('log') and is_main:
             save_model(model, args['log_dir'], f'model_epoch{epoch}{args.get("suffix", "")}.pt')
             write_csv(log, args['log_dir'], f'log{args.get("suffix", "")}.csv')
             if not args.get('only_training', False) and valid_dataset:
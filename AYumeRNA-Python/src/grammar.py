@@ -131,6 +131,29 @@ n -> 'A' | 'U' | 'G' | 'C'
 nl_nr -> 'AA' | 'AC' | 'AG' | 'AU' | 'CA' | 'CC' | 'CG' | 'CU' | 'GA' | 'GC' | 'GG' | 'GU' | 'UA' | 'UC' | 'UG' | 'UU'
 """
 
+def _make_cm_rule_index():
+    """
+    row indices of the productions of grammar_CM in tr/s/p.
+    tr: (parent state type, child state type) -> row. B -> S S is keyed by ("B", "S") and E -> by ("E", None).
+    s : nucleotide of "n -> nuc" -> row. p: pair of "nl_nr -> pair" -> row.
+    """
+    emitters = {Nonterminal('n'), Nonterminal('nl'), Nonterminal('nr')}
+    tr_row, s_row, p_row = dict(), dict(), dict()
+    for idx, rule in enumerate(CFG.fromstring(grammar_CM).productions()):
+        lhs = rule.lhs().symbol()
+        if lhs == 'n':
+            s_row[rule.rhs()[0]] = len(s_row)
+        elif lhs == 'nl_nr':
+            p_row[rule.rhs()[0]] = len(p_row)
+        else:
+            child = [symbol.symbol() for symbol in rule.rhs() if isinstance(symbol, Nonterminal) and symbol not in emitters]
+            tr_row[(lhs, child[0] if child else None)] = idx
+    return tr_row, s_row, p_row
+
+# lookup tables of grammar_CM, so that the conversion between CM parameters and tr/s/p is integer indexing.
+CM_TR_ROW, CM_S_ROW, CM_P_ROW = _make_cm_rule_index()
+CM_N_TR, CM_N_S, CM_N_P = len(CM_TR_ROW), len(CM_S_ROW), len(CM_P_ROW)
+
 # RNAG = grammar_g3
 # GCFG = CFG.fromstring(RNAG)
 # parser = nltk.ChartParser(GCFG)
@@ -4,6 +4,8 @@ import re
 from nltk import CFG
 from collections import OrderedDict
 from collections import deque
+from functools import reduce
+from multiprocessing import Pool
 from nltk import Nonterminal
 from nltk import Production
 
@@ -24,163 +26,644 @@ import copy
 import torch
 import numpy as np
 
+SINGLE_NUCS = ['A', 'C', 'G', 'U']
+DOUBLE_NUCS = [n+m for n in SINGLE_NUCS for m in SINGLE_NUCS]
+
+# state types of the compiled CM. The index is the type code.
+STATE_TYPES = ["S", "IL", "IR", "ML", "MP", "MR", "D", "B", "E"]
+ST_S, ST_IL, ST_IR, ST_ML, ST_MP, ST_MR, ST_D, ST_B, ST_E = range(len(STATE_TYPES))
+# number of residues emitted on the left/right side by each state type.
+DELTA_L = np.array([0, 1, 0, 1, 1, 0, 0, 0, 0])
+DELTA_R = np.array([0, 0, 1, 0, 1, 1, 0, 0, 0])
+MAX_CHILDREN = 6
+# columns of a traceback (cmalign --tfile) row, without the row index.
+TRACEBACK_COLUMNS = ["emitl", "emitr", "state", "mode", "nxtl", "nxtr", "prv", "tsc", "esc"]
+TRACEBACK_SEPARATOR = b'----- ------ ------ ------- ----- ----- ----- ----- ----- -----\n'
+
+def _transition_rule(parent_type, child_type):
+    """
+    production of grammar_CM for a transition parent_type -> child_type.
+    """
+    n     = Nonterminal('n')
+    nl    = Nonterminal('nl')
+    nr    = Nonterminal('nr')
+    S     = Nonterminal('S')
+    B     = Nonterminal('B')
+    MP    = Nonterminal('MP')
+    if parent_type in {'IL', 'ML'}:
+        rule = Production(Nonterminal(parent_type), [n, '.', Nonterminal(child_type)])
+    elif parent_type in {'IR', 'MR'}:
+        rule = Production(Nonterminal(parent_type), [Nonterminal(child_type), '.', n])
+    elif parent_type == 'MP':
+        rule = Production(MP, [nl, '(', Nonterminal(child_type), ')', nr])
+    elif parent_type in {'S', 'D'}:
+        rule = Production(Nonterminal(parent_type), [Nonterminal(child_type)])
+    elif parent_type == 'B':
+        rule = Production(B, [S, S])
+    elif parent_type == 'E':
+        rule = Production(Nonterminal("E"), [])
+    else:
+        raise Exception(f"Unidentified parent_state_type: {parent_type}")
+    return rule
+
+# s has a column per rule "n -> nuc" of grammar_CM (A, U, G, C). S_COLUMNS[j] is the SINGLE_NUCS index of column j.
+S_COLUMNS = [SINGLE_NUCS.index(nuc) for nuc in sorted(grammar.CM_S_ROW, key = grammar.CM_S_ROW.get)]
+
+
+def _logsumexp(a, axis):
+    """
+    log(sum(exp(a))) along axis. -inf when all the terms are -inf.
+    """
+    m = np.max(a, axis = axis, keepdims = True)
+    m = np.where(np.isfinite(m), m, 0)
+    with np.errstate(divide = "ignore"):
+        return np.log(np.sum(np.exp(a - m), axis = axis)) + np.squeeze(m, axis = axis)
 
-class CovarianceModel:
+
+class CompiledCM:
+    """
+    Array-backed covariance model compiled from a derivation dict.
+    State ids follow the order of the derivation dict (= state numbers in the cm file).
+
+    topology:
+        state_names   : state name of each id
+        state_type    : (M,) type code, index of STATE_TYPES
+        node_names    : node name of each node index
+        node_of_state : (M,) node index of each state
+        child_offsets : (M+1,) CSR offsets of the children of a state in child_ids
+        child_ids     : (n_trans,) child state ids
+        children      : (M, MAX_CHILDREN) dense view of the CSR arrays, padded with -1
+        single_states : ids of IL/IR/ML/MR states, i.e. the rows of s
+        pair_states   : ids of MP states, i.e. the rows of p
+    parameters:
+        trans         : (M, MAX_CHILDREN) transition probs aligned with `children`, padded with 0
+        emit_single   : (M, 4)  emission probs in the order of SINGLE_NUCS
+        emit_pair     : (M, 16) emission probs in the order of DOUBLE_NUCS
+    Models of the same CM share the topology. Use `with_params` to swap the parameters.
+    """
     def __init__(self, deriv_dict):
-        self.deriv_dict = deriv_dict
-        # remove node info
-        self._trans_prob_dict = {}
-        for k,v in self.deriv_dict.items():
-            self._trans_prob_dict.update(v)
-
-    def cmemit(self, n=1, sample = False):
-        outputs = []
-        for _ in range(n):
-            seq_ss        = "S_0"
-            current_state = "S_0"
-            # When "E-> ",
-            # 1: next node == END  ---> next_state = None and break
-            # 2: next node == BEGL ---> pop next_state from bif_stack
-            self._bif_stack = deque()
-            ins_loop_counter = 0
-            break_ins = False
-            while current_state != None:
-                rhs, next_state, probs_trans = self._fetch_rule_and_next(current_state, sample, break_ins = break_ins)
-                break_ins = False
-                if current_state == next_state:
-                    ins_loop_counter += 1
-                    if ins_loop_counter == int(1/(1-probs_trans)):
-                        break_ins = True                        
-                        ins_loop_counter = 0
-                seq_ss          = seq_ss.replace(current_state, rhs, 1)
-                current_state   = next_state
-                
-            seq_ss = re.sub(r"(\s|-)", "", seq_ss)
-            outputs.append((seq_ss[0::2], seq_ss[1::2]))
-        return outputs
-    
-    def _fetch_rule_and_next(self, current_state, sample, break_ins = False):
+        self.node_names  = list(deriv_dict.keys())
+        self.state_names = [state for states in deriv_dict.values() for state in states]
+        self.state_index = {state:i for i, state in enumerate(self.state_names)}
+        M = len(self.state_names)
+
+        self.state_type    = np.empty(M, dtype=np.int8)
+        self.node_of_state = np.empty(M, dtype=np.int32)
+        self.children      = np.full((M, MAX_CHILDREN), -1, dtype=np.int32)
+        n_children         = np.zeros(M, dtype=np.int32)
+        v = 0
+        for node_i, states in enumerate(deriv_dict.values()):
+            for state, trans_emit in states.items():
+                self.state_type[v]    = STATE_TYPES.index(state.split("_")[0])
+                self.node_of_state[v] = node_i
+                child_states          = list(trans_emit["trans"].keys())
+                n_children[v]         = len(child_states)
+                self.children[v, :len(child_states)] = [self.state_index[c] for c in child_states]
+                v += 1
+
+        self.child_offsets = np.concatenate([[0], np.cumsum(n_children)]).astype(np.int32)
+        self.child_ids     = self.children[self.children >= 0]
+        self.single_states = np.where(np.isin(self.state_type, [ST_IL, ST_IR, ST_ML, ST_MR]))[0]
+        self.pair_states   = np.where(self.state_type == ST_MP)[0]
+
+        # (node, tr column) of every transition. For B, both children share "B -> S S".
+        edge_node, edge_col = [], []
+        for v in range(M):
+            parent_type = STATE_TYPES[self.state_type[v]]
+            for k in range(n_children[v]):
+                edge_node.append(self.node_of_state[v])
+                edge_col.append(grammar.CM_TR_ROW[(parent_type, STATE_TYPES[self.state_type[self.children[v, k]]])])
+        self._edge_node = np.array(edge_node, dtype=np.int64)
+        self._edge_col  = np.array(edge_col, dtype=np.int64)
+        self._edge_flat = np.where(self.children.reshape(-1) >= 0)[0]
+        # when a tr cell is written twice, the later value wins as in make_trsp_from_deriv_dict.
+        last = {(r, c):i for i, (r, c) in enumerate(zip(edge_node, edge_col))}
+        self._edge_keep = np.array(sorted(last.values()), dtype=np.int64)
+        self._end_node  = self.node_of_state[self.state_type == ST_E]
+
+        self.trans, self.emit_single, self.emit_pair = self.params_from_deriv_dict(deriv_dict)
+
+    @property
+    def n_states(self):
+        return len(self.state_names)
+
+    @property
+    def n_nodes(self):
+        return len(self.node_names)
+
+    def with_params(self, trans, emit_single, emit_pair):
         """
-        current_state : Lefthand state.
-        sample        : How to determine a next state. True means random. 
-        break_ins     : Flag of escapeing from endless looping of an insertion state. If True, break from while. 
+        shallow copy sharing the topology arrays, with new parameters.
         """
-        trans_emit_from_current_node = self._trans_prob_dict[current_state]
-        child_states, probs_trans    = list(trans_emit_from_current_node["trans"].keys()), list(trans_emit_from_current_node["trans"].values())
-        
-        # 1 or 2, no child state
-        if child_states == []:
-            next_state = self._bif_stack.pop() if len(self._bif_stack) != 0 else None
-            return "--", next_state, 0
-        
-        # child states exist. determine the right hand side(rhs).
-        else:
-            prob_trans_sum = sum(probs_trans)
-            # determine next state
+        new = copy.copy(self)
+        new.trans, new.emit_single, new.emit_pair = trans, emit_single, emit_pair
+        return new
+
+    def params_from_deriv_dict(self, deriv_dict):
+        """
+        (trans, emit_single, emit_pair) of a derivation dict with the same topology.
+        """
+        M           = self.n_states
+        trans       = np.zeros((M, MAX_CHILDREN))
+        emit_single = np.zeros((M, 4))
+        emit_pair   = np.zeros((M, 16))
+        v = 0
+        for states in deriv_dict.values():
+            for trans_emit in states.values():
+                trans[v, :len(trans_emit["trans"])] = list(trans_emit["trans"].values())
+                if self.state_type[v] == ST_MP:
+                    emit_pair[v]   = [trans_emit["emit"][nuc] for nuc in DOUBLE_NUCS]
+                elif trans_emit["emit"]:
+                    emit_single[v] = [trans_emit["emit"][nuc] for nuc in SINGLE_NUCS]
+                v += 1
+        return trans, emit_single, emit_pair
+
+    def to_deriv_dict(self):
+        deriv_dict = OrderedDict()
+        trans, emit_single, emit_pair = self.trans.tolist(), self.emit_single.tolist(), self.emit_pair.tolist()
+        for v, state in enumerate(self.state_names):
+            node = self.node_names[self.node_of_state[v]]
+            if node not in deriv_dict:
+                deriv_dict[node] = OrderedDict()
+            n_child = self.child_offsets[v+1] - self.child_offsets[v]
+            prob_trans = OrderedDict(
+                (self.state_names[c], trans[v][k]) for k, c in enumerate(self.children[v, :n_child])
+                )
+            if self.state_type[v] == ST_MP:
+                prob_emit = dict(zip(DOUBLE_NUCS, emit_pair[v]))
+            elif self.state_type[v] in (ST_IL, ST_IR, ST_ML, ST_MR):
+                prob_emit = dict(zip(SINGLE_NUCS, emit_single[v]))
+            else:
+                prob_emit = {}
+            deriv_dict[node][state] = {"trans":prob_trans, "emit":prob_emit}
+        return deriv_dict
+
+    def to_trsp(self):
+        """
+        tr (n_nodes, 56), s (n_single, 4), p (n_pair, 16) of the parameters.
+        tr is nan where the node has no such rule. see `make_trsp_from_deriv_dict`.
+        """
+        keep = self._edge_keep
+        tr = np.full((self.n_nodes, grammar.CM_N_TR), np.nan)
+        tr[self._edge_node[keep], self._edge_col[keep]] = self.trans.reshape(-1)[self._edge_flat[keep]]
+        tr[self._end_node, grammar.CM_TR_ROW[("E", None)]] = 1
+        s  = self.emit_single[self.single_states][:, S_COLUMNS]
+        p  = self.emit_pair[self.pair_states]
+        return tr, s, p
+
+    def params_from_trsp(self, tr, s, p):
+        """
+        inverse of `to_trsp` for decoder outputs, tr (..., 56, n_nodes), s (..., 4, n_single), p (..., 16, n_pair).
+        Leading batch dimensions are kept: the outputs are (..., n_states, MAX_CHILDREN), (..., n_states, 4), (..., n_states, 16).
+        Transitions are normalized so that they sum to 1 for each state.
+        """
+        batch = tr.shape[:-2]
+        trans = np.zeros((*batch, self.n_states, MAX_CHILDREN), dtype=tr.dtype)
+        trans.reshape(*batch, -1)[..., self._edge_flat] = tr[..., self._edge_col, self._edge_node]
+        with np.errstate(invalid="ignore"):
+            trans = trans / trans.sum(axis=-1, keepdims=True)
+        trans[..., self.state_type == ST_E, :] = 0
+
+        emit_single = np.zeros((*batch, self.n_states, 4), dtype=s.dtype)
+        emit_single[..., self.single_states, :] = np.swapaxes(s[..., np.argsort(S_COLUMNS), :], -1, -2)
+        emit_pair   = np.zeros((*batch, self.n_states, 16), dtype=p.dtype)
+        emit_pair[..., self.pair_states, :] = np.swapaxes(p, -1, -2)
+        return trans, emit_single, emit_pair
+
+
+class CovarianceModel:
+    def __init__(self, deriv_dict, compiled = None):
+        """
+        deriv_dict: derivation dict (see `CMReader.load_derivation_dict_from_cmfile`)
+        compiled  : CompiledCM of deriv_dict if already available. Then deriv_dict may be None.
+        """
+        self._deriv_dict = deriv_dict
+        self.compiled    = compiled if compiled is not None else CompiledCM(deriv_dict)
+        self._emit_tables = None
+        self._log_tables  = None
+        self._bands       = dict()
+
+    @property
+    def deriv_dict(self):
+        if self._deriv_dict is None:
+            self._deriv_dict = self.compiled.to_deriv_dict()
+        return self._deriv_dict
+
+    def cmemit(self, n=1, sample = False, rng = None):
+        """
+        emit n (sequence, structure) pairs.
+        sample: True draws states and residues at random, False follows the most probable ones.
+                The deterministic path is the same for all n, so it is computed once.
+        rng   : seed or np.random.Generator used when sample is True.
+        """
+        if not sample:
+            return self._emit_batch(1, sample = False, rng = None) * n
+        return self._emit_batch(n, sample = True, rng = np.random.default_rng(rng))
+
+    def _emission_tables(self):
+        """
+        per-state tables for `_emit_batch`, built once per model.
+        """
+        if self._emit_tables is None:
+            cm = self.compiled
+            n_child = np.diff(cm.child_offsets)
+            padded  = np.arange(MAX_CHILDREN)[None, :] >= n_child[:, None]
+            with np.errstate(invalid = "ignore", divide = "ignore"):
+                # categorical draws: index = number of cdf entries <= u
+                trans_cdf = np.cumsum(cm.trans, axis = -1) / cm.trans.sum(axis = -1, keepdims = True)
+                trans_cdf[padded] = np.inf
+                trans_cdf[np.where(n_child > 0)[0], n_child[n_child > 0]-1] = np.inf
+                single_cdf = np.cumsum(cm.emit_single, axis = -1) / cm.emit_single.sum(axis = -1, keepdims = True)
+                pair_cdf   = np.cumsum(cm.emit_pair, axis = -1) / cm.emit_pair.sum(axis = -1, keepdims = True)
+                single_cdf[:, -1] = np.inf
+                pair_cdf[:, -1]   = np.inf
+
+                # deterministic path. An insertion state escapes from its loop with the 2nd best child
+                # after int(1/(1-max prob)) self transitions.
+                masked   = np.where(padded, -np.inf, cm.trans)
+                best     = masked.argmax(axis = -1)
+                max_prob = masked.max(axis = -1)
+                second   = np.sort(masked, axis = -1)[:, -2] if MAX_CHILDREN > 1 else max_prob
+                second_k = (masked == second[:, None]).argmax(axis = -1)
+                second_k = np.where(cm.children[np.arange(cm.n_states), second_k] == np.arange(cm.n_states), second_k+1, second_k)
+                second_k = np.where(n_child >= 2, second_k, best)
+                loop_max = 1/(1 - max_prob)
+                loop_max = np.where(np.isfinite(loop_max), loop_max, np.iinfo(np.int64).max).astype(np.int64)
+
+            self._emit_tables = {
+                "trans_cdf":trans_cdf, "single_cdf":single_cdf, "pair_cdf":pair_cdf,
+                "best_k":best, "second_k":second_k, "loop_max":loop_max,
+                "best_single":cm.emit_single.argmax(axis = -1), "best_pair":cm.emit_pair.argmax(axis = -1),
+            }
+        return self._emit_tables
+
+    def _emit_batch(self, n, sample, rng):
+        """
+        advance n trajectories together. Draws of a step are vectorized over the trajectories.
+        Bifurcations keep the right S state on a per-trajectory stack, as cmemit always did.
+        """
+        cm      = self.compiled
+        tables  = self._emission_tables()
+        current = np.zeros(n, dtype = np.int64)
+        alive   = np.ones(n, dtype = bool)
+        counter = np.zeros(n, dtype = np.int64)
+        break_ins = np.zeros(n, dtype = bool)
+        bif_stacks = [deque() for _ in range(n)]
+        # log of (trajectory, state, emission) of the alive trajectories at each step.
+        traj_log, state_log, emit_log = [], [], []
+
+        while alive.any():
+            idx = np.where(alive)[0]
+            v   = current[idx]
+            state_type = cm.state_type[v]
+
+            # emission
+            emit = np.full(len(idx), -1, dtype = np.int64)
+            is_single = np.isin(state_type, (ST_IL, ST_IR, ST_ML, ST_MR))
+            is_pair   = state_type == ST_MP
             if sample:
-                next_state = np.random.choice(child_states, 1, p = np.array(probs_trans)/prob_trans_sum)[0]
-            
-            else: # fetch in a deterministic way
-                if break_ins: # escape from ins loop
-                    prob_2nd = sorted(probs_trans, reverse=True)[1] #2nd max
-                    next_state = child_states[probs_trans.index(prob_2nd)] #
+                u = rng.random(len(idx))
+                emit[is_single] = (tables["single_cdf"][v[is_single]] <= u[is_single, None]).sum(axis = -1)
+                emit[is_pair]   = (tables["pair_cdf"][v[is_pair]] <= u[is_pair, None]).sum(axis = -1)
+            else:
+                emit[is_single] = tables["best_single"][v[is_single]]
+                emit[is_pair]   = tables["best_pair"][v[is_pair]]
+            traj_log.append(idx)
+            state_log.append(v)
+            emit_log.append(emit)
 
-                    if current_state == next_state: #exception in case that several top probs
-                        next_state = child_states[probs_trans.index(prob_2nd)+1]
-                else:
-                    next_state = child_states[np.array(probs_trans).argmax()]
-            
-            # processing next state,emission and the following processing
-            if re.match(r"(D|S)_.*", current_state):  # deletion | start
-                rhs             = " ".join([next_state])
-            elif re.match(r"B_.*", current_state):  # bif
-                child_states = list(self._trans_prob_dict[current_state]["trans"].keys())
-                for bif in child_states[::-1]:
-                    self._bif_stack.append(bif)
-                rhs        = " ".join([child_state for child_state in child_states])
-                next_state = self._bif_stack.pop()
-            else: 
-                emit_nucs, probs_emit = list(trans_emit_from_current_node["emit"].keys()), list(trans_emit_from_current_node["emit"].values())
-                if sample:
-                    emit = np.random.choice(emit_nucs, 1, p = np.array(probs_emit)/sum(probs_emit))[0]
+            # transition
+            if sample:
+                k = (tables["trans_cdf"][v] <= rng.random(len(idx))[:, None]).sum(axis = -1)
+            else:
+                k = np.where(break_ins[idx], tables["second_k"][v], tables["best_k"][v])
+            next_state = cm.children[v, np.minimum(k, MAX_CHILDREN-1)].astype(np.int64)
+
+            if not sample:
+                loop = next_state == v
+                counter[idx] += loop
+                escape = loop & (counter[idx] == tables["loop_max"][v])
+                break_ins[idx] = escape
+                counter[idx[escape]] = 0
+
+            for j in np.where((state_type == ST_B) | (state_type == ST_E))[0]:
+                stack = bif_stacks[idx[j]]
+                if state_type[j] == ST_B:
+                    stack.append(cm.children[v[j], 1])
+                    next_state[j] = cm.children[v[j], 0]
+                elif len(stack) != 0:
+                    next_state[j] = stack.pop()
                 else:
-                    emit = emit_nucs[np.array(probs_emit).argmax()]
-                    
-                if re.match(r".*R_", current_state):   rhs = " ".join([next_state, emit, "."])
-                elif re.match(r".*L_", current_state): rhs = " ".join([emit, ".", next_state])
-                elif re.match(r".*P_", current_state): rhs = " ".join([emit[0], "(", next_state, emit[1], ")"])
-                else: Exception(f"Unrecognized state: {current_state}")
-
-            return rhs, next_state, max(probs_trans)
+                    alive[idx[j]] = False
+            current[idx] = next_state
+
+        # group the log by trajectory, keeping the step order.
+        traj_log = np.concatenate(traj_log)
+        order    = np.argsort(traj_log, kind = "stable")
+        bounds   = np.searchsorted(traj_log[order], np.arange(n+1))
+        state_log, emit_log = np.concatenate(state_log)[order], np.concatenate(emit_log)[order]
+        return [
+            self._assemble_seq_ss(state_log[bounds[i]:bounds[i+1]], emit_log[bounds[i]:bounds[i+1]]) for i in range(n)
+            ]
+
+    def _assemble_seq_ss(self, states, emits):
+        """
+        (sequence, structure) of a trajectory. Right emissions wait on a stack until the subtree ends.
+        """
+        state_type = self.compiled.state_type
+        out, closing = [], []
+        MARK = None
+        for v, e in zip(states.tolist(), emits.tolist()):
+            t = state_type[v]
+            if   t in (ST_IL, ST_ML): out.append((SINGLE_NUCS[e], "."))
+            elif t in (ST_IR, ST_MR): closing.append((SINGLE_NUCS[e], "."))
+            elif t == ST_MP:
+                out.append((DOUBLE_NUCS[e][0], "("))
+                closing.append((DOUBLE_NUCS[e][1], ")"))
+            elif t == ST_B:
+                closing.append(MARK)
+            elif t == ST_E:
+                while len(closing) != 0:
+                    token = closing.pop()
+                    if token is MARK:
+                        break
+                    out.append(token)
+        seq = "".join(nuc for nuc, _ in out)
+        ss  = "".join(c for _, c in out)
+        return (seq, ss)
+
+    def _log_params(self):
+        """
+        log of the parameters for `cmeval`, built once per model.
+        """
+        if self._log_tables is None:
+            cm = self.compiled
+            with np.errstate(divide = "ignore"):
+                self._log_tables = (np.log(cm.trans), np.log(cm.emit_single), np.log(cm.emit_pair))
+        return self._log_tables
 
-    def cmeval(self, seq):
+    def cmeval(self, seq, tau = None):
         """
-        inside algorithm of covariance model.
-        should i name "forward"?
+        log-likelihood (natural log) of seq under the CM by the inside algorithm.
         see: "Biological Sequence Analysis", p286
-        TODO: use logsumexp and scaling
+        tau: if given, only the cells inside the query-dependent bands of `compute_bands` are filled.
+             `compute_bands(len(seq), tau)["dropped_mass"][0]` is the prior mass the bands exclude.
         """
-        L = len(seq)
-        M = len(self._trans_prob_dict)
-        a = torch.zeros(M, L+2, L+2)
+        x = np.array([SINGLE_NUCS.index(nuc) for nuc in seq.upper().replace("T", "U")], dtype = np.int64)
+        bands = self.compute_bands(len(x), tau) if tau is not None else None
+        return self._root_score(self._inside(x, bands), len(x), bands)
 
-        state2index = self._get_state2index()
-        DeltaL = {"P":1, "L":1, "D":0, "S":0, "B":0, "E":0, "R":0,}
-        DeltaR = {"P":1, "R":1, "D":0, "S":0, "B":0, "E":0, "L":0,}
-
-        # initialization
-        for j in range(0, L+1):
-            for state in list(self._trans_prob_dict.keys())[::-1]:
-                if self._get_statetype(state) == "E":
-                    a[state2index[state]][j+1, j] = 1
+    def score_many(self, seqs, tau = None, cpu = 1):
+        """
+        bit scores of many sequences: log2 of P(seq | CM) / P(seq | null), with the uniform null model
+        of the cm file (0.25 per residue), so that they are on the scale of GA/TC/NC of `CMReader`.
+        These are global inside scores without the null3 correction of cmsearch, so compare with care.
 
-                elif self._get_statetype(state) in "SD":
-                    for child_state, trans_prob in self._trans_prob_dict[state]["trans"].items():
-                        a[state2index[state]][j+1, j] += trans_prob * a[state2index[child_state]][j+1, j]
+        Sequences are bucketed by length. A bucket shares the bands and the DP buffers.
+        cpu > 1 scores buckets in a process pool whose workers receive the compiled CM once.
+        returns np.array of the scores in the order of seqs.
+        """
+        buckets = dict()
+        for idx, seq in enumerate(seqs):
+            buckets.setdefault(len(seq), []).append(idx)
+        jobs = [(idx, [seqs[i] for i in idx], tau) for idx in buckets.values()]
+        # long buckets first for load balancing
+        jobs.sort(key = lambda job: -len(job[1][0])*len(job[1][0])*len(job[1]))
+
+        scores = np.empty(len(seqs))
+        if cpu > 1:
+            with Pool(cpu, initializer = _init_score_worker, initargs = (self.compiled,)) as p:
+                results = p.map(_score_bucket, jobs)
+        else:
+            results = [self._score_bucket(*job) for job in jobs]
+        for idx, bucket_scores in results:
+            scores[idx] = bucket_scores
+        return scores
+
+    def _score_bucket(self, idx, seqs, tau):
+        L       = len(seqs[0])
+        bands   = self.compute_bands(L, tau) if tau is not None else None
+        buffers = self._dp_buffers(L, bands)
+        scores  = []
+        for seq in seqs:
+            x = np.array([SINGLE_NUCS.index(nuc) for nuc in seq.upper().replace("T", "U")], dtype = np.int64)
+            loglik = self._root_score(self._inside(x, bands, buffers = buffers), L, bands)
+            scores.append((loglik - L*np.log(0.25))/np.log(2))
+        return idx, scores
+
+    def _dp_buffers(self, L, bands):
+        M    = self.compiled.n_states
+        dmin = bands["dmin"] if bands is not None else np.zeros(M, dtype = np.int64)
+        dmax = bands["dmax"] if bands is not None else np.full(M, L, dtype = np.int64)
+        return [np.empty((L+1, max(dmax[v] - dmin[v] + 1, 0))) for v in range(M)]
+
+    def compute_bands(self, max_length, tau = 1e-7):
+        """
+        query-dependent bands of subsequence lengths (QDB, Nawrocki & Eddy, PLoS Comput Biol 2007).
+        gamma[v, d] is the prior probability that the subtree of v generates d residues, from the
+        transition probabilities only. The band [dmin[v], dmax[v]] drops at most tau/2 of gamma[v] on each side.
 
-                elif self._get_statetype(state) == "B":
-                    child_bif1, child_bif2 = self._trans_prob_dict[state]["trans"].keys()
-                    a[state2index[state]][j+1, j] = a[state2index[child_bif1]][j+1, j] * a[state2index[child_bif2]][j+1, j]
-                
-                elif self._get_statetype(state) in "PRL":
-                    pass
+        returns dict of
+            dmin, dmax  : (M,) bands, clipped to [0, max_length]
+            dropped_mass: (M,) prior mass of d <= max_length outside the band of each state
+        """
+        if (max_length, tau) in self._bands:
+            return self._bands[(max_length, tau)]
+        cm      = self.compiled
+        D       = max_length
+        n_child = np.diff(cm.child_offsets)
+        # renormalized so that rounding in the cm file does not make the total mass exceed 1
+        with np.errstate(invalid = "ignore"):
+            trans = cm.trans / cm.trans.sum(axis = -1, keepdims = True)
+        gamma   = np.zeros((cm.n_states, D+1))
+        for v in range(cm.n_states-1, -1, -1):
+            state_type = cm.state_type[v]
+            if state_type == ST_E:
+                gamma[v, 0] = 1
+                continue
+            if state_type == ST_B:
+                gamma[v] = np.convolve(gamma[cm.children[v, 0]], gamma[cm.children[v, 1]])[:D+1]
+                continue
+            shift, self_loop = DELTA_L[state_type] + DELTA_R[state_type], 0.
+            for k in range(n_child[v]):
+                child = cm.children[v, k]
+                if child == v:
+                    self_loop = trans[v, k]
+                elif shift <= D:
+                    gamma[v, shift:] += trans[v, k] * gamma[child, :D+1-shift]
+            if self_loop > 0:
+                for d in range(shift, D+1):
+                    gamma[v, d] += self_loop * gamma[v, d-shift]
+
+        cdf  = np.cumsum(gamma, axis = -1)
+        dmin = (cdf <= tau/2).sum(axis = -1)
+        right_ok = 1 - cdf <= tau/2
+        dmax = np.where(right_ok.any(axis = -1), right_ok.argmax(axis = -1), D)
+        states  = np.arange(cm.n_states)
+        kept    = cdf[states, dmax] - np.where(dmin > 0, cdf[states, np.maximum(dmin-1, 0)], 0)
+        dropped = cdf[:, -1] - np.where(dmin <= dmax, kept, 0)
+        self._bands[(max_length, tau)] = {"dmin":dmin, "dmax":dmax, "dropped_mass":dropped}
+        return self._bands[(max_length, tau)]
+
+    def _root_score(self, alpha, L, bands):
+        dmin = bands["dmin"][0] if bands is not None else 0
+        dmax = bands["dmax"][0] if bands is not None else L
+        return float(alpha[0][0, L - dmin]) if dmin <= L <= dmax else -np.inf
+
+    def cyk(self, seq, tau = None):
+        """
+        best parse of seq (CYK, max instead of sum in `cmeval`) in global mode.
+        returns (log prob of the parse, parse), where parse is the list of (state id, i, d) visited
+        in the order of a cmalign parsetree: state v generates seq[i:i+d], left subtree of a bifurcation first.
+        see `make_tbdf_from_parse` for the traceback table.
+        """
+        x = np.array([SINGLE_NUCS.index(nuc) for nuc in seq.upper().replace("T", "U")], dtype = np.int64)
+        L = len(x)
+        bands = self.compute_bands(L, tau) if tau is not None else None
+        alpha, choice = self._inside(x, bands, cyk = True)
+        score = self._root_score(alpha, L, bands)
+        if score == -np.inf:
+            raise ValueError("No parse of the sequence under the CM (within the bands).")
+
+        cm    = self.compiled
+        dmin  = bands["dmin"] if bands is not None else np.zeros(cm.n_states, dtype = np.int64)
+        parse = []
+        stack = [(0, 0, L)]
+        while len(stack) != 0:
+            v, i, d = map(int, stack.pop())
+            parse.append((v, i, d))
+            state_type = cm.state_type[v]
+            if state_type == ST_E:
+                continue
+            best = choice[v][i, d - dmin[v]]
+            if state_type == ST_B:
+                stack.append((cm.children[v, 1], i + best, d - best))
+                stack.append((cm.children[v, 0], i, best))
+            else:
+                dl, dr = DELTA_L[state_type], DELTA_R[state_type]
+                stack.append((cm.children[v, best], i + dl, d - dl - dr))
+        return score, parse
 
-        # recursion
-        for j in range(1, L+1):
-            for i in range(j, 0, -1):
-                for state in list(self._trans_prob_dict.keys())[::-1]:
-                    if   self._get_statetype(state) == "E": pass
+    def make_tbdf_from_parse(self, seq, parse):
+        """
+        traceback table of a parse, in the layout `TracebackFileReader` reads from cmalign --tfile.
+        emitl/emitr are 1-based positions, followed by the residue if the state emits it.
+        tsc/esc are in bits.
+        """
+        cm = self.compiled
+        log_trans, log_single, log_pair = self._log_params()
+        seq  = seq.upper().replace("T", "U")
+        # row index of the parent and of the children of each row
+        prv, nxtl, nxtr = [-1]*len(parse), [-1]*len(parse), [-1]*len(parse)
+        parents = []
+        for row_i, (v, i, d) in enumerate(parse):
+            if len(parents) != 0:
+                parent_i = parents.pop()
+                prv[row_i] = parent_i
+                if nxtl[parent_i] == -1: nxtl[parent_i] = row_i
+                else:                    nxtr[parent_i] = row_i
+            state_type = cm.state_type[v]
+            if state_type == ST_B:
+                parents.extend([row_i, row_i])
+            elif state_type != ST_E:
+                parents.append(row_i)
+
+        rows = []
+        for row_i, (v, i, d) in enumerate(parse):
+            state_type = cm.state_type[v]
+            syml = seq[i]     if state_type in (ST_IL, ST_ML, ST_MP) else ""
+            symr = seq[i+d-1] if state_type in (ST_IR, ST_MR, ST_MP) else ""
+            if state_type in (ST_E, ST_B):
+                tsc = "-"
+            else:
+                k   = list(cm.children[v]).index(parse[nxtl[row_i]][0])
+                tsc = f"{log_trans[v, k]/np.log(2):.2f}"
+            if   syml and symr: esc = f"{(log_pair[v, DOUBLE_NUCS.index(syml+symr)] + np.log(16))/np.log(2):.2f}"
+            elif syml or symr:  esc = f"{(log_single[v, SINGLE_NUCS.index(syml+symr)] + np.log(4))/np.log(2):.2f}"
+            else:               esc = "-"
+            rows.append([
+                f"{i+1}{syml}", f"{i+d}{symr}", f"{v}{STATE_TYPES[state_type]}", "J",
+                str(nxtl[row_i]), str(nxtr[row_i]), str(prv[row_i]), tsc, esc
+                ])
+        return pd.DataFrame(rows, columns = TRACEBACK_COLUMNS)
+
+    def _inside(self, x, bands = None, cyk = False, buffers = None):
+        """
+        alpha[v][i, d - dmin[v]]: log prob that state v generates x[i:i+d], for d in the band of v
+        (all of 0..L without bands).
+        Each diagonal d is computed at once over all start positions i.
+        States are visited from the last one since children have larger ids (or d-1 for insertions).
+        cyk: take the max over children (split points for B) instead of the sum.
+             Then also returns choice[v][i, d - dmin[v]], the best child index (split point for B).
+        buffers: alpha arrays of `_dp_buffers` for the same length and bands, reused instead of allocated.
+        """
+        cm = self.compiled
+        log_trans, log_single, log_pair = self._log_params()
+        L, M    = len(x), cm.n_states
+        n_child = np.diff(cm.child_offsets)
+        dmin    = bands["dmin"] if bands is not None else np.zeros(M, dtype = np.int64)
+        dmax    = bands["dmax"] if bands is not None else np.full(M, L, dtype = np.int64)
+        alpha   = buffers if buffers is not None else self._dp_buffers(L, bands)
+        for a in alpha:
+            a.fill(-np.inf)
+        choice  = [np.full((L+1, max(dmax[v] - dmin[v] + 1, 0)), -1, dtype = np.int32) for v in range(M)] if cyk else None
+
+        for d in range(L+1):
+            n_i = L-d+1
+            i   = np.arange(n_i)
+            for v in np.where((dmin <= d) & (d <= dmax))[0][::-1]:
+                state_type = cm.state_type[v]
+                if state_type == ST_E:
+                    if d == 0:
+                        alpha[v][:, 0] = 0
+                    continue
+
+                if state_type == ST_B:
+                    # split x[i:i+d] into x[i:i+k] and x[i+k:i+d], k in the bands of both children
+                    left, right = cm.children[v, 0], cm.children[v, 1]
+                    k = np.arange(max(dmin[left], d - dmax[right]), min(dmax[left], d - dmin[right]) + 1)[None, :]
+                    if k.size == 0:
+                        continue
+                    scores = alpha[left][i[:, None], k - dmin[left]] + alpha[right][i[:, None] + k, d - k - dmin[right]]
+                    if cyk:
+                        best = scores.argmax(axis = -1)
+                        alpha[v][i, d - dmin[v]]  = scores[i, best]
+                        choice[v][i, d - dmin[v]] = k[0, best]
+                    else:
+                        alpha[v][i, d - dmin[v]] = _logsumexp(scores, axis = -1)
+                    continue
+
+                dl, dr = DELTA_L[state_type], DELTA_R[state_type]
+                d_child = d - dl - dr
+                ks = [k for k, child in enumerate(cm.children[v, :n_child[v]]) if dmin[child] <= d_child <= dmax[child]]
+                if len(ks) == 0:
+                    continue
+                terms = [log_trans[v, k] + alpha[cm.children[v, k]][dl:dl+n_i, d_child - dmin[cm.children[v, k]]] for k in ks]
+                if cyk:
+                    terms = np.stack(terms)
+                    best  = terms.argmax(axis = 0)
+                    score = terms[best, i]
+                    choice[v][:n_i, d - dmin[v]] = np.array(ks)[best]
+                else:
+                    score = reduce(np.logaddexp, terms)
 
-                    elif self._get_statetype(state) == "P" and i == j: pass
+                if   state_type in (ST_IL, ST_ML): score = score + log_single[v, x[:n_i]]
+                elif state_type in (ST_IR, ST_MR): score = score + log_single[v, x[d-1:]]
+                elif state_type == ST_MP:          score = score + log_pair[v, 4*x[:n_i] + x[d-1:]]
+                alpha[v][:n_i, d - dmin[v]] = score
 
-                    elif self._get_statetype(state) == "B":
-                        child_bif1, child_bif2 = self._trans_prob_dict[state]["trans"].keys()
-                        for k in range(i-1, j+1):
-                            a[state2index[state]][i][j] +=\
-                                a[state2index[child_bif1]][i, k] * a[state2index[child_bif2]][k+1, j]
+        return (alpha, choice) if cyk else alpha
 
-                    else:
-                        if   self._get_statetype(state) == "L": emit_prob = self._trans_prob_dict[state]["emit"][seq[i-1]]
-                        elif self._get_statetype(state) == "R": emit_prob = self._trans_prob_dict[state]["emit"][seq[j-1]]
-                        elif self._get_statetype(state) == "P": emit_prob = self._trans_prob_dict[state]["emit"][seq[i-1] + seq[j-1]]
-                        else:                                   emit_prob = 1.
-                        
-                        for child_state, trans_prob in self._trans_prob_dict[state]["trans"].items():
-                            a[state2index[state]][i][j] += \
-                                emit_prob *\
-                                trans_prob *\
-                                a[state2index[child_state]]\
-                                    [i + DeltaL[self._get_statetype(state)],\
-                                     j - DeltaR[self._get_statetype(state)]]
 
-        return a[0][1,L]
+# CM of the workers of `CovarianceModel.score_many`
+_SCORE_WORKER_CM = None
 
-    def _get_state2index(self):
-        d = dict(enumerate(self._trans_prob_dict.keys()))
-        return {v:k for k,v in d.items()}
+def _init_score_worker(compiled):
+    global _SCORE_WORKER_CM
+    _SCORE_WORKER_CM = CovarianceModel(None, compiled)
 
-    def _get_statetype(self, state_name):
-        return state_name.split("_")[0][-1]
+def _score_bucket(job):
+    return _SCORE_WORKER_CM._score_bucket(*job)
 
 
 class CMReader:
@@ -204,24 +687,51 @@ class CMReader:
 
         self.grammar = grammar.grammar_CM
         self.cfg = CFG.fromstring(self.grammar)
+        self._cm_block = None
 
     def _num_to_state(self):
-        num_to_state= dict()
-        flag = False
+        num_to_state, _, _ = self._parse_cm_block()
+        return num_to_state
+
+    def _parse_cm_block(self):
+        """
+        tokenize the CM block (between "CM" and "//") once.
+        returns
+            num_to_state : {state number: state name}
+            nodes        : [(node name, [state numbers in the node])]
+            states       : {state number: tokens of the state line}
+        The result is cached because every loader of this class starts from it.
+        """
+        if self._cm_block is not None:
+            return self._cm_block
+
+        num_to_state = dict()
+        nodes        = []
+        states       = dict()
+        flag         = False
         for line in self.content:
-            if re.match("CM", line):
+            if line.startswith("CM"):
                 flag = True
-            elif re.match("//", line):
-                flag = False
-                break
-                
-            # main part
-            if flag and not re.match("CM", line):
-                # state lines
-                if re.match(r"\s{45}", line) == None:
-                    state_line = re.split(r"\s+", line)
-                    num_to_state[int(state_line[2])] = "_".join(state_line[1:3])
-        return num_to_state
+                continue
+            elif line.startswith("//"):
+                if flag:
+                    break
+            if not flag:
+                continue
+
+            token = line.split()
+            if line.startswith(" "*45):
+                # node line: [ MATP    1 ] ...
+                nodes.append(("_".join(token[1:3]), []))
+            else:
+                # state line: type, num, plast, pnum, cfirst, cnum, 4 band values, trans..., emit...
+                num = int(token[1])
+                num_to_state[num] = "_".join(token[0:2])
+                states[num]       = token
+                nodes[-1][1].append(num)
+
+        self._cm_block = (num_to_state, nodes, states)
+        return self._cm_block
 
     def _read_node_line(self, line):
         nodeline = re.split(r"\s+", line)[2:4]
@@ -229,48 +739,49 @@ class CMReader:
         
         return node_name
 
-    def _read_state_line(self, line):
+    def _read_state_tokens(self, token, num_to_state):
         """
         auxiliary function for `load_derivation_dict`.
-        Read lines describing information about a state in a node.
+        token: whitespace-split state line (see `_parse_cm_block`).
         """
-        num_to_state = self._num_to_state()
-        state_line   = re.split(r"\s+", line)
-        state_name   = "_".join(state_line[1:3])
-                          
+        state_type = token[0]
+        state_name = "_".join(token[0:2])
+
         # state line has two information of transtion and emission
         # 2-1. transision
         prob_trans       = OrderedDict()
-        lowest_child_idx = int(state_line[5])
-        num_child        = int(state_line[6]) if int(state_line[6]) <=6 else 2 
-        for i in range(num_child):
-            # BIF でない場合
-            if re.match(r"B_\d+", state_name) == None: 
-                log_odds = state_line[11+i]
-                if log_odds != '*':
-                    prob = 2**float(log_odds)
-                else: # proc "*" in D or E state
-                    prob = float(0)
-                prob_trans.update({num_to_state[lowest_child_idx + i]:prob})
-
-            # if BIF, left col of lowest_child_idx = BIF_R
-            # prob o both splited state is １
-            else:
-                prob_trans.update({num_to_state[lowest_child_idx]:float(1), num_to_state[int(state_line[6])]:float(1)})
-     
+        lowest_child_idx = int(token[4])
+        if state_type != "B":
+            for i in range(int(token[5])):
+                log_odds = token[10+i]
+                prob     = 2**float(log_odds) if log_odds != '*' else float(0) # proc "*" in D or E state
+                prob_trans[num_to_state[lowest_child_idx + i]] = prob
+        # if BIF, left col of lowest_child_idx = BIF_R
+        # prob o both splited state is １
+        else:
+            prob_trans[num_to_state[lowest_child_idx]] = float(1)
+            prob_trans[num_to_state[int(token[5])]]    = float(1)
+
         # 2-2. emission
-        if re.match(r"(IL|IR|ML|MR)_\d+", state_name) != None:
-            prob_emit  = {k:(2**float(v)/4) for k,v in zip(['A', 'C', 'G', 'U'], state_line[-5:-1])}
-        elif 'MP' in state_name:
-            double_nuc = [n+m for n in ['A', 'C', 'G', 'U'] for m in ['A', 'C', 'G', 'U'] ]
-            prob_emit  = {k:(2**float(v)/16) for k, v in zip(double_nuc, state_line[-17:-1])}
+        if state_type in {"IL", "IR", "ML", "MR"}:
+            prob_emit = {k:(2**float(v)/4) for k, v in zip(SINGLE_NUCS, token[-4:])}
+        elif state_type == "MP":
+            prob_emit = {k:(2**float(v)/16) for k, v in zip(DOUBLE_NUCS, token[-16:])}
         else: # S or E or D
-            prob_emit  = {}
+            prob_emit = {}
 
-        assert re.match(r"[A-Z+]+_\d+", state_name) != None, "State name is strange."
         assert len(prob_trans) <= 6, "Length of transition prob is strange."
-        assert len(prob_emit) in {0, 4, 16}, "Length of emission prob is strange."
+        return state_name, prob_trans, prob_emit
 
+    def _read_state_line(self, line):
+        """
+        auxiliary function for `load_derivation_dict`.
+        Read lines describing information about a state in a node.
+        """
+        state_name, prob_trans, prob_emit = self._read_state_tokens(line.split(), self._num_to_state())
+
+        assert re.match(r"[A-Z+]+_\d+", state_name) != None, "State name is strange."
+        assert len(prob_emit) in {0, 4, 16}, "Length of emission prob is strange."
         return state_name, prob_trans, prob_emit
     
     def load_derivation_dict_from_cmfile(self):
@@ -280,28 +791,16 @@ class CMReader:
         For transmission except for bifurcation, log-odds = \log_2{prob_transition}. 
         For emission except, log-odds = \log_2{\frac{prob_transition}{1/4}}. 
         '*' indicates, infinity i.e. impossible transition/emission.
+        The CM block is tokenized once (`_parse_cm_block`), so this is linear in the number of states.
         """
+        num_to_state, nodes, states = self._parse_cm_block()
         derivation_dict = OrderedDict()
-        flag            = False
-        for line in self.content:
-            #start reading
-            if re.match("CM", line):
-                flag = True
-            # finish reading
-            elif re.match("//", line):
-                flag = False
-                
-            # main part
-            if flag and not re.match("CM", line):
-                # 1: node line
-                if re.match(r"\s{45}", line):
-                    state_dict = OrderedDict() # extract state infos of a node
-                    node_name  = self._read_node_line(line)
-                # 2: state line. called many times in a node
-                else:
-                    state_name, prob_trans, prob_emit = self._read_state_line(line)
-                    state_dict.update({state_name:{"trans":prob_trans, "emit":prob_emit}})
-                derivation_dict.update({node_name:state_dict})
+        for node_name, state_nums in nodes:
+            state_dict = OrderedDict() # extract state infos of a node
+            for num in state_nums:
+                state_name, prob_trans, prob_emit = self._read_state_tokens(states[num], num_to_state)
+                state_dict[state_name] = {"trans":prob_trans, "emit":prob_emit}
+            derivation_dict[node_name] = state_dict
 
         return derivation_dict
     
@@ -321,12 +820,7 @@ class CMReader:
         current_state_type = current_state_name.split("_")[0]
         rule_to_value = dict()
         n     = Nonterminal('n')
-        nl    = Nonterminal('nl')
-        nr    = Nonterminal('nr')
         nl_nr = Nonterminal('nl_nr')
-        S     = Nonterminal('S')
-        B     = Nonterminal('B')
-        MP    = Nonterminal('MP')
         
         # 1: emission
         for nuc, val in trans_emit['emit'].items():
@@ -338,23 +832,12 @@ class CMReader:
         # 2: transition
         for child_state, val in trans_emit["trans"].items():
             child_state_type = child_state.split("_")[0]
-            if current_state_type in {'IL', 'ML'}:
-                rule = Production(Nonterminal(current_state_type), [n, '.', Nonterminal(child_state_type)])
-            elif current_state_type in {'IR', 'MR'}:
-                rule = Production(Nonterminal(current_state_type), [Nonterminal(child_state_type), '.', n])
-            elif current_state_type == 'MP':
-                rule = Production(MP, [nl, '(', Nonterminal(child_state_type), ')', nr])
-            elif current_state_type in {'S', 'D'}:
-                rule = Production(Nonterminal(current_state_type), [Nonterminal(child_state_type)])
-            elif current_state_type == 'B':
-                rule = Production(B, [S, S])
-            else:
-                raise Exception(f"Unidentified current_state_type: {current_state_type}")
+            rule             = _transition_rule(current_state_type, child_state_type)
             
             rule_to_value.update({rule:val if val != '*' else 0})
         
         if current_state_type == "E":
-            rule = Production(Nonterminal("E"), [])
+            rule = _transition_rule("E", None)
             rule_to_value.update({rule:1})
         return rule_to_value
 
@@ -382,92 +865,123 @@ class CMReader:
     #     return print(f"Created {new_file_path} based off of {self.path}!")
 
 
+def _copy_deriv_dict(deriv_dict):
+    """
+    copy.deepcopy of a derivation dict, much faster since the values are plain numbers.
+    """
+    return OrderedDict(
+        (node, OrderedDict(
+            (state, {"trans":trans_emit["trans"].copy(), "emit":trans_emit["emit"].copy()}) for state, trans_emit in states.items()
+            ))
+        for node, states in deriv_dict.items()
+        )
+
+
 class TracebackFileReader:
     """
     Class for traceback -> aligned_tbdict
     Load cm file from cm reader and utilize the key to fill the val in traceback file.
+    traceback_file may be None when tracebacks are made in memory by `make_tbdf_from_seq`.
+    Use it as a context manager (or call `close`) to close the traceback file.
     """
-    def __init__(self, cm_file, traceback_file):
+    def __init__(self, cm_file, traceback_file = None):
         self.traceback_file = traceback_file
-        self.traceback      = gzip.open(traceback_file, "rb")
+        self.traceback      = gzip.open(traceback_file, "rb") if traceback_file is not None else None
         self.cm_file        = cm_file
         cmio = CMReader(self.cm_file)
         self.cm_deriv_dict  = cmio.load_derivation_dict_from_cmfile()
+        self._cm            = None
+
+    def close(self):
+        if self.traceback is not None:
+            self.traceback.close()
 
-    def traceback_iter(self):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def cm(self):
+        if self._cm is None:
+            self._cm = CovarianceModel(self.cm_deriv_dict)
+        return self._cm
+
+    def make_tbdf_from_seq(self, seq, tau = None):
         """
-        returns generator of traceback text of a single strand.
-        A traceback file may be too heavy.
+        traceback of the CYK parse of seq, without running cmalign.
+        Same as the traceback of `cmalign -g --cyk --nonbanded` (or QDB bands of tau if given).
         """
-        Read      = True
-        IsContent = False
-        tbtext    = []
-        line      = self.traceback.readline()
-        while Read:
-            if line.startswith(b'----- ------ ------ ------- ----- ----- ----- ----- ----- -----\n'):
-                IsContent = not IsContent
-                if not IsContent:
-                    Read = False
-                    break
-            elif IsContent:
-                tbtext.append(line)
-            elif line == b'':
-                break
-            line = self.traceback.readline()
-        yield tbtext
-        
-    def _make_tbdf_from_tbtext(self, traceback):
-        backtrack_log = []
-        for line in traceback:
-            _, _, *token, _ = re.split(r"\s+", line.decode())
-            backtrack_log.append(token)
-        header = "emitl  emitr   state  mode  nxtl  nxtr  prv   tsc   esc"
-        return pd.DataFrame(backtrack_log, columns = re.split(r"\s+", header))
-
-    def _extract_trans_emit(self,row):
-        current_state = re.search(r"[A-Z]+", row["state"]).group() + "_" + re.search(r"\d+", row["state"]).group()
-        emitl         = row["emitl"][-1] if not row["emitl"].isnumeric() else ""
-        emitr         = row["emitr"][-1] if not row["emitr"].isnumeric() else ""
-        return current_state, emitl+emitr
+        _, parse = self.cm.cyk(seq, tau = tau)
+        return self.cm.make_tbdf_from_parse(seq, parse)
+
+    def iter_tracebacks(self):
+        """
+        stream the remaining tracebacks of the gzipped traceback file, one sequence at a time.
+        yields (state_path, emissions):
+            state_path: state names of the rows, e.g. "MP_12"
+            emissions : residues emitted by each row, "" / "G" / "GC" (left + right)
+        Rows are tokenized by whitespace only, without a DataFrame.
+        """
+        in_table = False
+        for line in self.traceback:
+            if line.startswith(TRACEBACK_SEPARATOR):
+                in_table = not in_table
+                if in_table:
+                    state_path, emissions = [], []
+                else:
+                    yield state_path, emissions
+            elif in_table:
+                _, emitl, emitr, state = line.decode().split(None, 4)[:4]
+                state_name, emitted_nuc = self._read_row(emitl, emitr, state)
+                state_path.append(state_name)
+                emissions.append(emitted_nuc)
+
+    @staticmethod
+    def _read_row(emitl, emitr, state):
+        """
+        ("12MP", "3G", "20C") -> ("MP_12", "GC")
+        """
+        n_digits = len(state) - len(state.lstrip("0123456789"))
+        emitl    = emitl[-1] if not emitl.isnumeric() else ""
+        emitr    = emitr[-1] if not emitr.isnumeric() else ""
+        return state[n_digits:] + "_" + state[:n_digits], emitl+emitr
 
     def _make_tbdict_from_tbdf(self,tbdf):
+        """
+        tbdf: (state_path, emissions) of `iter_tracebacks`, or a traceback table (DataFrame).
+        Each parent keeps only its last transition and emission.
+        """
+        if isinstance(tbdf, tuple):
+            state_path, emissions = tbdf
+        else:
+            state_path, emissions = [], []
+            for emitl, emitr, state in zip(tbdf["emitl"], tbdf["emitr"], tbdf["state"]):
+                state_name, emitted_nuc = self._read_row(emitl, emitr, state)
+                state_path.append(state_name)
+                emissions.append(emitted_nuc)
+
         traceback_dict = OrderedDict()
-        parent_state   = ""
-        last_emit      = ""
         bif_stack      = deque() # prepare bif for bifircation
-        
-        #  iteration for child
-        for i, row in tbdf.iterrows():
-            trans_emit_from_parent   = OrderedDict({"trans":OrderedDict(), "emit":OrderedDict()})
-            child_state, emitted_nuc = self._extract_trans_emit(row)
+        for i, child_state in enumerate(state_path):
             if "B" in child_state:
                 bif_stack.append(child_state)
-                
             # Pass for the first state(S)
-            if i != 0:
-                # proc S of BIF_R. The right before state must be "E" state. 
-                # trans: B -> S
-                if "S" in child_state and "E" in parent_state:
-                    # 直前のBまで戻ってB→Sを追加
-                    parent_bif = bif_stack.pop()
-                    traceback_dict[parent_bif]["trans"].update({child_state:1})
-                    
-                else: # transitions other than BIF.
-                    # For insertion, this may be called for multiple times.
-                    if child_state in trans_emit_from_parent["trans"]:
-                        trans_emit_from_parent["trans"][child_state] += 1
-                    else:
-                        trans_emit_from_parent["trans"].update({child_state:1})
-                        
-                if not last_emit == "":
-                    if last_emit in trans_emit_from_parent["emit"]:
-                        trans_emit_from_parent.update["emit"][last_emit] += 1
-                    else:
-                        trans_emit_from_parent["emit"].update({last_emit:1})
-            
-                traceback_dict.update({parent_state:trans_emit_from_parent})
-            parent_state = child_state
-            last_emit    = emitted_nuc
+            if i == 0:
+                continue
+            parent_state = state_path[i-1]
+            trans_emit_from_parent = OrderedDict({"trans":OrderedDict(), "emit":OrderedDict()})
+            # proc S of BIF_R. The right before state must be "E" state. 
+            # trans: B -> S
+            if "S" in child_state and "E" in parent_state:
+                parent_bif = bif_stack.pop()
+                traceback_dict[parent_bif]["trans"][child_state] = 1
+            else:
+                trans_emit_from_parent["trans"][child_state] = 1
+            if emissions[i-1] != "":
+                trans_emit_from_parent["emit"][emissions[i-1]] = 1
+            traceback_dict[parent_state] = trans_emit_from_parent
         return traceback_dict
 
     def make_aligned_tbdict_from_tbdf(self,tbdf):
@@ -475,7 +989,7 @@ class TracebackFileReader:
         Fill zeros in missing val in tbdict.
         Use cm_dict as a template.
         """
-        aligned_tbdict = copy.deepcopy(self.cm_deriv_dict)
+        aligned_tbdict = _copy_deriv_dict(self.cm_deriv_dict)
         tbdict         = self._make_tbdict_from_tbdf(tbdf)
         # Is there all keys in node_dict?
         # if there, assign count
@@ -515,8 +1029,9 @@ class TracebackFileReader:
         Complements 0 to missing values in tbdict. 
         Edit cm_dict as a template.
         When EL state appears, all the values of cm_deriv_dict are taken.  
+        tbdf: (state_path, emissions) of `iter_tracebacks`, or a traceback table (DataFrame).
         """
-        aligned_tbdict = copy.deepcopy(self.cm_deriv_dict)
+        aligned_tbdict = _copy_deriv_dict(self.cm_deriv_dict)
         tbdict         = self._make_tbdict_from_tbdf(tbdf)
         # Is there all keys in node_dict?
         # if there, assign count
@@ -528,53 +1043,44 @@ class TracebackFileReader:
                 if modeEL and ("S" in parent_state):
                     modeEL = False
 
-                if parent_state in tbdict.keys(): 
-                    for nuc, prob in trans_emit["emit"].items():
-                        sum_count_from_parent = sum(tbdict[parent_state]["emit"].values())
-                        if nuc in tbdict[parent_state]["emit"]:
-                            count = tbdict[parent_state]["emit"][nuc]/sum_count_from_parent
+                if parent_state in tbdict: 
+                    tb_emit  = tbdict[parent_state]["emit"]
+                    tb_trans = tbdict[parent_state]["trans"]
+                    sum_count_from_parent = sum(tb_emit.values())
+                    emit = trans_emit["emit"]
+                    for nuc in emit:
+                        if nuc in tb_emit:
+                            emit[nuc] = tb_emit[nuc]/sum_count_from_parent
                         elif not modeEL:
-                            count = 0
-                        else:
-                            count = aligned_tbdict[node][parent_state]["emit"][nuc]
-                        aligned_tbdict[node][parent_state]["emit"][nuc] = count
+                            emit[nuc] = 0
 
                     # If tbdict's child has EL state, ELmode.
-                    for tbchild in tbdict[parent_state]["trans"]:
-                        if "EL_" in tbchild:
-                            modeEL = True
-                            break
-
-                    for child_state, prob in trans_emit["trans"].items():
-                        sum_count_from_parent = 1 if "B" in parent_state else sum(tbdict[parent_state]["trans"].values()) 
-                        if child_state in tbdict[parent_state]["trans"]:
-                            val = tbdict[parent_state]["trans"][child_state]/sum_count_from_parent
+                    if any("EL_" in tbchild for tbchild in tb_trans):
+                        modeEL = True
+
+                    sum_count_from_parent = 1 if "B" in parent_state else sum(tb_trans.values()) 
+                    trans = trans_emit["trans"]
+                    for child_state in trans:
+                        if child_state in tb_trans:
+                            trans[child_state] = tb_trans[child_state]/sum_count_from_parent
                         elif not modeEL:
-                            val = 0
-                        else:
-                            val = aligned_tbdict[node][parent_state]["trans"][child_state]
-                        aligned_tbdict[node][parent_state]["trans"][child_state] = val
+                            trans[child_state] = 0
                     
         return aligned_tbdict
 
 # reconstruction of derivdict from tr/s/p
 # for sampliing sequences from decoder output.
-def make_deriv_dict_from_trsp(cm_deriv_dict, trsp):
+def make_deriv_dict_from_trsp(cm_deriv_dict, trsp, compiled_cm = None):
     """
     Getting cm_deriv_dict from cmreader is a time-consuming process.
     so, this function takes cm_deriv_dict as an input.
+    compiled_cm: CompiledCM of cm_deriv_dict. If given, the conversion runs on its index arrays.
     """
     tr,s,p = list(map(lambda x: x.squeeze().detach().numpy(), trsp))
+    if compiled_cm is not None:
+        return compiled_cm.with_params(*compiled_cm.params_from_trsp(tr, s, p)).to_deriv_dict()
+
     dirty_deriv_dict = copy.deepcopy(cm_deriv_dict)
-    all_rules = CFG.fromstring(grammar.grammar_CM).productions()
-    
-    n     = Nonterminal('n')
-    nl    = Nonterminal('nl')
-    nr    = Nonterminal('nr')
-    nl_nr = Nonterminal('nl_nr')
-    S     = Nonterminal('S')
-    B     = Nonterminal('B')
-    MP    = Nonterminal('MP')
 
     s_i = 0
     p_i = 0
@@ -583,14 +1089,10 @@ def make_deriv_dict_from_trsp(cm_deriv_dict, trsp):
             parent_state_type = parent_state.split("_")[0]
             # 1: emission
             for nuc, val in trans_emit['emit'].items():
-                if nuc in {'A', 'C', 'G', 'U'}:
-                    rule = Production(n, [nuc])
-                    rule_i = all_rules.index(rule) -56
-                    rule_val = s[rule_i, s_i]
+                if nuc in grammar.CM_S_ROW:
+                    rule_val = s[grammar.CM_S_ROW[nuc], s_i]
                 else:# double emissin
-                    rule = Production(nl_nr, [nuc])
-                    rule_i = all_rules.index(rule) -60
-                    rule_val = p[rule_i, p_i]
+                    rule_val = p[grammar.CM_P_ROW[nuc], p_i]
                 dirty_deriv_dict[node][parent_state]["emit"][nuc] = rule_val
             
             if parent_state_type in {'IL', 'ML', 'IR', 'MR'}:
@@ -601,22 +1103,10 @@ def make_deriv_dict_from_trsp(cm_deriv_dict, trsp):
             # fill tr values
             for child_state, val in trans_emit["trans"].items():
                 child_state_type = child_state.split("_")[0]
-                if parent_state_type in {'IL', 'ML'}:
-                    rule = Production(Nonterminal(parent_state_type), [n, '.', Nonterminal(child_state_type)])
-                elif parent_state_type in {'IR', 'MR'}:
-                    rule = Production(Nonterminal(parent_state_type), [Nonterminal(child_state_type), '.', n])
-                elif parent_state_type == 'MP':
-                    rule = Production(MP, [nl, '(', Nonterminal(child_state_type), ')', nr])
-                elif parent_state_type in {'S', 'D'}:
-                    rule = Production(Nonterminal(parent_state_type), [Nonterminal(child_state_type)])
-                elif parent_state_type == 'B':
-                    rule = Production(B, [S, S])
-                else:
+                if parent_state_type not in {'S', 'D', 'IL', 'ML', 'IR', 'MR', 'MP', 'B'}:
                     raise Exception(f"Unidentified parent_state_type: {parent_state_type}")
-                
-                rule_i = all_rules.index(rule)
-                rule_val = tr[rule_i, node_i]
-                dirty_deriv_dict[node][parent_state]["trans"][child_state] = rule_val
+                rule_i = grammar.CM_TR_ROW[(parent_state_type, 'S' if parent_state_type == 'B' else child_state_type)]
+                dirty_deriv_dict[node][parent_state]["trans"][child_state] = tr[rule_i, node_i]
                 
     def cleanup_deriv_dict(dirty_deriv_dict):
         """
@@ -632,33 +1122,53 @@ def make_deriv_dict_from_trsp(cm_deriv_dict, trsp):
                 
     return cleanup_deriv_dict(dirty_deriv_dict)
 
+# batched reconstruction of CMs from decoder outputs.
+def make_cms_from_trsp(compiled_cm, trsp):
+    """
+    decoder outputs tr (B, 56, n_nodes), s (B, 4, n_single), p (B, 16, n_pair) -> list of B CovarianceModel.
+    The parameters of all B models are gathered at once through the index arrays of compiled_cm,
+    and the derivation dict of a model is built only when its `deriv_dict` is accessed.
+    """
+    tr, s, p = [x.detach().cpu().numpy() if torch.is_tensor(x) else np.asarray(x) for x in trsp]
+    trans, emit_single, emit_pair = compiled_cm.params_from_trsp(tr, s, p)
+    return [
+        CovarianceModel(None, compiled_cm.with_params(trans[b], emit_single[b], emit_pair[b]))
+        for b in range(len(trans))
+        ]
+
 # conversion of derivdict to tr/s/p
-def make_trsp_from_deriv_dict(path_to_cmfile, deriv_dict):
+def make_trsp_from_deriv_dict(path_to_cmfile, deriv_dict, compiled_cm = None):
     """
     function to make trsp(onehot) from dictionary of CM.
+    compiled_cm: CompiledCM of the CM. If given, the conversion runs on its index arrays.
     """
-    cmreader = CMReader(path_to_cmfile)
+    if compiled_cm is not None:
+        tr, s, p = compiled_cm.with_params(*compiled_cm.params_from_deriv_dict(deriv_dict)).to_trsp()
+        return torch.from_numpy(tr), torch.from_numpy(s), torch.from_numpy(p)
+
     trans_map, single_map, pair_map = [], [], []
     
     for node, states in deriv_dict.items():
-        trans_col    = [np.nan]*56
+        trans_col    = [np.nan]*grammar.CM_N_TR
         for current_state_name, trans_emit in states.items():
+            current_state_type = current_state_name.split("_")[0]
 
             # emissionは何もない可能性があるので+1しておく
             if re.match(r".+P_", current_state_name) != None:
-                pair_col   = [np.nan]*16
+                pair_col   = [np.nan]*grammar.CM_N_P
             if re.match(r".+(L|R)_", current_state_name) != None:
-                single_col = [np.nan]*4
-
-            rule_to_value = cmreader._make_rule2val_from_trans_emit_dict(current_state_name, trans_emit)
-            for rule, val in rule_to_value.items():
-                idx = cmreader.cfg.productions().index(rule)
-                if idx <= 55:
-                    trans_col[idx] = val
-                elif 56 <= idx <= 59:
-                    single_col[idx-56] = val
-                elif 60 <= idx <= 76:
-                    pair_col[idx-60] = val
+                single_col = [np.nan]*grammar.CM_N_S
+
+            for nuc, val in trans_emit['emit'].items():
+                if nuc in grammar.CM_S_ROW:
+                    single_col[grammar.CM_S_ROW[nuc]] = val
+                else:
+                    pair_col[grammar.CM_P_ROW[nuc]] = val
+            for child_state, val in trans_emit["trans"].items():
+                child_state_type = 'S' if current_state_type == 'B' else child_state.split("_")[0]
+                trans_col[grammar.CM_TR_ROW[(current_state_type, child_state_type)]] = val if val != '*' else 0
+            if current_state_type == "E":
+                trans_col[grammar.CM_TR_ROW[("E", None)]] = 1
 
             if re.match(r".+P_", current_state_name) != None:
                 pair_map.append(pair_col)
@@ -676,8 +1186,6 @@ if __name__ == '__main__':
     #     "/Users/sumishunsuke/Desktop/RNA/genzyme/datasets/RF00163/RF00163.cm",
     #     "./outputs/EXP03/GVAE_chemparam_g4/GVAEchemparam_g4_random_sampled_traceback.txt.gz"
     #     )
-    # content      = list(reader.traceback_iter())[0]
-    # tbdf         = reader._make_tbdf_from_tbtext(content)
     # align_tbdict = reader.make_aligned_tbdict_from_tbdf(tbdf)
     # pprint(align_tbdict)
     # pprint(deriv)
@@ -1,38 +1,183 @@
+import os
 import h5py 
 import numpy as np
 import torch
 from torch import nn
 import util
 import preprocess
-from torch.utils.data import Dataset
+from trsp_h5 import read_trsp
+from torch.utils.data import Dataset, Sampler
 from torch.distributions import Normal
 from encoder import CovarianceModelEncoder
 from decoder import CovarianceModelDecoder
 
 class MyDataset(Dataset):
-    def __init__(self, path, weight_path = ""):
+    """
+    tr/s/p dataset of CM-VAE. Items are (tr, s, p, w) with tr (56, TR_LEN), s (4, S_LEN), p (16, P_LEN), w (1,).
+    backend: "h5"     reads every item from the h5 file.
+             "memory" preloads tr/s/p as contiguous, transposed, NaN-cleaned arrays of dtype.
+             "mmap"   memory-maps .npy files of the same arrays, written next to path (or in cache_dir) on first use.
+    dtype  : float32, or uint8 for one-hot data (checked when the arrays are built).
+    path may be in the legacy or the compact layout (see trsp_h5).
+    An index may be an int, a slice or an array of indices. The latter two return a batch gathered in one operation.
+    return_scales: items get a 5th element, (tr, s, p) of the inverse column sums of the targets (see models.loss.inverse_scale).
+                   The memory/mmap backends compute them once here.
+    """
+    def __init__(self, path, weight_path = "", backend = "h5", dtype = np.float32, cache_dir = None, chunk_size = 4096, return_scales = False):
         super().__init__()
-        self.path = path
-        self.data = h5py.File(path, "r")
-        self.tr = self.data["tr"]
-        self.s = self.data["s"]
-        self.p = self.data["p"]
-        if weight_path != "":
+        assert backend in {"h5", "memory", "mmap"}, "Select backend from h5/memory/mmap"
+        self.path    = path
+        self.backend = backend
+        self.dtype   = np.dtype(dtype)
+        self._pid    = os.getpid()
+        self.data    = h5py.File(path, "r")
+        self.tr_len, self.s_len, self.p_len = [self.data[key].shape[-2] for key in ("tr", "s", "p")]
+        self.n_data  = self.data["tr"].shape[0]
+        self.return_scales = return_scales
+        if backend == "h5":
+            self.tr = self.data["tr"]
+            self.s  = self.data["s"]
+            self.p  = self.data["p"]
+        elif backend == "memory":
+            self.tr, self.s, self.p = [self._convert(key, np.empty, chunk_size) for key in ("tr", "s", "p")]
+        else:
+            self.tr, self.s, self.p = [self._mmap_cache(key, cache_dir, chunk_size) for key in ("tr", "s", "p")]
+        if backend != "h5":
+            self.data.close()
+            self.data = None
+            if return_scales:
+                self.inv_scales = [self._inverse_scale(x, chunk_size) for x in (self.tr, self.s, self.p)]
+        if weight_path:
             self.weight = h5py.File(weight_path, "r")["weight"][:]
             self.weight = self.weight.reshape(self.weight.size, 1)
         else:
-            self.weight = np.ones(self.tr.shape[0])
+            self.weight = np.ones(self.n_data)
             self.weight = self.weight.reshape(self.weight.size, 1)
-                
+        self.weight = np.ascontiguousarray(self.weight, dtype = np.float32)
+
+    def _convert(self, key, allocate, chunk_size):
+        """
+        h5 dataset (N, LEN, N_RULES) -> array (N, N_RULES, LEN) of self.dtype, without NaN. Converted chunk by chunk.
+        allocate(shape, dtype) makes the output array.
+        """
+        source = self.data[key]
+        out    = allocate((source.shape[0], source.shape[2], source.shape[1]), self.dtype)
+        for start in range(0, source.shape[0], chunk_size):
+            x = read_trsp(self.data, key, slice(start, start+chunk_size), fill = 0).transpose(0, 2, 1)
+            if self.dtype == np.uint8 and not np.isin(x, (0, 1)).all():
+                raise ValueError(f"{key} of {self.path} is not one-hot. Use dtype float32.")
+            out[start:start+len(x)] = x
+        return out
+
+    @staticmethod
+    def _inverse_scale(x, chunk_size):
+        # (N, N_RULES, LEN) -> (N, LEN) float32
+        out = np.empty((x.shape[0], x.shape[2]), dtype = np.float32)
+        with np.errstate(divide = "ignore"):
+            for start in range(0, x.shape[0], chunk_size):
+                out[start:start+chunk_size] = 1/x[start:start+chunk_size].sum(axis = 1, dtype = np.float32)
+        return out
+
+    def _mmap_cache(self, key, cache_dir, chunk_size):
+        directory = cache_dir if cache_dir is not None else os.path.dirname(os.path.abspath(self.path))
+        base      = os.path.splitext(os.path.basename(self.path))[0]
+        cache     = os.path.join(directory, f"{base}_{key}_{self.dtype.name}.npy")
+        if not os.path.exists(cache) or os.path.getmtime(cache) < os.path.getmtime(self.path):
+            tmp = cache + ".tmp"
+            out = self._convert(key, lambda shape, dtype: np.lib.format.open_memmap(tmp, mode = "w+", shape = shape, dtype = dtype), chunk_size)
+            out.flush()
+            del out
+            os.replace(tmp, cache)
+        return np.load(cache, mmap_mode = "r")
+
+    def _h5(self):
+        # a forked DataLoader worker opens its own handle instead of sharing the parent's one.
+        if self._pid != os.getpid():
+            self._pid  = os.getpid()
+            self.data  = h5py.File(self.path, "r")
+            self.tr, self.s, self.p = self.data["tr"], self.data["s"], self.data["p"]
+
+    def __getstate__(self):
+        # h5py handles cannot be pickled: a spawned DataLoader worker opens its own in _h5.
+        state = self.__dict__.copy()
+        if self.backend == "h5":
+            state.update(_pid = None, data = None, tr = None, s = None, p = None)
+        return state
+
     def __len__(self):
-        return self.tr.shape[0]
+        return self.n_data
     
     def __getitem__(self, index):
-        tr_tensor = torch.from_numpy(self.tr[index]).nan_to_num(0).transpose(-2, -1).float()
-        s_tensor = torch.from_numpy(self.s[index]).nan_to_num(0).transpose(-2, -1).float()
-        p_tensor = torch.from_numpy(self.p[index]).nan_to_num(0).transpose(-2, -1).float()
-        w_tensor = torch.from_numpy(self.weight[index]).float()
-        return tr_tensor, s_tensor, p_tensor, w_tensor
+        if self.backend == "h5":
+            self._h5()
+            if isinstance(index, (int, np.integer)):
+                tr_tensor = torch.from_numpy(read_trsp(self.data, "tr", index, fill = 0)).transpose(-2, -1).float()
+                s_tensor = torch.from_numpy(read_trsp(self.data, "s", index, fill = 0)).transpose(-2, -1).float()
+                p_tensor = torch.from_numpy(read_trsp(self.data, "p", index, fill = 0)).transpose(-2, -1).float()
+                w_tensor = torch.from_numpy(self.weight[index]).float()
+                if self.return_scales:
+                    return tr_tensor, s_tensor, p_tensor, w_tensor, tuple(1/x.sum(dim = -2) for x in (tr_tensor, s_tensor, p_tensor))
+                return tr_tensor, s_tensor, p_tensor, w_tensor
+            # h5py fancy indexing needs increasing indices
+            index = np.arange(self.n_data)[index]
+            order = np.argsort(index)
+            inverse = np.argsort(order)
+            tr, s, p = [read_trsp(self.data, key, index[order], fill = 0)[inverse].transpose(0, 2, 1) for key in ("tr", "s", "p")]
+        else:
+            if isinstance(index, slice):
+                tr, s, p = self.tr[index], self.s[index], self.p[index]
+            else:
+                tr, s, p = [np.take(x, index, axis = 0) for x in (self.tr, self.s, self.p)]
+        # float32 copies only where needed (uint8 data, read-only memory maps, gathered h5 reads)
+        tr, s, p = [torch.from_numpy(np.require(x, dtype = np.float32, requirements = ["C", "W"])) for x in (tr, s, p)]
+        if not self.return_scales:
+            return tr, s, p, torch.from_numpy(self.weight[index])
+        if self.backend == "h5":
+            inv_scales = tuple(1/x.sum(dim = -2) for x in (tr, s, p))
+        elif isinstance(index, slice):
+            inv_scales = tuple(torch.from_numpy(x[index]) for x in self.inv_scales)
+        else:
+            inv_scales = tuple(torch.from_numpy(np.take(x, index, axis = 0)) for x in self.inv_scales)
+        return tr, s, p, torch.from_numpy(self.weight[index]), inv_scales
+
+
+class BatchIndexSampler(Sampler):
+    """
+    sampler of whole batches: yields arrays of batch_size indices (the last one shorter unless drop_last).
+    Use it with DataLoader(dataset, sampler = BatchIndexSampler(...), batch_size = None), so that MyDataset gathers
+    each batch in one operation and no collation runs.
+    rank/world_size shard the batches for data-parallel training: every global batch of batch_size*world_size indices
+    is split into world_size slices and rank takes its own. All ranks must pass generators with the same seed,
+    so that they draw the same permutation.
+    To resume an epoch, restore the generator to epoch_generator_state (its state before the epoch's permutation)
+    and set start_batch to the number of batches already done; the next iteration skips them.
+    """
+    def __init__(self, n_data, batch_size, shuffle = True, drop_last = False, generator = None, rank = 0, world_size = 1):
+        self.n_data     = n_data
+        self.batch_size = batch_size
+        self.shuffle    = shuffle
+        self.drop_last  = drop_last
+        self.generator  = generator
+        self.rank       = rank
+        self.world_size = world_size
+        self.start_batch = 0
+        self.epoch_generator_state = None
+
+    def __iter__(self):
+        if self.generator is not None:
+            self.epoch_generator_state = self.generator.get_state()
+        order = torch.randperm(self.n_data, generator = self.generator).numpy() if self.shuffle else np.arange(self.n_data)
+        global_batch = self.batch_size*self.world_size
+        start_batch, self.start_batch = self.start_batch, 0
+        for i in range(start_batch, len(self)):
+            start = i*global_batch + self.rank*self.batch_size
+            yield order[start:min(start + self.batch_size, (i + 1)*global_batch)]
+
+    def __len__(self):
+        global_batch = self.batch_size*self.world_size
+        if self.drop_last:
+            return self.n_data//global_batch
+        return -(-self.n_data//global_batch)
 
 
 class CovarianceModelVAE(nn.Module):
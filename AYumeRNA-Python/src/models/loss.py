@@ -0,0 +1,106 @@
+# reconstruction loss of CM-VAE, shared by training (scripts/train.py) and scoring (scripts/pred_activity.py).
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def modifiedCELoss(pred, soft_targets, gamma=0, summarize=True):
+    """
+    shape: (BATCH, N_COL, N_RULE)
+    gamma for focal loss
+    calc sum of a column and normalize a col by the sum, then calc CEloss.
+    summarize: sum over the batch too. Otherwise the loss of each item, (BATCH,).
+    One head at a time; CMVAELoss computes the three heads without transposes.
+    """
+    scale = soft_targets.nansum(dim=-1).unsqueeze(dim=-1)
+    logp = F.log_softmax(pred, dim=-1)
+    ce = -soft_targets / scale * logp
+    if gamma != 0:
+        ce = ce * (1 - logp.exp()).pow(gamma)
+    if summarize:
+        return torch.sum(ce)
+    else:
+        return ce.sum(dim=-1).sum(dim=-1)
+
+
+def inverse_scale(target):
+    """
+    1 / (sum of a column over the rules) of a target (..., N_RULE, LEN), as (..., LEN). NaN (rules that do not exist)
+    count as 0, as in modifiedCELoss.
+    MyDataset precomputes it so that CMVAELoss does not reduce the targets at every step.
+    """
+    return 1 / target.nansum(dim=-2)
+
+
+class CMVAELoss(nn.Module):
+    """
+    modifiedCELoss of the tr, s and p heads in one call, summed per item.
+    preds and targets are (tr, s, p) tuples of (BATCH, N_RULE, LEN) tensors, as the decoder outputs them and
+    MyDataset returns them: log-softmax runs over dim 1 of the contiguous tensors, without transposes.
+    inv_scales: (tr, s, p) of inverse_scale(target), (BATCH, LEN). Computed from the targets if None; NaN in the
+                targets then count as 0. Targets given with inv_scales must be free of NaN, as MyDataset returns them.
+    The focal term (1 - softmax)^gamma is skipped when gamma is 0.
+    """
+    def __init__(self, gamma=0):
+        super().__init__()
+        self.gamma = gamma
+
+    def forward(self, preds, targets, inv_scales=None):
+        if inv_scales is None:
+            targets    = [target.nan_to_num(0) for target in targets]
+            inv_scales = [inverse_scale(target) for target in targets]
+        loss = 0
+        for pred, target, inv_scale in zip(preds, targets, inv_scales):
+            logp = F.log_softmax(pred, dim=1)
+            if self.gamma != 0:
+                logp = logp * (1 - logp.exp()).pow(self.gamma)
+            # sum over rules first, then scale each column once
+            loss = loss - ((target * logp).sum(dim=1) * inv_scale).sum(dim=-1)
+        return loss
+
+
+if __name__ == "__main__":
+    # micro-benchmark of the loss of one training step (forward and backward), per-head legacy calls vs CMVAELoss.
+    import argparse
+    import time
+
+    def legacy_loss(pred, soft_targets, gamma=0):
+        # modifiedCELoss before the shared module
+        scale = soft_targets.nansum(dim=-1).unsqueeze(dim=-1)
+        logsoftmax = nn.LogSoftmax(dim=-1)
+        softmax = nn.Softmax(dim=-1)
+        ce = -soft_targets / scale * ((1 - softmax(pred)).pow(gamma)) * logsoftmax(pred)
+        ce_colwise = torch.sum(ce, dim=-1)
+        return ce.sum(dim=-1).sum(dim=-1)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=[8, 64, 256], type=int, nargs="+")
+    parser.add_argument('--lengths', default=[120, 80, 40], type=int, nargs=3, help="TR_LEN, S_LEN and P_LEN.")
+    parser.add_argument('--gamma', default=0, type=float)
+    parser.add_argument('--threads', default=1, type=int)
+    parser.add_argument('--repeat', default=50, type=int)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    def step_time(loss_fn, preds):
+        elapsed = []
+        for _ in range(args.repeat):
+            for pred in preds:
+                pred.grad = None
+            start = time.perf_counter()
+            loss_fn().sum().backward()
+            elapsed.append(time.perf_counter() - start)
+        return sorted(elapsed)[len(elapsed) // 2]
+
+    fused = CMVAELoss(gamma=args.gamma)
+    for batch_size in args.batch_size:
+        torch.manual_seed(0)
+        preds, targets = [], []
+        for n_rule, length in zip([56, 4, 16], args.lengths):
+            preds.append(torch.randn(batch_size, n_rule, length, requires_grad=True))
+            targets.append(F.one_hot(torch.randint(n_rule, (batch_size, length)), n_rule).transpose(1, 2).float())
+        inv_scales = [inverse_scale(target) for target in targets]
+        legacy = step_time(lambda: sum(legacy_loss(pred.transpose(-1, -2), target.transpose(-1, -2), args.gamma) for pred, target in zip(preds, targets)), preds)
+        new = step_time(lambda: fused(preds, targets, inv_scales), preds)
+        print(f"batch {batch_size}\t| legacy {legacy*1e3:.3f} ms\t| fused {new*1e3:.3f} ms\t| x{legacy/new:.1f}")
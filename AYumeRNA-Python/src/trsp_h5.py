@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+compact h5 layout of tr/s/p datasets of CM-VAE.
+
+The legacy layout (make_onehot_of_cm_from_traceback) stores tr (N, TR_LEN, 56), s (N, S_LEN, 4) and p (N, P_LEN, 16)
+as floats, with NaN where a node has no such rule. The compact layout keeps the keys and the shapes, but
+    - values are quantized without loss to uint8 when they are one-hot counts divided by small integers: code k < 255
+      is k/denominator. Code 255 is the value of "<key>_background" (LEN, N_RULES) at that position, which holds the
+      one other value a position may take (the CM parameter that tracebacks keep for states they do not visit).
+      Otherwise values are stored as float16 when exact, else in the source dtype.
+    - NaNs are stored as 0 and recorded in a validity mask "<key>_mask". The NaN pattern depends only on the CM, so the
+      mask is usually one (LEN, N_RULES) array shared by all rows, and (N, LEN, N_RULES) only when it is not.
+    - datasets are gzip compressed in chunks of batch_size rows, so a batch of consecutive rows reads whole chunks.
+`read_trsp` reads both layouts, so readers do not need to know which one a file has.
+"""
+import h5py
+import numpy as np
+
+FORMAT    = "compact_trsp"
+TRSP_KEYS = ("tr", "s", "p")
+MAX_CODES = 255  # codes of k/denominator. BACKGROUND is the code of <key>_background.
+BACKGROUND = 255
+
+
+def is_compact(h5):
+    return h5.attrs.get("format") == FORMAT
+
+def _table(denominator, dtype):
+    # uint8 code -> value
+    return (np.arange(MAX_CODES + 1, dtype = np.float64)/denominator).astype(dtype)
+
+def _iter_rows(source, chunk_size):
+    for start in range(0, source.shape[0], chunk_size):
+        yield start, np.asarray(source[start:start+chunk_size])
+
+def _denominator(values, dtype):
+    """
+    smallest denominator d <= MAX_CODES such that all values are k/d (k < MAX_CODES) exactly in dtype. 0 if none.
+    """
+    if values is None or not np.isfinite(values).all() or (values < 0).any():
+        return 0
+    for d in range(1, MAX_CODES + 1):
+        codes = np.rint(values.astype(np.float64)*d)
+        if codes.max(initial = 0) < MAX_CODES and (_table(d, dtype)[codes.astype(np.intp)] == values).all():
+            return d
+    return 0
+
+def _scan(source, chunk_size):
+    """
+    encoding of a legacy dataset: (stored dtype, denominator, background, mask kind, shared mask).
+    background is the first value other than 0/1 seen at each position (NaN if none); the other values must be k/denominator.
+    mask kind is "none" without NaN, "shared" when all rows have the NaN pattern of the first row and "rows" otherwise.
+    """
+    background = np.full(source.shape[1:], np.nan, dtype = source.dtype)
+    uniques    = np.empty(0, dtype = source.dtype)
+    exact16    = True
+    shared     = None
+    per_row    = False
+    for _, x in _iter_rows(source, chunk_size):
+        valid = ~np.isnan(x)
+        if shared is None:
+            shared = valid[0]
+        per_row = per_row or not (valid == shared).all()
+        values  = x[valid]
+        exact16 = exact16 and bool((values.astype(np.float16).astype(source.dtype) == values).all())
+        if uniques is None:
+            continue
+        odd   = valid & (x != 0) & (x != 1)
+        first = odd.argmax(axis = 0)
+        new   = np.isnan(background) & odd.any(axis = 0)
+        background[new] = np.take_along_axis(x, first[None], axis = 0)[0][new]
+        uniques = np.union1d(uniques, x[odd & (x != background)])
+        if len(uniques) > MAX_CODES:
+            uniques = None
+
+    denominator = _denominator(None if uniques is None else np.union1d(uniques, [0, 1]), source.dtype)
+    if denominator:
+        stored = np.uint8
+    elif exact16 and source.dtype.itemsize > 2:
+        stored = np.float16
+    else:
+        stored = source.dtype
+    if shared is None or shared.all() and not per_row:
+        kind = "none"
+    else:
+        kind = "rows" if per_row else "shared"
+    return stored, denominator, background, kind, shared
+
+def write_compact_dataset(h5, key, source, batch_size = 256, chunk_size = 4096):
+    """
+    encode source, a legacy (N, LEN, N_RULES) array or h5 dataset, into h5[key] and h5[key + "_mask"].
+    The source is read twice (scan, then encode), chunk_size rows at a time.
+    """
+    stored, denominator, background, kind, shared = _scan(source, chunk_size)
+    background = background if denominator and not np.isnan(background).all() else None
+    chunks = (max(min(batch_size, source.shape[0]), 1), *source.shape[1:])
+    ds = h5.create_dataset(key, source.shape, dtype = stored, chunks = chunks, compression = "gzip", shuffle = True)
+    ds.attrs["dtype"]       = source.dtype.name
+    ds.attrs["denominator"] = denominator
+    ds.attrs["mask"]        = kind
+    ds.attrs["background"]  = background is not None
+    if background is not None:
+        h5.create_dataset(key + "_background", data = background)
+    if kind == "shared":
+        h5.create_dataset(key + "_mask", data = shared)
+    elif kind == "rows":
+        h5.create_dataset(key + "_mask", source.shape, dtype = bool, chunks = chunks, compression = "gzip")
+
+    for start, x in _iter_rows(source, chunk_size):
+        valid = ~np.isnan(x)
+        x     = np.where(valid, x, 0)
+        if denominator:
+            codes = np.rint(x.astype(np.float64)*denominator)
+            if background is not None:
+                codes[x == background] = BACKGROUND
+            ds[start:start+len(x)] = codes.astype(np.uint8)
+        else:
+            ds[start:start+len(x)] = x.astype(stored)
+        if kind == "rows":
+            h5[key + "_mask"][start:start+len(x)] = valid
+    return ds
+
+def read_trsp(h5, key, index = slice(None), fill = np.nan):
+    """
+    h5[key][index] as in the legacy layout, from a file of either layout.
+    fill replaces NaN (rules that do not exist). With fill = 0 the mask of a compact file is not read.
+    """
+    ds = h5[key]
+    x  = ds[index]
+    if "denominator" not in ds.attrs:
+        return x if np.isnan(fill) else np.where(np.isnan(x), fill, x)
+
+    dtype = np.dtype(ds.attrs["dtype"])
+    if ds.attrs["denominator"]:
+        codes = x
+        x     = _table(int(ds.attrs["denominator"]), dtype)[codes]
+        if ds.attrs["background"]:
+            x = np.where(codes == BACKGROUND, h5[key + "_background"][()], x)
+    else:
+        x = x.astype(dtype, copy = False)
+    if ds.attrs["mask"] != "none" and fill != 0:
+        mask  = h5[key + "_mask"]
+        valid = mask[()] if ds.attrs["mask"] == "shared" else mask[index]
+        x     = np.where(valid, x, np.asarray(fill, dtype = dtype))
+    return x
+
+def convert_to_compact(src_path, dst_path, batch_size = 256, chunk_size = 4096):
+    """
+    legacy tr/s/p h5 file -> compact h5 file. Other datasets (id, ...) are copied as they are.
+    """
+    with h5py.File(src_path, "r") as src, h5py.File(dst_path, "w") as dst:
+        if is_compact(src):
+            raise ValueError(f"{src_path} is already compact.")
+        for key in src:
+            if key not in TRSP_KEYS:
+                src.copy(src[key], dst, key)
+        for key in TRSP_KEYS:
+            write_compact_dataset(dst, key, src[key], batch_size = batch_size, chunk_size = chunk_size)
+        dst.attrs["format"]     = FORMAT
+        dst.attrs["batch_size"] = batch_size
+    return dst_path
+
+def write_trsp_rows(src, targets):
+    """
+    copy rows of the id/tr/s/p datasets of src (open h5 file) to other h5 files, keeping the layout of src.
+    targets: list of (open h5 file, row indices). Each dataset of src is read once.
+    """
+    compact = is_compact(src)
+    for key in ("id", *TRSP_KEYS):
+        source = src[key]
+        data   = source[:]
+        for dst, rows in targets:
+            if key == "id" or not compact:
+                dst.create_dataset(key, data = data[rows], dtype = source.dtype)
+                continue
+            chunks = (max(min(int(src.attrs["batch_size"]), len(rows)), 1), *data.shape[1:])
+            ds = dst.create_dataset(key, data = data[rows], chunks = chunks, compression = "gzip", shuffle = True)
+            ds.attrs.update(source.attrs)
+            if source.attrs["background"]:
+                dst.create_dataset(key + "_background", data = src[key + "_background"][()])
+            if source.attrs["mask"] == "shared":
+                dst.create_dataset(key + "_mask", data = src[key + "_mask"][()])
+            elif source.attrs["mask"] == "rows":
+                dst.create_dataset(key + "_mask", data = src[key + "_mask"][:][rows], chunks = chunks, compression = "gzip")
+    for dst, _ in targets:
+        dst.attrs.update(src.attrs)
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    parser = argparse.ArgumentParser(description = "convert a tr/s/p h5 file of CM-VAE to the compact layout.")
+    parser.add_argument('-i', '--input', required = True, help = "legacy *_onehot_cm.h5 file")
+    parser.add_argument('-o', '--output', default = "", help = "output file (default: <input>_compact.h5)")
+    parser.add_argument('--batch_size', default = 256, type = int, help = "rows per h5 chunk. Use a multiple of the training batch size. (default: 256)")
+    args = parser.parse_args()
+
+    output = args.output if args.output else os.path.splitext(args.input)[0] + "_compact.h5"
+    convert_to_compact(args.input, output, batch_size = args.batch_size)
+    print(f"{args.input} ({os.path.getsize(args.input)} bytes) -> {output} ({os.path.getsize(output)} bytes)")
@@ -0,0 +1,117 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+
+import h5py
+import numpy as np
+import generate_weight
+from generate_weight import calc_distance_cm, compute_and_write_weight, count_neighbors, count_neighbors_lsh, flatten_onehot, weight_fingerprint, write_weight_resumable
+
+
+def weight_pairwise(tr, s, p, threshold):
+    """
+    exact weights by the pairwise loop of the original implementation.
+    """
+    N_COLUMNS = tr.shape[-1] + s.shape[-1] + p.shape[-1]
+    weight    = []
+    for i in range(len(tr)):
+        distances = [calc_distance_cm((tr[i], s[i], p[i]), (tr[j], s[j], p[j])) for j in range(len(tr)) if j != i]
+        weight.append(1/(1 + sum([1 if d < N_COLUMNS*threshold else 0 for d in distances])))
+    return np.array(weight)
+
+
+class TestWeight(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # near-duplicate clusters of one-hot like data
+        centers = rng.integers(0, 2, size = (4, 56*9 + 4*6 + 16*3)).astype(np.float32)
+        X = centers[rng.integers(0, 4, size = 60)]
+        X = np.where(rng.random(X.shape) < 0.15, 1 - X, X)
+        self.tr = X[:, :56*9].reshape(60, 9, 56)
+        self.s  = X[:, 56*9:56*9+4*6].reshape(60, 6, 4)
+        self.p  = X[:, 56*9+4*6:].reshape(60, 3, 16)
+
+    def test_blocked_counts_match_pairwise(self):
+        X = flatten_onehot([self.tr, self.s, self.p])
+        for data in [X, X*np.float32(0.7)]:  # 0/1 and general values
+            tr, s, p = data[:, :56*9].reshape(60, 9, 56), data[:, 56*9:56*9+4*6].reshape(60, 6, 4), data[:, 56*9+4*6:].reshape(60, 3, 16)
+            for threshold in [0, 0.1, 0.2, 0.3]:
+                expected = weight_pairwise(tr, s, p, threshold)
+                for block_size, cpu in [(7, 1), (None, 1), (16, 3)]:
+                    counts = count_neighbors(data, 76*threshold, block_size = block_size, cpu = cpu)
+                    np.testing.assert_array_equal(1/(1 + counts), expected)
+
+    def test_compute_and_write_weight(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            infile, outfile = os.path.join(tmp, "x.h5"), os.path.join(tmp, "w.h5")
+            with h5py.File(infile, "w") as f:
+                # stored as (N, cols, rules), like make_onehot_from_traceback
+                f.create_dataset("tr", data = self.tr)
+                f.create_dataset("s",  data = self.s)
+                f.create_dataset("p",  data = self.p)
+            Ntotal, Neff = compute_and_write_weight(infile, 0.2, outfile, cpu = 2)
+            expected = weight_pairwise(self.tr.transpose(0, 2, 1), self.s.transpose(0, 2, 1), self.p.transpose(0, 2, 1), 0.2)
+            with h5py.File(outfile, "r") as f:
+                np.testing.assert_allclose(f["weight"][:], expected, rtol = 1e-6)
+            self.assertEqual(Ntotal, 60)
+            self.assertAlmostEqual(Neff, expected.sum(), places = 6)
+
+    def test_lsh_counts(self):
+        X = flatten_onehot([self.tr, self.s, self.p])
+        X = np.concatenate([X, X[:10]])  # exact duplicates
+        for radius in [0, 40, 80]:
+            exact  = count_neighbors(X, radius)
+            approx = count_neighbors_lsh(X, radius)
+            self.assertTrue((approx <= exact).all())  # candidates are checked exactly
+            np.testing.assert_array_equal(approx, exact)
+        with self.assertRaises(ValueError):
+            count_neighbors_lsh(X*0.5, 40)
+
+    def test_lsh_dense_family(self):
+        # one family of 2000 distinct rows, all within the radius of each other
+        rng = np.random.default_rng(1)
+        X = np.tile(rng.integers(0, 2, size = 300), (2000, 1))
+        X[np.arange(2000), rng.integers(0, 300, size = 2000)] ^= 1
+        X[np.arange(2000), rng.integers(0, 300, size = 2000)] ^= 1
+        exact = count_neighbors(X, 10)
+        with mock.patch.object(generate_weight, "_hamming_pairs", wraps = generate_weight._hamming_pairs) as compared:
+            approx = count_neighbors_lsh(X, 10, n_tables = 5, max_bucket = 100)
+        n_unique = len(np.unique(X, axis = 0))
+        self.assertLessEqual(len(compared.call_args[0][1]), 5*n_unique*99//2)
+        self.assertTrue((approx <= exact).all())
+        self.assertGreater(approx.min(), 99)  # each row meets a whole part of the family in every table
+
+    def test_resume_after_interruption(self):
+        X = flatten_onehot([self.tr, self.s, self.p])
+        fingerprint = weight_fingerprint(X, threshold = 0.2)
+        # an edit of any row changes the fingerprint
+        large  = np.tile(X, (40, 1))
+        edited = large.copy()
+        edited[33, 0] = 1 - edited[33, 0]
+        self.assertNotEqual(weight_fingerprint(edited, threshold = 0.2), weight_fingerprint(large, threshold = 0.2))
+        calls = []
+        def failing_count(rows):
+            calls.append(rows[0])
+            if len(calls) == 3:
+                raise RuntimeError("interrupted")
+            return count_neighbors(X, 15.2, rows = rows)
+        with tempfile.TemporaryDirectory() as tmp:
+            outfile = os.path.join(tmp, "w.h5")
+            with self.assertRaises(RuntimeError):
+                write_weight_resumable(outfile, len(X), failing_count, fingerprint, rows_per_block = 16)
+            with h5py.File(outfile, "r") as f:
+                self.assertEqual(f["done"][:].tolist(), [True, True, False, False])
+            resumed = []
+            def count(rows):
+                resumed.append(rows[0])
+                return count_neighbors(X, 15.2, rows = rows)
+            weight = write_weight_resumable(outfile, len(X), count, fingerprint, rows_per_block = 16)
+            self.assertEqual(resumed, [32, 48])
+            np.testing.assert_array_equal(weight, (1/(1 + count_neighbors(X, 15.2))).astype(np.float32))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+import os
+import sys
+import tempfile
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+
+import numpy as np
+import torch
+from infernal_tools import CMReader, CompiledCM, CovarianceModel, TracebackFileReader, make_trsp_from_deriv_dict, make_deriv_dict_from_trsp, make_cms_from_trsp
+from cm_fixtures import write_synthetic_cmfile, write_synthetic_tfile, load_derivation_dict_legacy, load_aligned_tbdicts_legacy, cmeval_legacy
+
+
+class TestCMReader(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_same_derivation_dict_as_legacy_parser(self):
+        """
+        The single-pass parser must return exactly the dict of the line-by-line parser.
+        """
+        for seed, n_consensus in [(0, 10), (1, 25), (2, 40)]:
+            path = write_synthetic_cmfile(os.path.join(self.tmp.name, f"{seed}.cm"), n_consensus = n_consensus, seed = seed)
+            cmreader = CMReader(path)
+            deriv_dict = cmreader.load_derivation_dict_from_cmfile()
+            self.assertEqual(deriv_dict, load_derivation_dict_legacy(CMReader(path)))
+            self.assertEqual(list(deriv_dict), list(load_derivation_dict_legacy(CMReader(path))))
+
+    def test_thresholds(self):
+        path = write_synthetic_cmfile(os.path.join(self.tmp.name, "t.cm"), n_consensus = 5)
+        cmreader = CMReader(path)
+        self.assertEqual(cmreader.GA_THRESHOLD, 40.0)
+        self.assertEqual(cmreader.NC_THRESHOLD, 39.9)
+
+
+class TestCompiledCM(unittest.TestCase):
+    def setUp(self):
+        self.tmp  = tempfile.TemporaryDirectory()
+        self.path = write_synthetic_cmfile(os.path.join(self.tmp.name, "c.cm"), n_consensus = 30, seed = 3)
+        self.deriv_dict = CMReader(self.path).load_derivation_dict_from_cmfile()
+        self.compiled   = CompiledCM(self.deriv_dict)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        self.assertEqual(self.compiled.to_deriv_dict(), self.deriv_dict)
+        self.assertEqual(self.compiled.child_offsets[-1], len(self.compiled.child_ids))
+
+    def test_rule_index_tables(self):
+        from nltk import CFG
+        from infernal_tools import grammar, _transition_rule
+        productions = CFG.fromstring(grammar.grammar_CM).productions()
+        for (parent_type, child_type), row in grammar.CM_TR_ROW.items():
+            self.assertEqual(productions[row], _transition_rule(parent_type, child_type))
+        for nuc, row in grammar.CM_S_ROW.items():
+            self.assertEqual(productions[grammar.CM_N_TR + row].rhs(), (nuc,))
+        for pair, row in grammar.CM_P_ROW.items():
+            self.assertEqual(productions[grammar.CM_N_TR + grammar.CM_N_S + row].rhs(), (pair,))
+
+    def test_trsp_same_as_dict_path(self):
+        for a, b in zip(make_trsp_from_deriv_dict(self.path, self.deriv_dict, self.compiled),
+                        make_trsp_from_deriv_dict(self.path, self.deriv_dict)):
+            np.testing.assert_array_equal(a.numpy(), b.numpy())
+
+    def test_deriv_dict_from_trsp_same_as_dict_path(self):
+        tr, s, p = make_trsp_from_deriv_dict(self.path, self.deriv_dict, self.compiled)
+        g = torch.Generator().manual_seed(0)
+        trsp = [torch.rand(1, x.shape[1], x.shape[0], generator = g) for x in (tr, s, p)]
+        out_compiled = make_deriv_dict_from_trsp(self.deriv_dict, trsp, self.compiled)
+        out_dict     = make_deriv_dict_from_trsp(self.deriv_dict, trsp)
+        self.assertEqual(out_compiled, out_dict)
+        self.assertEqual(CovarianceModel(out_compiled).cmemit(2), CovarianceModel(out_dict).cmemit(2))
+
+
+    def test_batched_cms_from_trsp(self):
+        tr, s, p = make_trsp_from_deriv_dict(self.path, self.deriv_dict, self.compiled)
+        g = torch.Generator().manual_seed(1)
+        trsp = [torch.rand(5, x.shape[1], x.shape[0], generator = g) for x in (tr, s, p)]
+        cms  = make_cms_from_trsp(self.compiled, trsp)
+        self.assertEqual(len(cms), 5)
+        for b, cm in enumerate(cms):
+            self.assertEqual(cm.deriv_dict, make_deriv_dict_from_trsp(self.deriv_dict, [x[b:b+1] for x in trsp]))
+
+class TestCMEmit(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path     = write_synthetic_cmfile(os.path.join(self.tmp.name, "e.cm"), n_consensus = 30, seed = 4)
+        self.cm  = CovarianceModel(CMReader(path).load_derivation_dict_from_cmfile())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_seeded_batch(self):
+        self.assertEqual(self.cm.cmemit(50, sample = True, rng = 0), self.cm.cmemit(50, sample = True, rng = 0))
+        self.assertNotEqual(self.cm.cmemit(50, sample = True, rng = 0), self.cm.cmemit(50, sample = True, rng = 1))
+
+    def test_format(self):
+        for seq, ss in self.cm.cmemit(50, sample = True, rng = 0) + self.cm.cmemit(2):
+            self.assertEqual(len(seq), len(ss))
+            self.assertTrue(set(seq) <= set("ACGU"))
+            depth = 0
+            for c in ss:
+                depth += {"(":1, ")":-1, ".":0}[c]
+                self.assertGreaterEqual(depth, 0)
+            self.assertEqual(depth, 0)
+
+    def test_deterministic(self):
+        outputs = self.cm.cmemit(3)
+        self.assertEqual(len(outputs), 3)
+        self.assertEqual(len(set(outputs)), 1)
+
+
+class TestCMEval(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path     = write_synthetic_cmfile(os.path.join(self.tmp.name, "v.cm"), n_consensus = 12, seed = 5)
+        self.deriv_dict = CMReader(path).load_derivation_dict_from_cmfile()
+        self.cm  = CovarianceModel(self.deriv_dict)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_same_as_probability_space(self):
+        for seq, _ in self.cm.cmemit(3, sample = True, rng = 0):
+            seq = seq[:7]
+            self.assertAlmostEqual(np.exp(self.cm.cmeval(seq)), cmeval_legacy(self.deriv_dict, seq), places = 6)
+            self.assertAlmostEqual(self.cm.cmeval(seq), np.log(cmeval_legacy(self.deriv_dict, seq)), places = 4)
+
+    def test_banded(self):
+        seq = "".join(seq for seq, _ in self.cm.cmemit(5, sample = True, rng = 2))[:40]
+        bands = self.cm.compute_bands(len(seq), tau = 1e-7)
+        self.assertTrue(np.all(bands["dropped_mass"] <= 1e-7 + 1e-12))
+        self.assertAlmostEqual(self.cm.cmeval(seq, tau = 1e-7), self.cm.cmeval(seq), places = 3)
+        wide = self.cm.compute_bands(len(seq), tau = 0.)
+        self.assertAlmostEqual(self.cm.cmeval(seq, tau = 0.), self.cm.cmeval(seq), places = 9)
+        self.assertTrue(np.all(wide["dmax"] - wide["dmin"] >= bands["dmax"] - bands["dmin"]))
+
+    def test_score_many(self):
+        seqs   = [seq[:12] for seq, _ in self.cm.cmemit(8, sample = True, rng = 3)] + ["ACGU", "ACGUA"]
+        scores = self.cm.score_many(seqs)
+        for seq, score in zip(seqs, scores):
+            self.assertAlmostEqual(score, self.cm.cmeval(seq)/np.log(2) + 2*len(seq), places = 9)
+        np.testing.assert_allclose(self.cm.score_many(seqs, cpu = 2), scores)
+        np.testing.assert_allclose(self.cm.score_many(seqs, tau = 1e-7), scores, atol = 1e-3)
+
+    def test_no_underflow(self):
+        seq = "".join(seq for seq, _ in self.cm.cmemit(20, sample = True, rng = 1))[:120]
+        self.assertTrue(np.isfinite(self.cm.cmeval(seq)))
+
+
+class TestCYK(unittest.TestCase):
+    def setUp(self):
+        self.tmp  = tempfile.TemporaryDirectory()
+        self.path = write_synthetic_cmfile(os.path.join(self.tmp.name, "y.cm"), n_consensus = 15, seed = 6)
+        self.reader = TracebackFileReader(self.path)
+        self.cm     = self.reader.cm
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_parse(self):
+        cm = self.cm.compiled
+        for seq, _ in self.cm.cmemit(3, sample = True, rng = 0):
+            score, parse = self.cm.cyk(seq)
+            self.assertLessEqual(score, self.cm.cmeval(seq) + 1e-9)
+            tbdf = self.cm.make_tbdf_from_parse(seq, parse)
+            # the parse generates seq
+            emitted = sorted(
+                (int(x[:-1]), x[-1]) for x in list(tbdf["emitl"]) + list(tbdf["emitr"]) if not x.isnumeric()
+                )
+            self.assertEqual("".join(nuc for _, nuc in emitted), seq)
+            # and its log prob is the CYK score
+            logp = 0.
+            for (v, i, d), nxtl in zip(parse, tbdf["nxtl"].astype(int)):
+                state = cm.state_names[v]
+                if nxtl >= 0 and not state.startswith("B"):
+                    logp += np.log(cm.trans[v, list(cm.children[v]).index(parse[nxtl][0])])
+                if state.startswith("MP"):
+                    logp += np.log(cm.emit_pair[v, 4*"ACGU".index(seq[i]) + "ACGU".index(seq[i+d-1])])
+                elif state.startswith(("IL", "ML")):
+                    logp += np.log(cm.emit_single[v, "ACGU".index(seq[i])])
+                elif state.startswith(("IR", "MR")):
+                    logp += np.log(cm.emit_single[v, "ACGU".index(seq[i+d-1])])
+            self.assertAlmostEqual(logp, score, places = 9)
+
+    def test_trsp_in_memory(self):
+        seq  = self.cm.cmemit(1, sample = True, rng = 1)[0][0]
+        tbdf = self.reader.make_tbdf_from_seq(seq)
+        deriv_dict = self.reader.make_aligned_tbdict_from_tbdf_ELinitCM(tbdf)
+        tr, s, p   = make_trsp_from_deriv_dict(self.path, deriv_dict, self.cm.compiled)
+        self.assertEqual(tr.shape[0], self.cm.compiled.n_nodes)
+        self.assertEqual(s.shape[0], len(self.cm.compiled.single_states))
+
+
+class TestTracebackFileReader(unittest.TestCase):
+    def setUp(self):
+        self.tmp  = tempfile.TemporaryDirectory()
+        self.path = write_synthetic_cmfile(os.path.join(self.tmp.name, "t.cm"), n_consensus = 15, seed = 7)
+        self.cm   = CovarianceModel(CMReader(self.path).load_derivation_dict_from_cmfile())
+        self.seqs = [seq for seq, _ in self.cm.cmemit(6, sample = True, rng = 0)]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_same_aligned_tbdict_as_dataframe_parser(self):
+        for local_rng in [None, np.random.default_rng(0)]:
+            tb_file = write_synthetic_tfile(os.path.join(self.tmp.name, "tb.txt.gz"), self.cm, self.seqs, local_rng = local_rng)
+            reader  = TracebackFileReader(self.path, tb_file)
+            aligned = [reader.make_aligned_tbdict_from_tbdf_ELinitCM(tb) for tb in reader.iter_tracebacks()]
+            self.assertEqual(len(aligned), len(self.seqs))
+            self.assertEqual(aligned, load_aligned_tbdicts_legacy(self.path, tb_file))
+
+    def test_dataframe_input(self):
+        tb_file = write_synthetic_tfile(os.path.join(self.tmp.name, "tb.txt.gz"), self.cm, self.seqs[:1])
+        reader  = TracebackFileReader(self.path, tb_file)
+        tbdf    = reader.make_tbdf_from_seq(self.seqs[0])
+        self.assertEqual(
+            reader.make_aligned_tbdict_from_tbdf_ELinitCM(tbdf),
+            reader.make_aligned_tbdict_from_tbdf_ELinitCM(next(reader.iter_tracebacks()))
+            )
+
+
+    def test_onehot_h5_matches_per_sequence_conversion(self):
+        import h5py
+        import importlib
+        cwd = os.getcwd()
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))  # the script loads src/infernal_tools.py relative to cwd
+        try:
+            make_onehot = importlib.import_module("make_onehot_from_traceback")
+        finally:
+            os.chdir(cwd)
+        tb_file = write_synthetic_tfile(os.path.join(self.tmp.name, "tb.txt.gz"), self.cm, self.seqs, local_rng = np.random.default_rng(1))
+        reader  = TracebackFileReader(self.path, tb_file)
+        output  = make_onehot.make_onehot_of_cm_from_traceback(tb_file, self.path, [], chunk_size = 4)
+        with h5py.File(output, "r") as h5:
+            self.assertEqual([x.decode() for x in h5["id"][:]], [f"seq{n}" for n in range(len(self.seqs))])
+            for n, tb in enumerate(reader.iter_tracebacks()):
+                expected = make_trsp_from_deriv_dict(self.path, reader.make_aligned_tbdict_from_tbdf_ELinitCM(tb))
+                for key, x in zip(["tr", "s", "p"], expected):
+                    np.testing.assert_array_equal(h5[key][n], x.numpy().astype(np.float32))
+            legacy = [h5[key][:] for key in ["tr", "s", "p"]]
+        output = make_onehot.make_onehot_of_cm_from_traceback(tb_file, self.path, [], chunk_size = 4, compact = True)
+        with h5py.File(output, "r") as h5:
+            for key, x in zip(["tr", "s", "p"], legacy):
+                self.assertEqual(h5[key].dtype, np.uint8)
+                np.testing.assert_array_equal(make_onehot.trsp_h5.read_trsp(h5, key), x)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import jobs
+from jobs import JobStore, JobWorkerPool
+
+
+def echo_job(params, progress_messages, work_dir):
+    progress_messages.append(f"got {params['x']}")
+    print("a printed line")
+    with open(os.path.join(work_dir, "scratch.txt"), "w") as f:
+        f.write("intermediate")
+    with open(os.path.join(work_dir, "out.txt"), "w") as f:
+        f.write(str(params["x"]))
+    return {"y": params["x"] * 2, "file": os.path.join(work_dir, "out.txt")}
+
+def failing_job(params, progress_messages, work_dir):
+    progress_messages.append("starting")
+    raise ValueError("bad input")
+
+def crashing_job(params, progress_messages, work_dir):
+    os._exit(1)
+
+
+class TestJobs(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = JobStore(os.path.join(self.tmp.name, "jobs.sqlite"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_queue_order(self):
+        first  = self.store.submit(echo_job, {"x": 1})
+        second = self.store.submit(echo_job, {"x": 2})
+        self.assertEqual(self.store.get(second)["queue_position"], 1)
+        self.assertEqual(self.store.claim("worker")["id"], first)
+        self.assertEqual(self.store.get(first)["status"], "running")
+        self.assertEqual(self.store.claim("worker")["id"], second)
+        self.assertIsNone(self.store.claim("worker"))
+
+    def test_pool_runs_jobs(self):
+        with mock.patch.object(jobs, "JOBS_DIR", os.path.join(self.tmp.name, "jobs")):
+            ok     = self.store.submit(echo_job, {"x": 21})
+            failed = self.store.submit(failing_job, {})
+            pool = JobWorkerPool(n_workers = 2, db_path = self.store.path, poll = 0.1).start()
+            try:
+                job = self.store.wait(ok, poll = 0.1, timeout = 60)
+                self.assertEqual(job["status"], "succeeded")
+                self.assertEqual(job["result"]["y"], 42)
+                # only the result file is kept
+                self.assertEqual(os.listdir(os.path.dirname(job["result"]["file"])), ["out.txt"])
+                self.assertEqual([(kind, message) for _, _, kind, message in self.store.progress(ok)],
+                                 [("message", "got 21"), ("output", "a printed line")])
+                job = self.store.wait(failed, poll = 0.1, timeout = 60)
+                self.assertEqual((job["status"], job["error"]), ("failed", "bad input"))
+                self.assertFalse(os.path.exists(os.path.join(jobs.JOBS_DIR, failed)))
+                self.assertEqual(self.store.live_workers(), 2)
+            finally:
+                pool.stop()
+
+    def test_dead_workers_are_replaced(self):
+        with mock.patch.object(jobs, "JOBS_DIR", os.path.join(self.tmp.name, "jobs")):
+            crashed = self.store.submit(crashing_job, {})
+            pool = JobWorkerPool(n_workers = 1, db_path = self.store.path, poll = 0.1).start()
+            try:
+                job = self.store.wait(crashed, poll = 0.1, timeout = 60)
+                self.assertEqual(job["status"], "failed")
+                self.assertEqual(job["attempts"], jobs.MAX_ATTEMPTS)
+                job = self.store.wait(self.store.submit(echo_job, {"x": 1}), poll = 0.1, timeout = 60)
+                self.assertEqual(job["status"], "succeeded")
+            finally:
+                pool.stop()
+
+    def test_requeue_orphans(self):
+        job_id = self.store.submit(echo_job, {"x": 1})
+        self.store.heartbeat("worker")
+        self.store.claim("worker")
+        self.assertEqual(self.store.requeue_orphans(), {})
+        # the worker stopped sending heartbeats
+        self.assertEqual(self.store.requeue_orphans(stale = 0), {job_id: "queued"})
+        self.assertEqual(self.store.get(job_id)["status"], "queued")
+        self.store.claim("worker")
+        self.assertEqual(self.store.requeue_orphans(["worker"]), {job_id: "failed"})
+        self.assertEqual(self.store.get(job_id)["status"], "failed")
+
+    def test_purge(self):
+        with mock.patch.object(jobs, "JOBS_DIR", os.path.join(self.tmp.name, "jobs")):
+            job_id = self.store.submit(echo_job, {"x": 1})
+            jobs.run_job(self.store, self.store.claim("worker"))
+            pool = JobWorkerPool(n_workers = 0, db_path = self.store.path)
+            pool.purge(time.time() - 3600)
+            self.assertTrue(os.path.exists(os.path.join(jobs.JOBS_DIR, job_id)))
+            pool.purge(time.time() + 1)
+            self.assertFalse(os.path.exists(os.path.join(jobs.JOBS_DIR, job_id)))
+            self.assertEqual(self.store.progress(job_id), [])
+
+    def test_purge_keeps_files_in_use(self):
+        with mock.patch.object(jobs, "JOBS_DIR", os.path.join(self.tmp.name, "jobs")):
+            old = time.time() - 7200
+            resume_dir = os.path.join(jobs.JOBS_DIR, "weights", "key")
+            os.makedirs(resume_dir)
+            with open(os.path.join(resume_dir, "output_weight.h5"), "w") as f:
+                f.write("block")
+            os.utime(resume_dir, (old, old))  # writes to the file do not touch the directory
+            pool = JobWorkerPool(n_workers = 0, db_path = self.store.path)
+            pool.purge(time.time() - 3600)
+            self.assertTrue(os.path.exists(resume_dir))
+            # files of a job still in the queue are kept
+            os.utime(os.path.join(resume_dir, "output_weight.h5"), (old, old))
+            with mock.patch("time.time", return_value = old - 600):
+                self.store.submit(echo_job, {"x": 1})
+            pool.purge(time.time() - 3600)
+            self.assertTrue(os.path.exists(resume_dir))
+            self.store.claim("worker")
+            self.store.requeue_orphans(["worker"], stale = 0)
+            self.store.claim("worker")
+            self.store.requeue_orphans(["worker"])  # failed after MAX_ATTEMPTS runs
+            pool.purge(time.time() - 3600)
+            self.assertFalse(os.path.exists(resume_dir))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+import numpy as np
+import torch
+from model_cache import ModelCache, estimate_nbytes
+
+
+class TestModelCache(unittest.TestCase):
+    def test_hits_skip_loading(self):
+        cache = ModelCache()
+        loads = []
+        def load():
+            loads.append(1)
+            return torch.nn.Linear(4, 2).eval()
+        first = cache.get(("model", "etag:a", "etag:b"), load)
+        self.assertIs(cache.get(("model", "etag:a", "etag:b"), load), first)
+        self.assertEqual(len(loads), 1)
+        metrics = cache.metrics()
+        self.assertEqual((metrics["hits"], metrics["misses"], metrics["hit_rate"]), (1, 1, 0.5))
+        self.assertEqual(metrics["bytes"], (4*2 + 2)*4)
+
+    def test_lru_eviction_by_bytes(self):
+        array = lambda: np.zeros(1000)  # about 8 kB each
+        cache = ModelCache(max_bytes = 2*estimate_nbytes(array()))
+        cache.get("a", array)
+        cache.get("b", array)
+        cache.get("a", array)  # b is now the least recently used
+        cache.get("c", array)
+        self.assertEqual(list(cache.entries), ["a", "c"])
+        self.assertEqual(cache.metrics()["evictions"], 1)
+        # a value over the budget is kept alone
+        cache.get("big", lambda: np.zeros(10000))
+        self.assertEqual(list(cache.entries), ["big"])
+        self.assertEqual(cache.nbytes, estimate_nbytes(np.zeros(10000)))
+
+
+if __name__ == '__main__':
+    unittest.main()
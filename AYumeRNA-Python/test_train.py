@@ -0,0 +1,205 @@
+import importlib.util
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+
+import csv
+import h5py
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from train import GlooSyncBatchNorm, allreduce_gradients, train_main, _free_port
+from trsp_h5 import convert_to_compact
+from models.loss import CMVAELoss, inverse_scale, modifiedCELoss
+
+
+def make_synthetic_trsp(path, n = 96, tr_len = 20, s_len = 16, p_len = 16, seed = 0):
+    """
+    one-hot tr/s/p in the legacy layout: 4 clusters of rows with 10% of the columns redrawn.
+    """
+    rng = np.random.default_rng(seed)
+    def onehot(length, n_rules, n_valid):
+        centers = rng.integers(0, n_valid, size = (4, length))
+        rules   = centers[rng.integers(0, 4, size = n)]
+        rules   = np.where(rng.random(rules.shape) < 0.1, rng.integers(0, n_valid, size = rules.shape), rules)
+        x = np.zeros((n, length, n_rules), dtype = np.float32)
+        np.put_along_axis(x, rules[..., None], 1, axis = -1)
+        x[..., n_valid:] = np.nan
+        return x
+    with h5py.File(path, "w") as h5:
+        h5.create_dataset("id", data = [f"seq{i}" for i in range(n)], dtype = h5py.special_dtype(vlen = str))
+        h5.create_dataset("tr", data = onehot(tr_len, 56, 3))
+        h5.create_dataset("s",  data = onehot(s_len, 4, 4))
+        h5.create_dataset("p",  data = onehot(p_len, 16, 16))
+    return path
+
+def _gradient_worker(rank, world_size, port, X, w, out):
+    dist.init_process_group("gloo", init_method = f"tcp://127.0.0.1:{port}", rank = rank, world_size = world_size)
+    torch.manual_seed(0)
+    model = GlooSyncBatchNorm.convert(torch.nn.Sequential(torch.nn.Linear(X.shape[1], 3), torch.nn.BatchNorm1d(3)))
+    shard = slice(rank*len(X)//world_size, (rank + 1)*len(X)//world_size)
+    (w[shard]*model(X[shard]).pow(2).sum(dim = -1)).sum().backward()
+    allreduce_gradients(model)
+    if rank == 0:
+        out.copy_(torch.cat([param.grad.reshape(-1) for param in model.parameters()] + [model[1].running_var]))
+    dist.destroy_process_group()
+
+
+def legacy_modifiedCELoss(pred, soft_targets, gamma=0, summarize=True):
+    """
+    modifiedCELoss as it was in scripts/train.py and scripts/pred_activity.py.
+    """
+    scale = soft_targets.nansum(dim=-1).unsqueeze(dim=-1)
+    logsoftmax = torch.nn.LogSoftmax(dim=-1)
+    softmax = torch.nn.Softmax(dim=-1)
+    ce = -soft_targets / scale * ((1 - softmax(pred)).pow(gamma)) * logsoftmax(pred)
+    if summarize:
+        return torch.sum(ce)
+    else:
+        return ce.sum(dim=-1).sum(dim=-1)
+
+
+class TestLoss(unittest.TestCase):
+    def test_gradients_equal_legacy_loss(self):
+        torch.manual_seed(0)
+        targets = []
+        for n_rule, length in [(56, 30), (4, 20), (16, 10)]:
+            target = torch.nn.functional.one_hot(torch.randint(n_rule, (6, length)), n_rule).transpose(1, 2).float()
+            target[:, :, ::3] = torch.rand(6, n_rule, 1)*2  # soft, unnormalized columns
+            targets.append(target)
+        w = torch.rand(6)
+        for gamma in [0, 2]:
+            preds  = [torch.randn(target.shape, requires_grad = True) for target in targets]
+            legacy = sum(legacy_modifiedCELoss(pred.transpose(-1, -2), target.transpose(-1, -2), gamma, summarize = False) for pred, target in zip(preds, targets))
+            expected_grads = torch.autograd.grad((w*legacy).sum(), preds)
+            for inv_scales in [None, [inverse_scale(target) for target in targets]]:
+                fused = CMVAELoss(gamma = gamma)(preds, targets, inv_scales)
+                torch.testing.assert_close(fused, legacy)
+                for grad, expected in zip(torch.autograd.grad((w*fused).sum(), preds), expected_grads):
+                    torch.testing.assert_close(grad, expected)
+            pred, target = preds[1].transpose(-1, -2), targets[1].transpose(-1, -2)
+            torch.testing.assert_close(modifiedCELoss(pred, target, gamma), legacy_modifiedCELoss(pred, target, gamma))
+
+    def test_nan_targets_count_as_zero(self):
+        torch.manual_seed(0)
+        target = torch.nn.functional.one_hot(torch.randint(3, (4, 10)), 56).transpose(1, 2).float()
+        clean  = [target, target[:, :4], target[:, :16]]
+        nan    = [x.clone() for x in clean]
+        for x in nan:
+            x[:, -1] = torch.nan  # a rule that does not exist
+        preds = [torch.randn(x.shape, requires_grad = True) for x in clean]
+        torch.testing.assert_close(inverse_scale(nan[0]), inverse_scale(clean[0]))
+        loss = CMVAELoss()(preds, nan)
+        torch.testing.assert_close(loss, CMVAELoss()(preds, clean))
+        self.assertTrue(all(torch.isfinite(grad).all() for grad in torch.autograd.grad(loss.sum(), preds)))
+
+
+class TestDataParallel(unittest.TestCase):
+    def test_gradients_equal_global_batch(self):
+        X, w = torch.randn(12, 5), torch.rand(12)
+        out  = torch.zeros(27).share_memory_()
+        mp.spawn(_gradient_worker, args = (2, _free_port(), X, w, out), nprocs = 2, join = True)
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(torch.nn.Linear(5, 3), torch.nn.BatchNorm1d(3))
+        (w*model(X).pow(2).sum(dim = -1)).sum().backward()
+        expected = torch.cat([param.grad.reshape(-1) for param in model.parameters()] + [model[1].running_var])
+        torch.testing.assert_close(out, expected)
+
+    @unittest.skipUnless(importlib.util.find_spec("requests"), "models.CMVAE needs the requests package")
+    def test_convergence_equivalent_to_single_process(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            make_synthetic_trsp(os.path.join(tmp, "X.h5"))
+            final = {}
+            for world_size, batch_size in [(1, 16), (2, 8)]:
+                log_dir = os.path.join(tmp, f"log{world_size}")
+                os.makedirs(log_dir)
+                args = {
+                    "data_dir": tmp, "X_train": "X.h5", "log": True, "log_dir": log_dir, "epoch": 15,
+                    "batch_size": batch_size, "world_size": world_size, "hidden": 32, "z_dim": 4,
+                    "learning_rate": 1e-2, "print_every": 1000, "threads_per_worker": 1
+                    }
+                train_main(args)
+                self.assertEqual(sorted(os.listdir(log_dir)), ["config.yaml", "log.csv", "model_epoch15.pt"])
+                with open(os.path.join(log_dir, "log.csv")) as f:
+                    loss = [float(row["loss"]) for row in csv.DictReader(f)]
+                self.assertEqual(len(loss), 15*(96//16))  # one log row per global batch
+                final[world_size] = np.mean(loss[-12:])
+                self.assertLess(final[world_size], 0.7*np.mean(loss[:6]))
+            self.assertAlmostEqual(final[2]/final[1], 1, delta = 0.1)
+
+
+
+@unittest.skipUnless(importlib.util.find_spec("requests"), "models.CMVAE needs the requests package")
+class TestPredActivity(unittest.TestCase):
+    def test_compact_file_scores_as_legacy(self):
+        from models.CMVAE import CovarianceModelVAE
+        from pred_activity import eval_ELBO, load_data_cm
+        with tempfile.TemporaryDirectory() as tmp:
+            legacy  = make_synthetic_trsp(os.path.join(tmp, "X.h5"), n = 8)
+            with h5py.File(legacy, "a") as h5:
+                h5["s"][...] = h5["s"][:]/2  # stored as uint8 codes of k/2 in the compact layout
+            compact = convert_to_compact(legacy, os.path.join(tmp, "X_compact.h5"))
+            trsp    = load_data_cm(legacy)
+            for x, y in zip(trsp, load_data_cm(compact)):
+                torch.testing.assert_close(x, y, rtol = 0, atol = 0)
+        torch.manual_seed(0)
+        model = CovarianceModelVAE(32, 4, 32, *[x.shape[-1] for x in trsp]).eval()
+        score = eval_ELBO(model, [x[:2] for x in trsp], beta = 1e-3, n_samples = 2)
+        self.assertTrue(torch.isfinite(score))
+
+
+@unittest.skipUnless(importlib.util.find_spec("requests"), "models.CMVAE needs the requests package")
+class TestResume(unittest.TestCase):
+    def train(self, tmp, name, epoch, fail_at_step = None, **kwargs):
+        log_dir = os.path.join(tmp, name)
+        os.makedirs(log_dir, exist_ok = True)
+        args = {
+            "data_dir": tmp, "X_train": "X.h5", "X_valid": "X.h5", "log": True, "log_dir": log_dir, "epoch": epoch,
+            "batch_size": 16, "hidden": 32, "z_dim": 4, "use_anneal": True, "print_every": 1000, **kwargs
+            }
+        adam_step = torch.optim.Adam.step
+        calls = []
+        def failing_step(optimizer, *a, **k):
+            calls.append(1)
+            if len(calls) == fail_at_step:
+                raise RuntimeError("interrupted")
+            return adam_step(optimizer, *a, **k)
+        with mock.patch.object(torch.optim.Adam, "step", failing_step):
+            train_main(args)
+        with open(os.path.join(log_dir, "log.csv")) as f:
+            log = list(csv.DictReader(f))
+        return log, torch.load(os.path.join(log_dir, f"model_epoch{epoch}.pt")), len(calls)
+
+    def assert_same_training(self, a, b):
+        self.assertEqual(a[0], b[0])
+        self.assertEqual(len(a[0]), 3*(96//16))
+        for key in a[1]:
+            torch.testing.assert_close(a[1][key], b[1][key], rtol = 0, atol = 0)
+
+    def test_resume_equals_uninterrupted_run(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            make_synthetic_trsp(os.path.join(tmp, "X.h5"))
+            expected = self.train(tmp, "uninterrupted", 3)
+            # interrupted in the middle of epoch 2 after a time-based checkpoint at every step
+            with self.assertRaises(RuntimeError):
+                self.train(tmp, "interrupted", 3, fail_at_step = 9, ckpt_minutes = 1e-9)
+            resumed = self.train(tmp, "interrupted", 3, ckpt_minutes = 1e-9)
+            self.assertEqual(resumed[2], 18 - 8)
+            self.assert_same_training(resumed, expected)
+            # more epochs for a finished run
+            self.train(tmp, "extended", 2, save_ckpt = True, ckpt_iter = 1)
+            extended = self.train(tmp, "extended", 3, save_ckpt = True, ckpt_iter = 1)
+            self.assertEqual(extended[2], 6)
+            self.assert_same_training(extended, expected)
+            # another config starts over
+            other = self.train(tmp, "extended", 3, save_ckpt = True, ckpt_iter = 1, learning_rate = 1e-2)
+            self.assertNotEqual(other[0], expected[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
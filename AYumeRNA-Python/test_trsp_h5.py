@@ -0,0 +1,102 @@
+import os
+import sys
+import tempfile
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+
+import h5py
+import numpy as np
+from trsp_h5 import TRSP_KEYS, convert_to_compact, is_compact, read_trsp
+from generate_weight import compute_and_write_weight
+from split_onehot_train_valid_test import split_onehot_cm
+
+
+def make_legacy(path, tr, s, p):
+    with h5py.File(path, "w") as h5:
+        h5.create_dataset("id", data = [f"seq{n}" for n in range(len(tr))], dtype = h5py.special_dtype(vlen = str))
+        h5.create_dataset("tr", data = tr)
+        h5.create_dataset("s",  data = s)
+        h5.create_dataset("p",  data = p)
+    return path
+
+
+class TestCompactLayout(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        N   = 50
+        # one-hot transitions, NaN where the node has no such rule (same for all rows)
+        tr = np.zeros((N, 12, 56), dtype = np.float32)
+        tr[np.arange(N)[:, None], np.arange(12), rng.integers(0, 3, size = (N, 12))] = 1
+        tr[:, :, 3:] = np.nan
+        # counts divided by small integers
+        s = (rng.integers(0, 7, size = (N, 5, 4))/np.array([1, 2, 3, 6])).astype(np.float32)
+        p = rng.random((N, 4, 16)).astype(np.float32)
+        self.trsp = (tr, s, p)
+        self.legacy = make_legacy(os.path.join(self.tmp.name, "x_onehot_cm.h5"), tr, s, p)
+        self.compact = convert_to_compact(self.legacy, os.path.join(self.tmp.name, "c_onehot_cm.h5"), batch_size = 8)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def assert_same_layout_values(self, path_a, path_b):
+        with h5py.File(path_a, "r") as a, h5py.File(path_b, "r") as b:
+            self.assertEqual(a["id"][:].tolist(), b["id"][:].tolist())
+            for key in TRSP_KEYS:
+                x, y = read_trsp(a, key), read_trsp(b, key)
+                self.assertEqual(x.dtype, y.dtype)
+                np.testing.assert_array_equal(x, y)  # NaN at the same positions
+
+    def test_round_trip(self):
+        self.assert_same_layout_values(self.legacy, self.compact)
+        with h5py.File(self.compact, "r") as h5:
+            self.assertTrue(is_compact(h5))
+            self.assertEqual([h5[key].dtype for key in TRSP_KEYS], [np.uint8, np.uint8, np.float32])
+            self.assertEqual([h5[key].attrs["denominator"] for key in TRSP_KEYS], [1, 6, 0])
+            self.assertEqual(h5["tr"].attrs["mask"], "shared")
+            self.assertEqual(h5["tr"].chunks[0], 8)
+            index = np.array([3, 7, 20])
+            np.testing.assert_array_equal(read_trsp(h5, "tr", index, fill = 0), np.nan_to_num(self.trsp[0][index]))
+            np.testing.assert_array_equal(read_trsp(h5, "s", 4), self.trsp[1][4])
+
+    def test_float16_and_per_row_mask(self):
+        tr, s, p = self.trsp
+        tr = tr.copy()
+        tr[0, 0, 5]  = 0.25  # a rule that is NaN in the other rows
+        tr[:, 1, :3] = np.where(np.arange(50)[:, None] % 2 == 0, tr[:, 1, :3], [0.3, 0.2, 0.5])  # unvisited node keeps the CM parameters
+        tr[7, 1, :3] = [0.5, 0.5, 0]  # and other fractions too
+        p16 = np.random.default_rng(1).random(p.shape).astype(np.float16).astype(np.float64)
+        legacy  = make_legacy(os.path.join(self.tmp.name, "y.h5"), tr, s, p16)
+        compact = convert_to_compact(legacy, os.path.join(self.tmp.name, "y_compact.h5"))
+        self.assert_same_layout_values(legacy, compact)
+        with h5py.File(compact, "r") as h5:
+            self.assertEqual(h5["tr"].attrs["mask"], "rows")
+            self.assertEqual(h5["tr"].attrs["denominator"], 2)
+            self.assertTrue(h5["tr"].attrs["background"])
+            np.testing.assert_array_equal(h5["tr_background"][1, :3], np.float32([0.3, 0.2, 0.5]))
+            self.assertEqual(h5["p"].dtype, np.float16)
+            self.assertEqual(read_trsp(h5, "p").dtype, np.float64)
+
+    def test_split_keeps_layout(self):
+        split_onehot_cm(self.legacy, suffix = "_legacy")
+        split_onehot_cm(self.compact, suffix = "_compact")
+        for part in ["train", "valid", "test"]:
+            legacy  = os.path.join(self.tmp.name, f"x_onehot_cm_{part}_legacy.h5")
+            compact = os.path.join(self.tmp.name, f"c_onehot_cm_{part}_compact.h5")
+            self.assert_same_layout_values(legacy, compact)
+            with h5py.File(compact, "r") as h5:
+                self.assertTrue(is_compact(h5))
+
+    def test_weights_from_compact_file(self):
+        weights = []
+        for path in [self.legacy, self.compact]:
+            outfile = path + ".weight.h5"
+            compute_and_write_weight(path, 0.1, outfile)
+            with h5py.File(outfile, "r") as h5:
+                weights.append(h5["weight"][:])
+        np.testing.assert_array_equal(weights[0], weights[1])
+
+
+if __name__ == '__main__':
+    unittest.main()